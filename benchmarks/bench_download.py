@@ -0,0 +1,123 @@
+"""Download a label end to end from a local stand-in server.
+
+    python benchmarks/bench_download.py [-r RELEASES] [-j JOBS] [--api] ...
+
+Runs `download_urls` like the command line does, or with --api
+`BCFreeDownloader.download_label`, against a StandInServer (see server.py)
+and reports releases per minute, MB/s and the peak RSS of the process, which
+includes the server. Every --email-every-th release is only available by
+email, its download email arrives in a LocalMailProvider inbox.
+"""
+
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+
+# progress bars only get in the way of the report, tqdm reads this on import
+os.environ.setdefault("TQDM_DISABLE", "1")
+
+from free_bandcamp_downloader import logger
+from free_bandcamp_downloader.__main__ import (
+    Config,
+    download_urls,
+    downloader_from_config,
+)
+from free_bandcamp_downloader.history import DownloadHistory
+from server import LocalMailProvider, StandInServer
+
+
+def peak_rss() -> int:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def run_cli(server: StandInServer, config: Config) -> int:
+    with downloader_from_config(config) as downloader:
+        downloader.mail_provider = LocalMailProvider(server)
+        download_urls([server.label_url], config, downloader)
+    with DownloadHistory.open(config.get("download-history-file")) as history:
+        return len(history)
+
+
+def run_api(server: StandInServer, config: Config, jobs: int) -> int:
+    with downloader_from_config(config) as downloader:
+        downloader.mail_provider = LocalMailProvider(server)
+        page = downloader.get_url_page(server.label_url)
+        info = downloader.download_label(page, jobs)
+        # email releases are marked downloaded in place
+        downloader.flush_email_downloads()
+    return sum(
+        bool((r.get("release_info") or {}).get("is_downloaded"))
+        for r in info["releases"]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--releases", type=int, default=20)
+    parser.add_argument("-t", "--tracks", type=int, default=4)
+    parser.add_argument("--track-size", type=float, default=2, help="MiB")
+    parser.add_argument("-j", "--jobs", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=20, help="ms per request")
+    parser.add_argument(
+        "--bandwidth", type=float, default=0, help="MiB/s per connection, 0 for any"
+    )
+    parser.add_argument("--email-every", type=int, default=4)
+    parser.add_argument("--mail-delay", type=float, default=0.5, help="seconds")
+    parser.add_argument(
+        "--rate-limit", default="1000", help="requests per second, see --rate-limit"
+    )
+    parser.add_argument("--stream-unzip", action="store_true")
+    parser.add_argument("--api", action="store_true", help="use BCFreeDownloader")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args()
+    if not args.debug:
+        logger.setLevel("WARNING")
+
+    server = StandInServer(
+        releases=args.releases,
+        tracks=args.tracks,
+        track_size=int(args.track_size * 1024**2),
+        email_every=args.email_every,
+        latency=args.latency / 1000,
+        bandwidth=args.bandwidth * 1024**2 or None,
+        mail_delay=args.mail_delay,
+    )
+    with server, tempfile.TemporaryDirectory() as tmp:
+        os.environ["XDG_CONFIG_HOME"] = os.path.join(tmp, "config")
+        os.environ["XDG_DATA_HOME"] = os.path.join(tmp, "data")
+        config = Config()
+        config.set("dir", os.path.join(tmp, "out"))
+        os.makedirs(config.get("dir"))
+        config.set("jobs", args.jobs)
+        config.set("email", "auto")
+        config.set("rate-limit", args.rate_limit)
+        config.set("cdn-rate-limit", args.rate_limit)
+        config.set("stream-unzip", args.stream_unzip)
+
+        start = time.perf_counter()
+        if args.api:
+            releases = run_api(server, config, args.jobs)
+        else:
+            releases = run_cli(server, config)
+        elapsed = time.perf_counter() - start
+
+    mb = server.bytes_sent / 1e6
+    print(
+        f"{'releases':>10}{'seconds':>10}{'rel/min':>10}{'MB':>10}{'MB/s':>10}"
+        f"{'peak RSS MiB':>14}"
+    )
+    print(
+        f"{releases:>10}{elapsed:>10.2f}{releases / elapsed * 60:>10.1f}"
+        f"{mb:>10.1f}{mb / elapsed:>10.1f}{peak_rss() / 1024**2:>14.1f}"
+    )
+    if releases != args.releases:
+        raise SystemExit(f"only {releases} of {args.releases} releases downloaded")
+
+
+if __name__ == "__main__":
+    main()
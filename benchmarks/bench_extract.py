@@ -0,0 +1,55 @@
+"""Compare the page extraction backends on the saved fixture pages.
+
+    python benchmarks/bench_extract.py [-n ROUNDS]
+
+Each round runs the same helpers the downloader uses on every page
+(get_page_info, get_download_info) with both backends and checks that they
+agree.
+"""
+
+import argparse
+import glob
+import os
+import time
+
+from free_bandcamp_downloader.bc_free_downloader import BCFreeDownloader
+from free_bandcamp_downloader.extract import make_extractor
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def extract(name: str, text: str, backend: str):
+    page = make_extractor(text, backend)
+    if name == "download.html":
+        return BCFreeDownloader.get_download_info(page, "FLAC")
+    return BCFreeDownloader.get_page_info(page)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'page':<16}{'size':>10}{'soup ms':>12}{'fast ms':>12}{'speedup':>10}")
+    for path in sorted(glob.glob(os.path.join(FIXTURES, "*.html"))):
+        name = os.path.basename(path)
+        with open(path) as f:
+            text = f.read()
+        if extract(name, text, "soup") != extract(name, text, "fast"):
+            raise SystemExit(f"backends disagree on {path}")
+
+        timings = {}
+        for backend in ("soup", "fast"):
+            start = time.perf_counter()
+            for _ in range(args.rounds):
+                extract(name, text, backend)
+            timings[backend] = (time.perf_counter() - start) / args.rounds * 1000
+        print(
+            f"{name:<16}{len(text):>10}"
+            f"{timings['soup']:>12.2f}{timings['fast']:>12.2f}"
+            f"{timings['soup'] / timings['fast']:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Measure how long the command line takes to start.
+
+    python benchmarks/bench_import.py [-n ROUNDS] [--max-ms MS]
+
+Times fresh interpreters importing free_bandcamp_downloader.__main__ and
+running `bcdl-free --version`, and checks that importing the command line
+doesn't load any of the heavy dependencies, which are only needed once
+something is downloaded. Exits with an error if one of them is loaded or if
+the median startup is slower than --max-ms, so it can guard against an
+eager import creeping back in.
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+# only imported by the code paths that use them
+HEAVY_MODULES = (
+    "bs4",
+    "guerrillamail",
+    "importlib.metadata",
+    "mutagen",
+    "pyrfc6266",
+    "requests",
+    "tqdm",
+    "free_bandcamp_downloader.bc_free_downloader",
+)
+
+LOADED = (
+    "import sys, free_bandcamp_downloader.__main__\n"
+    f"print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+)
+
+COMMANDS = {
+    "python": [sys.executable, "-c", "pass"],
+    "import": [sys.executable, "-c", "import free_bandcamp_downloader.__main__"],
+    "--version": [sys.executable, "-m", "free_bandcamp_downloader", "--version"],
+}
+
+
+def median_ms(command, rounds: int) -> float:
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--rounds", type=int, default=10)
+    parser.add_argument(
+        "--max-ms", type=float, default=0, help="fail above this, 0 for no limit"
+    )
+    args = parser.parse_args()
+
+    loaded = subprocess.run(
+        [sys.executable, "-c", LOADED], check=True, capture_output=True, text=True
+    ).stdout.split()
+
+    print(f"{'command':<12}{'median ms':>12}")
+    results = {}
+    for name, command in COMMANDS.items():
+        results[name] = median_ms(command, args.rounds)
+        print(f"{name:<12}{results[name]:>12.1f}")
+    # the interpreter's own startup isn't ours to speed up
+    startup = results["--version"] - results["python"]
+    print(f"{'overhead':<12}{startup:>12.1f}")
+
+    if loaded:
+        raise SystemExit(f"importing the command line loads {', '.join(loaded)}")
+    if args.max_ms and startup > args.max_ms:
+        raise SystemExit(f"startup took {startup:.1f}ms, over {args.max_ms}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Compare the transfer loop with the iter_content loop it replaced.
+
+    python benchmarks/bench_transfer.py [-s SIZE] [-n FILES] [-j JOBS]
+
+Downloads the same file from a StandInServer (see server.py) `-n` times on
+`-j` threads into a temporary directory with each loop, and reports MB/s and
+the CPU time spent per GB. "iter_content" is the previous loop: a new 1 MiB
+bytes object per chunk, a progress update per chunk and a file that grows as
+it is appended to. The others read into one reused buffer with a preallocated
+file and throttled progress, with the adaptive or a fixed chunk size.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+# progress bars only get in the way of the report, tqdm reads this on import
+os.environ.setdefault("TQDM_DISABLE", "1")
+
+import requests
+
+from free_bandcamp_downloader.bc_free_downloader import (
+    BCFreeDownloader,
+    TransferProgress,
+)
+from free_bandcamp_downloader.transfer import PartFile, copy_response
+from server import StandInServer
+
+
+class Progress:
+    """The progress bar as it was, updated on every chunk"""
+
+    def __init__(self, total: int):
+        from tqdm import tqdm
+
+        self.bar = tqdm(total=total, unit="iB", unit_scale=True)
+
+    def update(self, n: int):
+        self.bar.update(n)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.bar.close()
+
+
+def iter_content(r: requests.Response, file_name: str, size: int):
+    with Progress(size) as pbar, open(file_name, "wb") as f:
+        for chunk in r.iter_content(chunk_size=BCFreeDownloader.CHUNK_SIZE):
+            f.write(chunk)
+            pbar.update(len(chunk))
+
+
+def buffered(chunk_size):
+    def transfer(r: requests.Response, file_name: str, size: int):
+        with TransferProgress(size) as pbar, open(file_name, "wb") as f:
+            PartFile(file_name).preallocate(f, size)
+            copy_response(r, f.write, pbar, chunk_size, size)
+
+    return transfer
+
+
+LOOPS = {
+    "iter_content": iter_content,
+    "adaptive": buffered(None),
+    "64 KiB": buffered(64 * 1024),
+    "1 MiB": buffered(1024**2),
+}
+
+
+def run(loop, session: requests.Session, url: str, files: int, jobs: int, tmp: str):
+    def download(i: int):
+        with session.get(url, stream=True) as r:
+            r.raise_for_status()
+            size = int(r.headers["content-length"])
+            file_name = os.path.join(tmp, f"{i}.zip")
+            loop(r, file_name, size)
+        if os.path.getsize(file_name) != size:
+            raise SystemExit(f"{file_name} is incomplete")
+        os.remove(file_name)
+        return size
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        return sum(pool.map(download, range(files)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--size", type=float, default=64, help="MiB per file")
+    parser.add_argument("-n", "--files", type=int, default=8)
+    parser.add_argument("-j", "--jobs", type=int, default=4)
+    parser.add_argument(
+        "--bandwidth", type=float, default=0, help="MiB/s per connection, 0 for any"
+    )
+    args = parser.parse_args()
+
+    server = StandInServer(
+        releases=1,
+        tracks=1,
+        track_size=int(args.size * 1024**2),
+        bandwidth=args.bandwidth * 1024**2 or None,
+    )
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.jobs)
+    session.mount("http://", adapter)
+    url = f"{server.base_url}/files/{server.release_ids()[0]}"
+
+    print(f"{'loop':<14}{'seconds':>10}{'MB/s':>10}{'CPU s/GB':>10}")
+    with server, tempfile.TemporaryDirectory() as tmp:
+        for name, loop in LOOPS.items():
+            # the server runs in this process, its CPU time is included
+            start, cpu = time.perf_counter(), time.process_time()
+            size = run(loop, session, url, args.files, args.jobs, tmp)
+            elapsed = time.perf_counter() - start
+            cpu = time.process_time() - cpu
+            print(
+                f"{name:<14}{elapsed:>10.2f}{size / elapsed / 1e6:>10.1f}"
+                f"{cpu / (size / 1e9):>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
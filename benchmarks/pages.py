@@ -0,0 +1,233 @@
+"""Synthetic Bandcamp pages for the benchmarks.
+
+The pages carry the same blobs as real release, label and download pages
+(og:type, data-tralbum, ld+json, data-band, music-grid, #pagedata) wrapped in
+roughly as much unrelated markup as the real ones.
+"""
+
+import html
+import json
+from typing import Dict, List, Optional
+
+
+def _attr(obj) -> str:
+    return html.escape(json.dumps(obj), quote=True)
+
+
+def _filler(n: int) -> str:
+    # navigation, comment and recommendation blocks like on the real pages
+    blocks = []
+    for i in range(n):
+        blocks.append(
+            f'<div class="recommendations-container" id="rec-{i}">'
+            f'<ul class="recommendations"><li class="recommended-album">'
+            f'<a class="album-link" href="https://artist{i}.bandcamp.com/album/x{i}"'
+            f' data-trackpipe="{{&quot;index&quot;:{i}}}">'
+            f'<img class="album-art" src="https://f4.bcbits.com/img/a{i}_9.jpg" alt="">'
+            f'<span class="release-title">Recommended release {i}</span></a>'
+            f'<div class="comment"><span class="fan-name">fan{i}</span>'
+            f"<p>This is a great record, track {i % 12} > everything else & more.</p>"
+            f"</div></li></ul></div>\n"
+        )
+    return "".join(blocks)
+
+
+def _head(og_type: str, url: str, title: str, ld_json: Optional[Dict]) -> str:
+    ld = ""
+    if ld_json is not None:
+        ld = (
+            '<script type="application/ld+json">\n'
+            f"{json.dumps(ld_json, indent=4)}\n</script>\n"
+        )
+    return (
+        "<!DOCTYPE html>\n<html>\n<head>\n"
+        f"<title>{html.escape(title)}</title>\n"
+        '<meta charset="utf-8">\n'
+        f'<meta property="og:title" content="{html.escape(title)}">\n'
+        f'<meta property="og:type" content="{og_type}">\n'
+        f'<meta property="og:url" content="{url}">\n'
+        '<link rel="stylesheet" href="https://s4.bcbits.com/client-bundle/1/'
+        'global.css">\n'
+        + "".join(
+            f'<script src="https://s4.bcbits.com/bundle/{i}.js" '
+            f'data-vars="{_attr({"n": i})}"></script>\n'
+            for i in range(20)
+        )
+        + ld
+        + "</head>\n"
+    )
+
+
+def album_page(
+    base_url: str,
+    item_id: int,
+    tracks: int = 12,
+    free: bool = True,
+    item_type: str = "album",
+) -> str:
+    url = f"{base_url}/{item_type}/release-{item_id}"
+    title = f"Release {item_id}"
+    trackinfo = [
+        {
+            "id": item_id * 100 + i,
+            "track_num": i + 1,
+            "title": f"Track {i + 1}",
+            "duration": 180.5 + i,
+            "file": {"mp3-128": f"https://t4.bcbits.com/stream/{item_id}/{i}"},
+            "lyrics": "la " * 200,
+        }
+        for i in range(tracks)
+    ]
+    tralbum = {
+        "url": url,
+        "hasAudio": True,
+        "freeDownloadPage": f"{base_url}/download?id={item_id}" if free else None,
+        "is_purchased": False,
+        "item_type": item_type,
+        "id": item_id,
+        "current": {
+            "type": item_type,
+            "id": item_id,
+            "title": title,
+            "about": "About this release. " * 50,
+            "credits": "Credits. " * 30,
+        },
+        "trackinfo": trackinfo,
+    }
+    ld_json = {
+        "@type": "MusicAlbum",
+        "@id": url,
+        "name": title,
+        "keywords": ["electronic", "ambient", "bandcamp"],
+        "description": "About this release. " * 50,
+        "creditText": "Credits. " * 30,
+        "albumRelease": [
+            {
+                "@id": url,
+                "@type": "MusicRelease",
+                "offers": {"price": 0.0, "priceCurrency": "USD"},
+            },
+            {"@id": f"{url}#merch", "@type": "MusicRelease"},
+        ],
+        "track": {
+            "numberOfItems": tracks,
+            "itemListElement": [
+                {"position": t["track_num"], "item": {"name": t["title"]}}
+                for t in trackinfo
+            ],
+        },
+    }
+    return (
+        _head("album" if item_type == "album" else "song", url, title, ld_json)
+        + '<body>\n<div id="pgBd">\n'
+        + _filler(60)
+        + f'<script data-tralbum="{_attr(tralbum)}" '
+        f'data-band="{_attr({"id": 1, "name": "Artist"})}"></script>\n'
+        + _filler(60)
+        + "</div>\n</body>\n</html>\n"
+    )
+
+
+def label_page(base_url: str, releases: List[Dict], grid_items: int = None) -> str:
+    """`releases` are dicts with type, id and url. The first `grid_items`
+    of them are rendered as music-grid items, the rest go into the
+    data-client-items blob like Bandcamp does for long discographies."""
+    if grid_items is None:
+        grid_items = min(len(releases), 16)
+    lis = "".join(
+        f'<li data-item-id="{r["type"]}-{r["id"]}" data-band-id="1" '
+        f'class="music-grid-item square">\n'
+        f'<a href="{r["url"]}"><div class="art">'
+        f'<img src="https://f4.bcbits.com/img/a{r["id"]}_2.jpg" alt=""></div>'
+        f'<p class="title">Release {r["id"]}</p></a>\n</li>\n'
+        for r in releases[:grid_items]
+    )
+    client_items = [
+        {
+            "type": r["type"],
+            "id": r["id"],
+            "band_id": 1,
+            "page_url": r["url"],
+            "title": f"Release {r['id']}",
+            "artist": "Artist",
+            "art_id": r["id"],
+            "filtered": False,
+        }
+        for r in releases[grid_items:]
+    ]
+    band = {"id": 1, "name": "Label", "local_url": base_url}
+    return (
+        _head("band", base_url, "Label", None)
+        + "<body>\n"
+        + _filler(20)
+        + f'<script data-band="{_attr(band)}"></script>\n'
+        + '<ol id="music-grid" class="editable-grid music-grid" '
+        + f'data-client-items="{html.escape(_attr(client_items))}">\n'
+        + lis
+        + "</ol>\n"
+        + _filler(20)
+        + "</body>\n</html>\n"
+    )
+
+
+def download_page(
+    base_url: str, item_id: int, file_url: str, item_type: str = "album"
+) -> str:
+    blob = {
+        "download_type": "a" if item_type == "album" else "t",
+        "digital_items": [
+            {
+                "type": item_type,
+                "item_id": item_id,
+                "title": f"Release {item_id}",
+                "downloads": {
+                    fmt: {"url": f"{file_url}?enc={fmt}", "size_mb": "100MB"}
+                    for fmt in (
+                        "flac",
+                        "mp3-v0",
+                        "mp3-320",
+                        "aac-hi",
+                        "vorbis",
+                        "alac",
+                        "wav",
+                        "aiff-lossless",
+                    )
+                },
+            }
+        ],
+    }
+    return (
+        _head("website", f"{base_url}/download", "Download", None)
+        + "<body>\n"
+        + _filler(10)
+        + f'<div id="pagedata" data-blob="{_attr(blob)}"></div>\n'
+        + _filler(10)
+        + "</body>\n</html>\n"
+    )
+
+
+def write_fixtures(directory: str):
+    import os
+
+    base_url = "https://label.bandcamp.com"
+    releases = [
+        {"type": "album", "id": 1000 + i, "url": f"/album/release-{1000 + i}"}
+        for i in range(300)
+    ]
+    pages = {
+        "album.html": album_page(base_url, 1000),
+        "track.html": album_page(base_url, 2000, tracks=1, item_type="track"),
+        "label.html": label_page(base_url, releases),
+        "download.html": download_page(
+            base_url, 1000, "https://p4.bcbits.com/download/album/1000"
+        ),
+    }
+    for name, text in pages.items():
+        with open(os.path.join(directory, name), "w") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    import os
+
+    write_fixtures(os.path.join(os.path.dirname(__file__), "fixtures"))
@@ -0,0 +1,240 @@
+"""A local stand-in for Bandcamp to benchmark the downloader against.
+
+StandInServer serves a label page, its release pages, download pages and
+zip files built from the synthetic pages in pages.py, with a configurable
+latency per request and bandwidth per connection. Releases that aren't free
+ask for an email address like on Bandcamp; their download emails are
+delivered to the inboxes of LocalMailProvider after `mail_delay` seconds.
+"""
+
+import io
+import json
+import os
+import re
+import struct
+import threading
+import time
+import zipfile
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from free_bandcamp_downloader.mail import Inbox, MailMessage, MailProvider
+from pages import album_page, download_page, label_page
+
+
+def flac_file(size: int) -> bytes:
+    """A FLAC header with `size` bytes of noise as audio, enough for mutagen
+    to read and tag it"""
+    # 4096 sample blocks, 44.1kHz, 2 channels, 16 bits
+    info = struct.pack(">HH", 4096, 4096) + b"\0" * 6
+    info += ((44100 << 44) | (1 << 41) | (15 << 36)).to_bytes(8, "big")
+    info += b"\0" * 16
+    # last metadata block, STREAMINFO
+    header = b"fLaC" + bytes([0x80]) + len(info).to_bytes(3, "big") + info
+    return header + os.urandom(size)
+
+
+def album_zip(tracks: int, track_size: int) -> bytes:
+    f = io.BytesIO()
+    # audio doesn't compress, store it like Bandcamp does
+    with zipfile.ZipFile(f, "w", zipfile.ZIP_STORED) as z:
+        track = flac_file(track_size)
+        for i in range(tracks):
+            z.writestr(f"Artist - Release - {i + 1:02d} Track {i + 1}.flac", track)
+        z.writestr("cover.jpg", os.urandom(64 * 1024))
+    return f.getvalue()
+
+
+class StandInServer:
+    """Serves `releases` releases of `tracks` tracks of `track_size` bytes
+    on a free port of localhost. Every `email_every`-th release requires an
+    email address, 0 means all are free. `latency` seconds are added to
+    every request and file bodies are sent at `bandwidth` bytes per second
+    per connection, None for as fast as possible."""
+
+    def __init__(
+        self,
+        releases: int = 20,
+        tracks: int = 4,
+        track_size: int = 1024**2,
+        email_every: int = 0,
+        latency: float = 0.0,
+        bandwidth: Optional[float] = None,
+        mail_delay: float = 0.5,
+    ):
+        self.releases = releases
+        self.email_every = email_every
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.mail_delay = mail_delay
+        # every release gets the same file, only its name differs
+        self.zip = album_zip(tracks, track_size)
+        self.bytes_sent = 0
+        self.requests = 0
+        # address -> delivery time, message and body of its emails
+        self.outbox: Dict[str, List[Tuple[float, MailMessage, str]]] = {}
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._httpd.server_address[1]}"
+
+    @property
+    def label_url(self) -> str:
+        return f"{self.base_url}/music"
+
+    def release_ids(self) -> List[int]:
+        return [1000 + i for i in range(self.releases)]
+
+    def release_url(self, id: int) -> str:
+        return f"{self.base_url}/album/release-{id}"
+
+    def is_free(self, id: int) -> bool:
+        return not self.email_every or (id - 1000) % self.email_every != 0
+
+    def start(self) -> "StandInServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _send_email(self, address: str, id: int):
+        message = MailMessage(
+            str(id), "noreply@bandcamp.com", f"Your download of Release {id}"
+        )
+        body = f'<a href="{self.base_url}/download?id={id}">Download</a>'
+        with self._lock:
+            self.outbox.setdefault(address, []).append(
+                (time.monotonic() + self.mail_delay, message, body)
+            )
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(
+                self,
+                body: bytes,
+                content_type: str = "text/html; charset=utf-8",
+                headers: Optional[Dict[str, str]] = None,
+                throttle: bool = False,
+            ):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                if not throttle or not server.bandwidth:
+                    self.wfile.write(body)
+                else:
+                    chunk = 64 * 1024
+                    start = time.monotonic()
+                    for offset in range(0, len(body), chunk):
+                        self.wfile.write(body[offset : offset + chunk])
+                        ahead = offset / server.bandwidth - (time.monotonic() - start)
+                        if ahead > 0:
+                            time.sleep(ahead)
+                with server._lock:
+                    server.bytes_sent += len(body)
+
+            def _begin(self):
+                with server._lock:
+                    server.requests += 1
+                if server.latency:
+                    time.sleep(server.latency)
+
+            def do_GET(self):
+                self._begin()
+                url = urlsplit(self.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                base = server.base_url
+                if url.path == "/music":
+                    releases = [
+                        {"type": "album", "id": id, "url": f"/album/release-{id}"}
+                        for id in server.release_ids()
+                    ]
+                    return self._send(label_page(base, releases).encode())
+                m = re.fullmatch(r"/album/release-(\d+)", url.path)
+                if m:
+                    id = int(m.group(1))
+                    page = album_page(base, id, free=server.is_free(id))
+                    return self._send(page.encode())
+                if url.path == "/download":
+                    id = int(query["id"])
+                    page = download_page(base, id, f"{base}/files/{id}")
+                    return self._send(page.encode())
+                m = re.fullmatch(r"/files/(\d+)", url.path)
+                if m:
+                    name = f"Artist - Release {m.group(1)}.zip"
+                    return self._send(
+                        server.zip,
+                        "application/zip",
+                        {"Content-Disposition": f'attachment; filename="{name}"'},
+                        throttle=True,
+                    )
+                self.send_error(404)
+
+            def do_POST(self):
+                self._begin()
+                length = int(self.headers.get("Content-Length") or 0)
+                form = {
+                    k: v[0]
+                    for k, v in parse_qs(self.rfile.read(length).decode()).items()
+                }
+                if self.path == "/email_download":
+                    server._send_email(form["address"], int(form["item_id"]))
+                    return self._send(
+                        json.dumps({"ok": True}).encode(), "application/json"
+                    )
+                self.send_error(404)
+
+        return Handler
+
+
+class LocalInbox(Inbox):
+    def __init__(self, server: StandInServer, address: str):
+        self.server = server
+        self.address = address
+
+    def _delivered(self) -> List[Tuple[float, MailMessage, str]]:
+        now = time.monotonic()
+        with self.server._lock:
+            return [m for m in self.server.outbox.get(self.address, []) if m[0] <= now]
+
+    def list_messages(self) -> List[MailMessage]:
+        return [message for _, message, _ in self._delivered()]
+
+    def get_body(self, id: str) -> str:
+        return next(body for _, message, body in self._delivered() if message.id == id)
+
+
+class LocalMailProvider(MailProvider):
+    """Inboxes that receive the emails of a StandInServer"""
+
+    def __init__(self, server: StandInServer):
+        self.server = server
+        self._count = 0
+
+    def new_inbox(self) -> LocalInbox:
+        self._count += 1
+        return LocalInbox(self.server, f"bench{self._count}@localhost")
@@ -1,8 +1,14 @@
-import importlib.metadata
 import logging
 import os
 
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
 logger = logging.getLogger(__name__)
 
-__version__ = importlib.metadata.version("free-bandcamp-downloader")
+
+# looking up the installed version is slow, only do it when asked for
+def __getattr__(name: str):
+    if name == "__version__":
+        import importlib.metadata
+
+        return importlib.metadata.version("free-bandcamp-downloader")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
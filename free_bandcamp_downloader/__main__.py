@@ -5,14 +5,24 @@ Usage:
         [-c <country>] [-f <format>]
     bcdl-free defaults
     bcdl-free clear
-    bcdl-free [--debug] [--force] [--no-unzip] [-al]
+    bcdl-free [--debug] [--force] [--no-unzip] [-al] [-j <n>]
         [-d <dir>] [-e <email>] [-z <zipcode>] [-c <country>] [-f <format>]
-        [--cookies <file>] [--identity <value>] URL...
+        [--cookies <file>] [--identity <value>] [--parser <name>] URL...
     bcdl-free -h | --help | --version
-    bcdl-free [--debug] [--force] [--no-unzip] [-al]
+    bcdl-free [--debug] [--force] [--no-unzip] [-al] [-j <n>]
         [-d <dir>] [-e <email>] [-z <zipcode>] [-c <country>] [-f <format>]
         [--cookies <file>] [--identity <value>] [--download-history-file <file>]
-        URL...
+        [--parser <name>] [--http-cache <dir>] [--http-cache-ttl <seconds>]
+        [--http-cache-size <mb>] [--segments <n>] [--segment-threshold <mb>]
+        [--chunk-size <kb>] [--no-preallocate] [--digest <name>] [--stream-unzip]
+        [--tag-jobs <n>] [--tag-processes] [--inboxes <n>]
+        [--mail-api <url>] [--rate-limit <n>] [--cdn-rate-limit <n>]
+        [--pool-hosts <n>] [--pool-size <n>] [--sync-collection]
+        [--collection-cache <dir>] [--collection-cache-ttl <seconds>]
+        [--metrics-file <file>] [--prometheus-file <file>] [--watch]
+        [--watch-min-interval <hours>] [--watch-max-interval <hours>]
+        [--queue-lease <seconds>]
+        (--queue <file> [--input <file>] [URL...] | --input <file> [URL...] | URL...)
 
 Arguments:
     URL            URL to download. Can be a link to a label or release page
@@ -27,16 +37,46 @@ Options:
     --version                            Show version
     --force                              Download even if album has been downloaded before
     --no-unzip                           Don't unzip downloaded albums
+    --stream-unzip                       Unzip and tag albums while they download instead of saving the zip first
     --debug                              Set loglevel to debug
     -a -l                                Dummy options, for backwards compatibility
     -d <dir> --dir <dir>                 Set download directory
     -c <country> --country <country>     Set country
     -z <zipcode> --zipcode <zipcode>     Set zipcode
     -e <email> --email <email>           Set email (set to 'auto' to automatically download from a disposable email)
+    --inboxes <n>                        Number of disposable inboxes to spread email releases over with email 'auto'
+    --mail-api <url>                     Base URL of the Guerrilla Mail API for email 'auto'
     -f <format> --format <format>        Set format
     --cookies <file>                     Path to cookies.txt file so albums in your collection can be downloaded
     --identity <value>                   Value of identity cookie so albums in your collection can be downloaded
+    --sync-collection                    Find albums in your collection with one index of the whole collection instead of a search per album
+    --collection-cache <dir>             Keep collection indexes in this directory between runs
+    --collection-cache-ttl <seconds>     Reuse a collection index for this many seconds
     --download-history-file <file>       Path to history file containing downloaded albums
+    -j <n> --jobs <n>                    Number of releases to fetch, download and tag concurrently
+    --tag-jobs <n>                       Number of files to tag concurrently
+    --tag-processes                      Tag files in worker processes instead of threads
+    --parser <name>                      Page parser, 'fast' (default) or 'soup' (BeautifulSoup)
+    --http-cache <dir>                   Cache release and label pages in this directory between runs
+    --http-cache-ttl <seconds>           Serve cached pages without revalidating for this many seconds
+    --http-cache-size <mb>               Maximum size of the page cache in MiB
+    --rate-limit <n>                     Initial page requests per second per host, adapted to 429/5xx responses
+    --cdn-rate-limit <n>                 Initial file download requests per second per host
+    --pool-hosts <n>                     Number of hosts to keep connections open to
+    --pool-size <n>                      Number of connections to keep open per host (default: sized to the jobs)
+    --segments <n>                       Number of connections to download large files over
+    --segment-threshold <mb>             Only download files of at least this many MiB over several connections
+    --chunk-size <kb>                    Read downloads in chunks of this many KiB (default: adapted to the connection)
+    --no-preallocate                     Don't reserve the full size of a file on disk before downloading it
+    --digest <name>                      Hash downloads with this hashlib algorithm (e.g. sha256) and record the digest in the history
+    --watch                              Only download releases of label pages that weren't there on earlier runs, and skip labels that aren't due for a check
+    --watch-min-interval <hours>         Check a watched label at most this often
+    --watch-max-interval <hours>         Check a watched label at least this often
+    --input <file>                       Read URLs from this file, one per line ('-' for stdin)
+    --queue <file>                       Keep the progress of the run in this file, so running it again resumes it
+    --queue-lease <seconds>              Let other workers on the same queue take over jobs that weren't renewed for this long
+    --metrics-file <file>                Write counts, latencies and bytes of every stage of the run to this JSON file
+    --prometheus-file <file>             Write the same metrics in the Prometheus text format, e.g. for node_exporter
 
 Formats:
     - FLAC
@@ -50,23 +90,35 @@ Formats:
 """
 
 import dataclasses
+import hashlib
+import itertools
 import logging
 import sys
 import os
 import pprint
-from typing import List, Set
+import time
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Set
 from docopt import docopt
 from configparser import ConfigParser
 
-from free_bandcamp_downloader import __version__
-from free_bandcamp_downloader.bc_free_downloader import (
-    AlbumInfo,
-    BCFreeDownloader,
-    BCFreeDownloaderOptions,
-    TralbumId,
-)
+from free_bandcamp_downloader.metrics import stage_metrics
+from free_bandcamp_downloader.options import FORMATS, BCFreeDownloaderOptions
 from free_bandcamp_downloader import logger
 
+# the downloader and its dependencies are only imported once there is
+# something to download, so setdefault/defaults/clear and runs where every
+# url is in the history start quickly
+if TYPE_CHECKING:
+    from free_bandcamp_downloader.bc_free_downloader import (
+        AlbumInfo,
+        BCFreeDownloader,
+        TralbumId,
+    )
+    from free_bandcamp_downloader.history import DownloadHistory
+    from free_bandcamp_downloader.jobqueue import JobQueue
+    from free_bandcamp_downloader.tagging import Tagger
+    from free_bandcamp_downloader.watch import LabelCrawl, LabelWatch
+
 
 class Config:
     def __init__(self):
@@ -79,9 +131,40 @@ class Config:
             self.parser["free-bandcamp-downloader"][field.name] = field.default
         self.parser["free-bandcamp-downloader"]["force"] = "false"
         self.parser["free-bandcamp-downloader"]["no-unzip"] = "false"
+        self.parser["free-bandcamp-downloader"]["stream-unzip"] = "false"
+        self.parser["free-bandcamp-downloader"]["jobs"] = "1"
+        self.parser["free-bandcamp-downloader"]["tag-jobs"] = "1"
+        self.parser["free-bandcamp-downloader"]["tag-processes"] = "false"
+        self.parser["free-bandcamp-downloader"]["inboxes"] = "1"
+        self.parser["free-bandcamp-downloader"]["mail-api"] = None
+        self.parser["free-bandcamp-downloader"]["http-cache"] = None
+        self.parser["free-bandcamp-downloader"]["http-cache-ttl"] = "3600"
+        self.parser["free-bandcamp-downloader"]["http-cache-size"] = "256"
+        self.parser["free-bandcamp-downloader"]["rate-limit"] = "10"
+        self.parser["free-bandcamp-downloader"]["cdn-rate-limit"] = "20"
+        self.parser["free-bandcamp-downloader"]["pool-hosts"] = "100"
+        # sized to the number of concurrent requests if not set
+        self.parser["free-bandcamp-downloader"]["pool-size"] = None
+        self.parser["free-bandcamp-downloader"]["segments"] = "1"
+        self.parser["free-bandcamp-downloader"]["segment-threshold"] = "64"
+        # adapted to the speed of the connection if not set
+        self.parser["free-bandcamp-downloader"]["chunk-size"] = None
+        self.parser["free-bandcamp-downloader"]["no-preallocate"] = "false"
+        self.parser["free-bandcamp-downloader"]["digest"] = None
         self.parser["free-bandcamp-downloader"]["download-history-file"] = (
             get_data_dir() + "/downloaded.txt"
         )
+        self.parser["free-bandcamp-downloader"]["sync-collection"] = "false"
+        self.parser["free-bandcamp-downloader"]["collection-cache"] = (
+            get_data_dir() + "/collections"
+        )
+        self.parser["free-bandcamp-downloader"]["collection-cache-ttl"] = "86400"
+        self.parser["free-bandcamp-downloader"]["watch"] = "false"
+        self.parser["free-bandcamp-downloader"]["watch-min-interval"] = "6"
+        self.parser["free-bandcamp-downloader"]["watch-max-interval"] = "168"
+        self.parser["free-bandcamp-downloader"]["queue-lease"] = "300"
+        self.parser["free-bandcamp-downloader"]["metrics-file"] = None
+        self.parser["free-bandcamp-downloader"]["prometheus-file"] = None
 
         # read config file
         self.config_path = os.path.join(config_dir, "free-bandcamp-downloader.cfg")
@@ -142,40 +225,53 @@ def get_data_dir() -> str:
     return data_dir
 
 
-def is_downloaded(downloaded_set, id: TralbumId, url: str = None) -> bool:
-    return id in downloaded_set or url in downloaded_set
+def is_downloaded(history: "DownloadHistory", id: "TralbumId", url: str = None) -> bool:
+    return history.is_downloaded(id, url)
 
 
-def add_to_dl_file(config: Config, id: TralbumId):
-    history_file = config.parser["free-bandcamp-downloader"]["download-history-file"]
-    with open(history_file, "a") as f:
-        f.write(f"{id[0][0]}:{id[1]}\n")
+def add_to_history(
+    history: "DownloadHistory", id: "TralbumId", url: str = None, digest: str = None
+):
+    history.add(id, url, digest)
 
 
-def get_downloaded(config: Config) -> Set[TralbumId]:
+# drop urls of releases in the history before their pages are fetched
+def skip_downloaded_urls(history: "DownloadHistory", urls: List[str]) -> List[str]:
+    remaining = []
+    for url in urls:
+        if history.find_url(url) is not None:
+            logger.error(f"{url} already downloaded. To download anyways, use --force.")
+        else:
+            remaining.append(url)
+    return remaining
+
+
+def get_downloaded(config: Config) -> "DownloadHistory":
+    from free_bandcamp_downloader.history import DownloadHistory
+
     history_file = config.parser["free-bandcamp-downloader"]["download-history-file"]
-    if not os.path.exists(history_file):
-        with open(history_file, "w") as f:
-            pass
+    return DownloadHistory.open(history_file)
+
+
+# input urls of a queued run are added this many at a time
+QUEUE_BATCH = 256
+# and claimed this many per job at a time, few enough that other workers on
+# the queue get a share of a short batch
+QUEUE_CLAIM_PER_JOB = 8
+
+
+def tag_files(files: List[str], head_data: Dict, tagger: "Tagger"):
+    logger.info("Setting tags...")
+    for result in tagger.tag_files(files, head_data):
+        if result.error:
+            logger.error(f"Could not tag {result.file_name}: {result.error}")
+
+
+def post_download(album_info: "AlbumInfo", config: Config, tagger: "Tagger"):
+    if album_info.get("files") is not None:
+        # unzipped and tagged while downloading
+        return
 
-    downloaded = set()
-    with open(history_file, "r") as f:
-        for line in f:
-            type = line.strip()[:2]
-            if type == "a:":
-                type = "album"
-                data = int(line[2:])
-            elif type == "t:":
-                type = "track"
-                data = int(line[2:])
-            else:
-                type = "url"
-                data = line.strip()
-            downloaded.add((type, data))
-    return downloaded
-
-
-def post_download(album_info: AlbumInfo, config: Config):
     file_name = album_info["file_name"]
     # file list for setting tags
     files = [file_name]
@@ -183,25 +279,356 @@ def post_download(album_info: AlbumInfo, config: Config):
 
     # unzip if needed
     if unzip and file_name.endswith(".zip"):
+        from free_bandcamp_downloader.bc_free_downloader import BCFreeDownloader
+
         files = BCFreeDownloader.unzip_album(file_name)
 
-    logger.info("Setting tags...")
-    for file in files:
-        BCFreeDownloader.tag_file(file, album_info["head_data"])
+    tag_files(files, album_info["head_data"], tagger)
+
+
+# post-process a release that an earlier queued run downloaded, see
+# JobQueue.set_state for what is kept of it
+def resume_post_download(album_info: Dict, config: Config, tagger: "Tagger"):
+    file_name = album_info["file_name"]
+    dir_name = file_name[:-4]
+    if (
+        album_info["files"] is None
+        and file_name.endswith(".zip")
+        and not os.path.exists(file_name)
+        and os.path.isdir(dir_name)
+    ):
+        # unzipped before the run stopped, the tags may be missing
+        files = [
+            os.path.join(root, name)
+            for root, _, names in os.walk(dir_name)
+            for name in names
+        ]
+        tag_files(sorted(files), album_info["head_data"], tagger)
+    else:
+        post_download(album_info, config, tagger)
+
+
+def downloader_from_config(config: Config) -> "BCFreeDownloader":
+    from free_bandcamp_downloader.bc_free_downloader import BCFreeDownloader
+    from free_bandcamp_downloader.collection import CollectionSync
+    from free_bandcamp_downloader.http_cache import HTTPCache
+    from free_bandcamp_downloader.mail import GuerrillaMailProvider
+    from free_bandcamp_downloader.rate_limit import RateLimiter
+    from free_bandcamp_downloader.transfer import TransferOptions
+
+    http_cache = None
+    cache_dir = config.get("http-cache")
+    if cache_dir:
+        http_cache = HTTPCache(
+            cache_dir,
+            ttl=float(config.get("http-cache-ttl")),
+            max_size=int(float(config.get("http-cache-size")) * 1024**2),
+        )
+    pool_size = config.get("pool-size")
+    if pool_size:
+        pool_maxsize = int(pool_size)
+    else:
+        jobs = config.parser.getint("free-bandcamp-downloader", "jobs")
+        segments = max(int(config.get("segments")), 1)
+        pool_maxsize = max(10, jobs * segments + BCFreeDownloader.EMAIL_WORKERS)
+    collection_sync = None
+    if config.parser.getboolean("free-bandcamp-downloader", "sync-collection"):
+        collection_sync = CollectionSync(
+            config.get("collection-cache"),
+            ttl=float(config.get("collection-cache-ttl")),
+        )
+    transfer_options = TransferOptions(
+        segments=int(config.get("segments")),
+        segment_threshold=int(float(config.get("segment-threshold")) * 1024**2),
+        chunk_size=(
+            int(float(config.get("chunk-size")) * 1024)
+            if config.get("chunk-size")
+            else None
+        ),
+        preallocate=not config.parser.getboolean(
+            "free-bandcamp-downloader", "no-preallocate"
+        ),
+        digest=config.get("digest"),
+        stream_unzip=(
+            config.parser.getboolean("free-bandcamp-downloader", "stream-unzip")
+            and not config.parser.getboolean("free-bandcamp-downloader", "no-unzip")
+        ),
+    )
+    return BCFreeDownloader(
+        options_from_config(config),
+        http_cache=http_cache,
+        transfer_options=transfer_options,
+        mail_provider=GuerrillaMailProvider(config.get("mail-api")),
+        inboxes=int(config.get("inboxes")),
+        rate_limiter=RateLimiter(
+            rate=float(config.get("rate-limit")),
+            cdn_rate=float(config.get("cdn-rate-limit")),
+        ),
+        pool_connections=int(config.get("pool-hosts")),
+        pool_maxsize=pool_maxsize,
+        collection_sync=collection_sync,
+    )
+
+
+def tagger_from_config(config: Config) -> "Tagger":
+    from free_bandcamp_downloader.tagging import Tagger
+
+    return Tagger(
+        jobs=config.parser.getint("free-bandcamp-downloader", "tag-jobs"),
+        processes=config.parser.getboolean("free-bandcamp-downloader", "tag-processes"),
+    )
+
+
+def watch_from_config(
+    config: Config, downloaded: "DownloadHistory"
+) -> Optional["LabelWatch"]:
+    if not config.parser.getboolean("free-bandcamp-downloader", "watch"):
+        return None
+    from free_bandcamp_downloader.watch import LabelWatch
+
+    return LabelWatch(
+        downloaded,
+        min_interval=float(config.get("watch-min-interval")) * 3600,
+        max_interval=float(config.get("watch-max-interval")) * 3600,
+    )
+
+
+# log statistics of the run and write its metrics
+def report_run(downloader: "BCFreeDownloader", config: Config):
+    logger.info(f"Requests: {downloader.rate_limiter.stats}")
+    logger.info(f"Connections: {downloader.adapter.stats}")
+    if downloader.http_cache is not None:
+        logger.info(f"HTTP cache: {downloader.http_cache.stats}")
+    for name, stage in stage_metrics.stages.items():
+        logger.info(f"Stage {name}: {stage}")
+    if config.get("metrics-file"):
+        stage_metrics.write_json(config.get("metrics-file"))
+    if config.get("prometheus-file"):
+        stage_metrics.write_prometheus(config.get("prometheus-file"))
+
+
+def download_urls_pipelined(
+    downloader: "BCFreeDownloader",
+    downloaded: "DownloadHistory",
+    tagger: "Tagger",
+    urls: Iterable[str],
+    config: Config,
+    jobs: int,
+    watch: Optional["LabelWatch"] = None,
+    queue: Optional["JobQueue"] = None,
+    backlog: Optional[int] = None,
+):
+    from free_bandcamp_downloader.pipeline import DownloadPipeline
 
+    force = config.parser.getboolean("free-bandcamp-downloader", "force")
+
+    def should_download(id: "TralbumId", url: str) -> bool:
+        if not force and is_downloaded(downloaded, id, url):
+            logger.error(f"{url} already downloaded. To download anyways, use --force.")
+            return False
+        # other workers on the same queue may have found it under another url
+        if queue is not None and not queue.claim_release(id):
+            logger.info(f"{url} is being downloaded by another worker")
+            return False
+        return True
+
+    # called in input order, so the history file stays deterministic, except
+    # in queued runs, see on_state
+    def on_downloaded(album_info: "AlbumInfo"):
+        current = album_info["tralbum_data"]["current"]
+        id = (current["type"], current["id"])
+        add_to_history(
+            downloaded, id, album_info["tralbum_data"]["url"], album_info.get("digest")
+        )
+
+    crawls: Dict[str, "LabelCrawl"] = {}
+
+    # only releases that weren't on the label page last time and that
+    # aren't done in the queue
+    def label_releases(url: str, releases):
+        if watch is not None:
+            crawls[url] = watch.crawl(url)
+            releases = crawls[url].filter(releases)
+        if queue is not None:
+            releases = queue.filter_releases(url, releases)
+        return releases
+
+    def on_state(url: str, state: str, album_info: Optional["AlbumInfo"] = None):
+        if album_info is not None:
+            # in the history before the job moves on instead of in input
+            # order, which can be held up by the downloads before it
+            on_downloaded(album_info)
+            downloaded.commit()
+        queue.set_state(url, state, album_info)
+
+    pipeline = DownloadPipeline(
+        downloader,
+        jobs,
+        should_download=should_download,
+        on_downloaded=on_downloaded if queue is None else None,
+        post_process=lambda album_info: post_download(album_info, config, tagger),
+        label_releases=(
+            label_releases if watch is not None or queue is not None else None
+        ),
+        on_state=on_state if queue is not None else None,
+        on_released=queue.finish_release if queue is not None else None,
+        keep_results=queue is None,
+    )
+    pipeline.run(urls, backlog=backlog)
+    unfinished = pipeline.unfinished()
+    for crawl in crawls.values():
+        crawl.finish(unfinished)
+
+
+# `downloader` defaults to one built from the config
+def download_urls(
+    urls: List[str], config: Config, downloader: Optional["BCFreeDownloader"] = None
+):
+    downloaded = get_downloaded(config)
+    if not config.parser.getboolean("free-bandcamp-downloader", "force"):
+        urls = skip_downloaded_urls(downloaded, urls)
+    watch = watch_from_config(config, downloaded)
+    if watch is not None:
+        urls = watch.due(urls)
+    if not urls:
+        downloaded.close()
+        return
+    owned = downloader is None
+    if owned:
+        downloader = downloader_from_config(config)
+    tagger = tagger_from_config(config)
+    jobs = config.parser.getint("free-bandcamp-downloader", "jobs")
+    try:
+        if jobs > 1:
+            download_urls_pipelined(
+                downloader, downloaded, tagger, urls, config, jobs, watch
+            )
+        else:
+            download_urls_sequential(
+                downloader, downloaded, tagger, urls, config, watch
+            )
+    finally:
+        tagger.close()
+        downloaded.close()
+        report_run(downloader, config)
+        if owned:
+            downloader.close()
+
+
+# `urls` are read as they are needed, so they can come from a file or stdin
+# of any size, and the progress of the run is kept in `queue`
+def download_queue(
+    urls: Iterable[str],
+    queue: "JobQueue",
+    config: Config,
+    downloader: Optional["BCFreeDownloader"] = None,
+):
+    from free_bandcamp_downloader import jobqueue
 
-def download_urls(urls: List[str], config: Config):
-    downloader = BCFreeDownloader(options_from_config(config))
     downloaded = get_downloaded(config)
     force = config.parser.getboolean("free-bandcamp-downloader", "force")
+    jobs = config.parser.getint("free-bandcamp-downloader", "jobs")
+    watch = watch_from_config(config, downloaded)
+    claim_size = min(QUEUE_BATCH, QUEUE_CLAIM_PER_JOB * jobs)
+    # built when the first job is claimed, closed at the end
+    owned = downloader is None
+    tagger = None
+    urls = iter(urls)
+    more = True
+
+    # claims the next batch once the pipeline has taken the last one, so one
+    # pipeline runs the whole queue and its download emails overlap with the
+    # following batches instead of holding each batch up
+    def claimed_urls() -> Iterator[str]:
+        nonlocal more, tagger
+        while True:
+            # jobs of workers that died, also this one in an earlier run
+            for url, album_info in queue.reclaim():
+                tagger = tagger or tagger_from_config(config)
+                id = tuple(album_info["id"])
+                if not is_downloaded(downloaded, id, album_info["url"]):
+                    add_to_history(
+                        downloaded, id, album_info["url"], album_info["digest"]
+                    )
+                resume_post_download(album_info, config, tagger)
+                queue.set_state(url, jobqueue.DONE)
+
+            batch_urls = queue.claim(claim_size)
+            while more and len(batch_urls) < claim_size:
+                chunk = list(itertools.islice(urls, QUEUE_BATCH))
+                more = len(chunk) == QUEUE_BATCH
+                queue.add(chunk)
+                batch_urls += queue.claim(claim_size - len(batch_urls))
+            if not batch_urls:
+                if not queue.in_flight_elsewhere():
+                    return
+                # take over the jobs of other workers if they die
+                time.sleep(min(queue.lease / 3, 1))
+                continue
+            remaining = batch_urls
+            if not force:
+                remaining = skip_downloaded_urls(downloaded, remaining)
+            if watch is not None:
+                remaining = watch.due(remaining)
+            for url in set(batch_urls) - set(remaining):
+                queue.set_state(url, jobqueue.DONE)
+            yield from remaining
+
+    try:
+        queue.retry_failed()
+        claimed = claimed_urls()
+        first = next(claimed, None)
+        if first is not None:
+            if downloader is None:
+                downloader = downloader_from_config(config)
+            tagger = tagger or tagger_from_config(config)
+            # the pipeline reports the state of every job, also with one job
+            download_urls_pipelined(
+                downloader,
+                downloaded,
+                tagger,
+                itertools.chain([first], claimed),
+                config,
+                jobs,
+                watch,
+                queue,
+                backlog=claim_size,
+            )
+        counts = queue.counts()
+        logger.info(
+            "Queue: "
+            + ", ".join(f"{counts[state]} {state}" for state in sorted(counts))
+        )
+    finally:
+        if tagger is not None:
+            tagger.close()
+        downloaded.close()
+        if downloader is not None:
+            report_run(downloader, config)
+            if owned:
+                downloader.close()
+
+
+def download_urls_sequential(
+    downloader: "BCFreeDownloader",
+    downloaded: "DownloadHistory",
+    tagger: "Tagger",
+    urls: List[str],
+    config: Config,
+    watch: Optional["LabelWatch"] = None,
+):
+    from free_bandcamp_downloader.bc_free_downloader import BCFreeDownloadError
 
-    for url in urls:
-        soup = downloader.get_url_soup(url)
-        url_info = downloader.get_page_info(soup)
+    force = config.parser.getboolean("free-bandcamp-downloader", "force")
+    crawls: List["LabelCrawl"] = []
+    # label releases waiting for their download email
+    queued: Set["TralbumId"] = set()
 
-        urltype = url_info and url_info.get("type")
+    for url in urls:
+        page = downloader.get_url_page(url)
+        urltype = page.og_type
         if urltype == "album" or urltype == "song":
-            tralbum = url_info["info"]["tralbum_data"]
+            tralbum = downloader.get_album_info(page)["tralbum_data"]
             type = tralbum["current"]["type"]
             id = tralbum["current"]["id"]
             url = tralbum["url"]
@@ -210,13 +637,17 @@ def download_urls(urls: List[str], config: Config):
                     f"{url} already downloaded. To download anyways, use --force."
                 )
                 continue
-            ret = downloader.download_album(soup)
+            ret = downloader.download_album(page)
             if ret["is_downloaded"]:
-                add_to_dl_file(config, (type, id))
-                downloaded.add((type, id))
-                post_download(ret, config)
+                add_to_history(downloaded, (type, id), url, ret.get("digest"))
+                post_download(ret, config, tagger)
         elif urltype == "band":
-            for rel in url_info["info"]["releases"]:
+            # releases are downloaded as the label page is parsed
+            releases = downloader.iter_label_releases(page)
+            if watch is not None:
+                crawls.append(watch.crawl(url))
+                releases = crawls[-1].filter(releases)
+            for rel in releases:
                 type = rel["type"]
                 id = rel["id"]
                 url = rel["url"]
@@ -225,46 +656,63 @@ def download_urls(urls: List[str], config: Config):
                         f"{url} already downloaded. To download anyways, use --force."
                     )
                     continue
-                soup = downloader.get_url_soup(url)
-                ret = downloader.download_album(soup)
+                page = downloader.get_url_page(url)
+                ret = downloader.download_album(page)
                 if ret["is_downloaded"]:
-                    add_to_dl_file(config, (type, id))
-                    downloaded.add((type, id))
-                    post_download(ret, config)
+                    add_to_history(downloaded, (type, id), url, ret.get("digest"))
+                    post_download(ret, config, tagger)
+                elif ret["email_queued"]:
+                    queued.add((type, id))
         else:
-            continue
+            # only bandcamp pages are supported
+            raise BCFreeDownloadError("Page does not have a valid og:type value")
 
     # finish up downloading
     ret = downloader.flush_email_downloads()
     for album_info in ret:
         type = album_info["tralbum_data"]["current"]["type"]
         id = album_info["tralbum_data"]["current"]["id"]
-        add_to_dl_file(config, (type, id))
-        downloaded.add((type, id))
-        post_download(album_info, config)
+        url = album_info["tralbum_data"]["url"]
+        add_to_history(downloaded, (type, id), url, album_info.get("digest"))
+        post_download(album_info, config, tagger)
+        queued.discard((type, id))
+    for crawl in crawls:
+        crawl.finish(queued)
 
 
 def main():
     config = Config()
-    arguments = docopt(__doc__, version=__version__)
+    arguments = docopt(__doc__)
+
+    if arguments["--version"]:
+        from free_bandcamp_downloader import __version__
+
+        print(__version__)
+        sys.exit(0)
 
     if arguments["--debug"]:
         logger.setLevel(logging.DEBUG)
 
     # set config if needed
-    if arguments["URL"] or arguments["setdefault"]:
+    if (
+        arguments["URL"]
+        or arguments["--input"]
+        or arguments["--queue"]
+        or arguments["setdefault"]
+    ):
         for option in config.parser["free-bandcamp-downloader"].keys():
             arg = f"--{option}"
             if arguments.get(arg):
                 config.set(option, arguments[arg])
-        if (
-            config.parser["free-bandcamp-downloader"]["format"]
-            not in BCFreeDownloader.FORMATS
-        ):
+        if config.parser["free-bandcamp-downloader"]["format"] not in FORMATS:
             logger.error(
                 f'{config.parser.get("format")} is not a valid format. See "bcdl-free -h" for valid formats'
             )
             sys.exit(1)
+        digest = config.get("digest")
+        if digest and digest not in hashlib.algorithms_available:
+            logger.error(f"{digest} is not a hash algorithm of hashlib")
+            sys.exit(1)
 
     # write to config file
     if arguments["setdefault"]:
@@ -280,7 +728,17 @@ def main():
         print(str(config))
         sys.exit(0)
 
-    if arguments["URL"]:
+    if arguments["--input"] or arguments["--queue"]:
+        from free_bandcamp_downloader.jobqueue import JobQueue, read_urls
+
+        urls = arguments["URL"]
+        if arguments["--input"]:
+            urls = itertools.chain(urls, read_urls(arguments["--input"]))
+        with JobQueue(
+            arguments["--queue"], lease=float(config.get("queue-lease"))
+        ) as queue:
+            download_queue(urls, queue, config)
+    elif arguments["URL"]:
         download_urls(arguments["URL"], config)
 
 
@@ -0,0 +1,382 @@
+import asyncio
+import os
+import pyrfc6266
+
+from bs4 import BeautifulSoup
+from http.cookiejar import MozillaCookieJar
+from tqdm import tqdm
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+from urllib.parse import urljoin
+
+from free_bandcamp_downloader import logger
+from free_bandcamp_downloader.extract import BandcampPage, make_extractor
+from free_bandcamp_downloader.rate_limit import may_retry
+from free_bandcamp_downloader.bc_free_downloader import (
+    AlbumInfo,
+    BCFreeDownloader,
+    BCFreeDownloaderOptions,
+    BCFreeDownloadError,
+    DownloadRet,
+    LabelInfo,
+    Page,
+    PageInfo,
+    ResolvedDownload,
+    TralbumId,
+)
+
+try:
+    import aiohttp
+    from yarl import URL
+except ImportError:
+    aiohttp = None
+
+
+class AsyncBCFreeDownloader:
+    """asyncio counterpart of BCFreeDownloader, built on aiohttp.
+
+    Page requests and file transfers are bounded by separate semaphores, so
+    many releases can be resolved concurrently in one event loop while only a
+    few files are transferred at a time. Use as an async context manager or
+    call `close()` when done.
+    """
+
+    RETRY_STATUSES = {413, 429, 500, 502, 503, 504}
+    RETRIES = 10
+    BACKOFF_FACTOR = 10
+    BACKOFF_MAX = 60
+    # no limit on the whole request, large zips take longer than aiohttp's
+    # default of 5 minutes, only on connecting and on each read
+    CONNECT_TIMEOUT = 30
+    READ_TIMEOUT = 60
+
+    def __init__(
+        self,
+        options: BCFreeDownloaderOptions,
+        concurrency: int = 32,
+        transfer_concurrency: int = 4,
+    ):
+        if aiohttp is None:
+            raise ImportError(
+                "AsyncBCFreeDownloader requires aiohttp, "
+                "install free-bandcamp-downloader[async]"
+            )
+        self.options = options
+        self.mail_session = None
+        # set by _init_email, which only starts a mail session for email 'auto'
+        self._email_initialized = False
+        self.queued_emails: Dict[TralbumId, AlbumInfo] = {}
+        self.session: Optional["aiohttp.ClientSession"] = None
+        self.page_slots = asyncio.Semaphore(concurrency)
+        self.transfer_slots = asyncio.Semaphore(transfer_concurrency)
+        self._email_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _init_session(self):
+        # aiohttp sessions have to be created inside the running loop
+        jar = aiohttp.CookieJar()
+        if self.options.cookies:
+            cj = MozillaCookieJar(self.options.cookies)
+            cj.load()
+            for cookie in cj:
+                domain = cookie.domain.lstrip(".")
+                jar.update_cookies(
+                    {cookie.name: cookie.value},
+                    response_url=URL(f"https://{domain}/"),
+                )
+        if self.options.identity:
+            jar.update_cookies(
+                {"identity": self.options.identity},
+                response_url=URL("https://bandcamp.com/"),
+            )
+        timeout = aiohttp.ClientTimeout(
+            total=None, connect=self.CONNECT_TIMEOUT, sock_read=self.READ_TIMEOUT
+        )
+        self.session = aiohttp.ClientSession(
+            cookie_jar=jar, raise_for_status=False, timeout=timeout
+        )
+
+    async def _init_email(self):
+        from guerrillamail import GuerrillaMailSession
+
+        logger.info("Starting mail session...")
+        if not self.options.email:
+            self.options.email = "auto"
+        if self.options.email == "auto":
+            self.mail_session = GuerrillaMailSession()
+            state = await asyncio.to_thread(self.mail_session.get_session_state)
+            self.options.email = state["email_address"]
+        self._email_initialized = True
+
+    async def _request(
+        self, method: str, url: str, **kwargs
+    ) -> "aiohttp.ClientResponse":
+        if self.session is None:
+            self._init_session()
+        for attempt in range(self.RETRIES + 1):
+            try:
+                r = await self.session.request(method, url, **kwargs)
+            except aiohttp.ClientConnectionError:
+                if attempt == self.RETRIES:
+                    raise
+            else:
+                if (
+                    r.status not in self.RETRY_STATUSES
+                    or not may_retry(method, r.status, r.headers)
+                    or attempt == self.RETRIES
+                ):
+                    try:
+                        r.raise_for_status()
+                    except aiohttp.ClientResponseError:
+                        r.release()
+                        raise
+                    return r
+                r.release()
+            # same schedule as the urllib3 Retry of the blocking downloader
+            await asyncio.sleep(min(self.BACKOFF_MAX, self.BACKOFF_FACTOR * 2**attempt))
+
+    async def get_url_text(self, url: str, **kwargs) -> str:
+        async with self.page_slots:
+            r = await self._request("GET", url, **kwargs)
+            async with r:
+                return await r.text()
+
+    async def get_url_soup(self, url: str, **kwargs) -> BeautifulSoup:
+        return BeautifulSoup(await self.get_url_text(url, **kwargs), "html.parser")
+
+    async def get_url_page(self, url: str, **kwargs) -> BandcampPage:
+        text = await self.get_url_text(url, **kwargs)
+        return BandcampPage(make_extractor(text, self.options.parser), url)
+
+    async def get_url_info(self, url: str, **kwargs) -> PageInfo:
+        page = await self.get_url_page(url, **kwargs)
+        try:
+            return BCFreeDownloader.get_page_info(page)
+        except Exception:
+            raise BCFreeDownloadError(f"Could not get page info for {url}")
+
+    async def post_url_json(self, url: str, **kwargs) -> Dict:
+        async with self.page_slots:
+            r = await self._request("POST", url, **kwargs)
+            async with r:
+                return await r.json(content_type=None)
+
+    async def _resolve_download(
+        self, download_page_url: str, format: str
+    ) -> ResolvedDownload:
+        page = await self.get_url_page(download_page_url)
+        return BCFreeDownloader.get_download_info(page, format)
+
+    @staticmethod
+    def _response_file_name(r: "aiohttp.ClientResponse") -> str:
+        # pyrfc6266 only looks at the headers and url of the response
+        return pyrfc6266.requests_response_to_filename(
+            SimpleNamespace(headers=r.headers, url=str(r.url))
+        )
+
+    async def _transfer_file(self, download_url: str) -> str:
+        async def download(download_url: str) -> str:
+            async with self.transfer_slots:
+                r = await self._request("GET", download_url)
+                async with r:
+                    size = int(r.headers["content-length"])
+                    name = self._response_file_name(r)
+                    file_name = os.path.join(self.options.dir, name)
+                    with tqdm(total=size, unit="iB", unit_scale=True) as pbar:
+                        with open(file_name, "wb") as f:
+                            async for chunk in r.content.iter_chunked(
+                                BCFreeDownloader.CHUNK_SIZE
+                            ):
+                                f.write(chunk)
+                                pbar.update(len(chunk))
+                    return file_name
+
+        try:
+            file_name = await download(download_url)
+        except Exception:
+            statdownload_url = download_url.replace("/download/", "/statdownload/")
+            download_url = BCFreeDownloader.get_retry_url(
+                await self.get_url_text(statdownload_url)
+            )
+            if download_url:
+                file_name = await download(download_url)
+            else:
+                # retry requires email address
+                raise BCFreeDownloadError(
+                    "Download expired. Make sure your payment email is linked "
+                    "to your fan account (Settings > Fan > Payment email addresses)"
+                )
+
+        logger.info(f"Downloaded {file_name}")
+
+        return file_name
+
+    async def _download_file(self, download_page_url: str, format: str) -> DownloadRet:
+        resolved = await self._resolve_download(download_page_url, format)
+        file_name = await self._transfer_file(resolved["download_url"])
+        return {"id": resolved["id"], "file_name": file_name}
+
+    async def _find_purchased_download_page(
+        self, user_id: int, tralbum_data: Dict
+    ) -> str:
+        logger.info("Downloading album from collection...")
+        logger.debug(f"Searching for album: '{tralbum_data['current']['title']}'")
+        results = await self.post_url_json(
+            BCFreeDownloader.COLLECTION_SEARCH_URL,
+            json=BCFreeDownloader.get_collection_search_form(user_id, tralbum_data),
+        )
+        return BCFreeDownloader.get_redownload_url(results, tralbum_data)
+
+    # find the download link of a release page without transferring it
+    async def resolve_album(self, page: Page) -> AlbumInfo:
+        album_data = BCFreeDownloader.get_album_info(page)
+        tralbum_data = album_data["tralbum_data"]
+        album_data["is_downloaded"] = False
+        album_data["email_queued"] = False
+        album_data["download"] = None
+        url = tralbum_data["url"]
+
+        offer = BCFreeDownloader.get_release_offer(page, album_data)
+        if offer["kind"] == "free":
+            download_page_url = offer["download_page_url"]
+        elif offer["kind"] == "email":
+            async with self._email_lock:
+                if not self._email_initialized:
+                    await self._init_email()
+            r = await self.post_url_json(
+                urljoin(url, "/email_download"),
+                data=BCFreeDownloader.get_email_form(tralbum_data, self.options),
+            )
+
+            if not r["ok"]:
+                raise ValueError(f"Bad response when sending email address: {r}")
+            type = tralbum_data["current"]["type"]
+            id = tralbum_data["current"]["id"]
+            album_data["email_queued"] = True
+            self.queued_emails[(type, id)] = album_data
+            return album_data
+        elif offer["kind"] == "purchased":
+            download_page_url = await self._find_purchased_download_page(
+                offer["fan_id"], tralbum_data
+            )
+        else:
+            return album_data
+
+        album_data["download"] = await self._resolve_download(
+            download_page_url, self.options.format
+        )
+
+        return album_data
+
+    async def download_album(self, page: Page) -> AlbumInfo:
+        album_data = await self.resolve_album(page)
+        if album_data["download"] is None:
+            return album_data
+        album_data["file_name"] = await self._transfer_file(
+            album_data["download"]["download_url"]
+        )
+        album_data["is_downloaded"] = True
+        return album_data
+
+    # unconditionally download all releases of a label page concurrently
+    async def download_label(self, page: Page) -> LabelInfo:
+        info = BCFreeDownloader.get_label_info(page)
+
+        async def download_release(release):
+            logger.info(f"Downloading {release['url']}")
+            try:
+                page = await self.get_url_page(release["url"])
+                release["release_info"] = await self.download_album(page)
+            except BCFreeDownloadError as ex:
+                logger.info(ex)
+
+        await asyncio.gather(*(download_release(r) for r in info["releases"]))
+        return info
+
+    # unconditionally downloads the provided url
+    # see BCFreeDownloader.download_url
+    async def download_url(self, url: str):
+        page = await self.get_url_page(url)
+
+        # dispatch on og:type alone, get_page_info would decode a label's
+        # whole grid before download_label reads it again
+        page_type = page.og_type
+        if page_type == "album" or page_type == "song":
+            ret = await self.download_album(page)
+        elif page_type == "band":
+            ret = await self.download_label(page)
+        else:
+            raise BCFreeDownloadError("Page does not have a valid og:type value")
+
+        ret["page_type"] = page_type
+
+        return ret
+
+    async def flush_email_downloads(self, poll_interval: float = 5) -> List[AlbumInfo]:
+        if self.mail_session is None:
+            # sent to a fixed address, see BCFreeDownloader.flush_email_downloads
+            if self.queued_emails:
+                logger.error(
+                    f"Download links of {len(self.queued_emails)} releases "
+                    f"were sent to {self.options.email}"
+                )
+                self.queued_emails.clear()
+            return []
+        checked_ids = set()
+        downloaded = []
+
+        async def download(download_url: str):
+            dlret = await self._download_file(download_url, self.options.format)
+            album_data = self.queued_emails.pop(dlret["id"])
+            album_data["file_name"] = dlret["file_name"]
+            downloaded.append(album_data)
+
+        tasks = []
+        while True:
+            in_flight = 0
+            for task in tasks:
+                if not task.done():
+                    in_flight += 1
+                elif task.exception():
+                    raise task.exception()
+            # releases whose email arrived are downloading already
+            waiting = len(self.queued_emails) - in_flight
+            if waiting <= 0:
+                break
+            logger.info(f"Waiting for {waiting} emails from Bandcamp...")
+            await asyncio.sleep(poll_interval)
+            # guerrillamail is a blocking client
+            emails = await asyncio.to_thread(self.mail_session.get_email_list)
+            for email in emails:
+                email_id = email.guid
+                if email_id in checked_ids:
+                    continue
+
+                checked_ids.add(email_id)
+                if (
+                    email.sender == "noreply@bandcamp.com"
+                    and "download" in email.subject
+                ):
+                    logger.info(f'Received email "{email.subject}"')
+                    mail = await asyncio.to_thread(
+                        self.mail_session.get_email, email_id
+                    )
+                    download_url = BCFreeDownloader.get_email_download_url(mail.body)
+                    if download_url:
+                        tasks.append(asyncio.create_task(download(download_url)))
+                    else:
+                        logger.error(
+                            f"Could not find download URL in body: {mail.body}"
+                        )
+        await asyncio.gather(*tasks)
+        return downloaded
@@ -1,32 +1,182 @@
+import ssl
+import threading
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
 from requests.adapters import HTTPAdapter
-from urllib3.util.ssl_ import create_urllib3_context
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+DEFAULT_CIPHERS = ":".join(
+    [
+        "ECDHE+AESGCM",
+        "ECDHE+CHACHA20",
+        "DHE+AESGCM",
+        "DHE+CHACHA20",
+        "ECDH+AESGCM",
+        "DH+AESGCM",
+        "ECDH+AES",
+        "DH+AES",
+        "RSA+AESGCM",
+        "RSA+AES",
+        "!aNULL",
+        "!eNULL",
+        "!MD5",
+        "!DSS",
+        "!AESCCM",
+    ]
+)
+
+
+@dataclass
+class ConnectionStats:
+    requests: int = 0
+    connections: int = 0
+    tls_handshakes: int = 0
+    tls_resumed: int = 0
+
+    def __str__(self):
+        return (
+            f"{self.requests} requests over {self.connections} connections, "
+            f"{self.tls_handshakes} TLS handshakes ({self.tls_resumed} resumed)"
+        )
+
+
+class _SessionSavingSSLSocket(ssl.SSLSocket):
+    _read = False
+
+    def recv_into(self, *args, **kwargs):
+        n = super().recv_into(*args, **kwargs)
+        if not self._read:
+            # TLS 1.3 tickets are read with the first response, save the
+            # session while the connection is still kept alive in its pool
+            self._read = True
+            self.context._save_session(self)
+        return n
+
+    def close(self):
+        # TLS 1.3 tickets arrive after the handshake, save the session again
+        self.context._save_session(self)
+        super().close()
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """SSL context that keeps the last TLS session of every name a server's
+    certificate is valid for and offers it on the next connection to any host
+    the certificate covers, so connecting to another artist subdomain after
+    the first one skips the full handshake (RFC 8446 4.2.11)."""
+
+    sslsocket_class = _SessionSavingSSLSocket
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.stats = ConnectionStats()
+        # certificate name, e.g. "*.bandcamp.com" -> session
+        self._sessions: Dict[str, ssl.SSLSession] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _certificate_names(sock: ssl.SSLSocket) -> List[str]:
+        try:
+            cert = sock.getpeercert()
+        except (OSError, ValueError):
+            return []
+        return [
+            value
+            for key, value in (cert or {}).get("subjectAltName", ())
+            if key == "DNS"
+        ]
+
+    def _find_session(self, hostname: str) -> Optional[ssl.SSLSession]:
+        session = self._sessions.get(hostname)
+        if session is None and "." in hostname:
+            session = self._sessions.get("*." + hostname.split(".", 1)[1])
+        return session
+
+    def _save_session(self, sock: ssl.SSLSocket):
+        hostname = sock.server_hostname
+        try:
+            session = sock.session
+        except (OSError, ValueError):
+            return
+        if hostname and session is not None:
+            names = getattr(sock, "_certificate_names", None) or [hostname]
+            with self._lock:
+                for name in names:
+                    self._sessions[name] = session
+
+    def wrap_socket(self, sock, *args, server_hostname=None, session=None, **kwargs):
+        if session is None and server_hostname:
+            with self._lock:
+                session = self._find_session(server_hostname)
+        ssl_sock = super().wrap_socket(
+            sock, *args, server_hostname=server_hostname, session=session, **kwargs
+        )
+        with self._lock:
+            self.stats.tls_handshakes += 1
+            if ssl_sock.session_reused:
+                self.stats.tls_resumed += 1
+        # kept for close, when the certificate can't be read anymore
+        ssl_sock._certificate_names = self._certificate_names(ssl_sock)
+        self._save_session(ssl_sock)
+        return ssl_sock
+
+
+def create_ssl_context() -> ResumingSSLContext:
+    # same settings as urllib3's create_urllib3_context, but with session
+    # tickets enabled
+    ctx = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ctx.minimum_version = ssl.TLSVersion.TLSv1_2
+    ctx.options |= ssl.OP_NO_COMPRESSION
+    if getattr(ctx, "post_handshake_auth", None) is not None:
+        ctx.post_handshake_auth = True
+    ctx.hostname_checks_common_name = False
+    ctx.load_default_certs()
+    ctx.set_ciphers(DEFAULT_CIPHERS)
+    return ctx
 
 
 # https://github.com/urllib3/urllib3/issues/3439#issuecomment-2306400349
 class BandcampHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter with one SSL context shared by the pools of all hosts, and
+    statistics on how well connections and TLS sessions are reused.
+
+    `pool_connections` is the number of hosts to keep pools for and
+    `pool_maxsize` the number of connections kept per host, so they should
+    be at least the number of artist subdomains and of concurrent requests.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.ssl_context = create_ssl_context()
+        self._lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    @property
+    def stats(self) -> ConnectionStats:
+        return self.ssl_context.stats
+
+    def _counting_pool(self, pool_class):
+        adapter = self
+
+        class CountingPool(pool_class):
+            def _new_conn(self):
+                with adapter._lock:
+                    adapter.stats.connections += 1
+                return super()._new_conn()
+
+        return CountingPool
+
     def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
-        ctx = create_urllib3_context()
-        ctx.load_default_certs()
-        DEFAULT_CIPHERS = ":".join(
-            [
-                "ECDHE+AESGCM",
-                "ECDHE+CHACHA20",
-                "DHE+AESGCM",
-                "DHE+CHACHA20",
-                "ECDH+AESGCM",
-                "DH+AESGCM",
-                "ECDH+AES",
-                "DH+AES",
-                "RSA+AESGCM",
-                "RSA+AES",
-                "!aNULL",
-                "!eNULL",
-                "!MD5",
-                "!DSS",
-                "!AESCCM",
-            ]
-        )
-        ctx.set_ciphers(DEFAULT_CIPHERS)
-        return super().init_poolmanager(
-            connections, maxsize, block, **pool_kwargs, ssl_context=ctx
+        super().init_poolmanager(
+            connections, maxsize, block, **pool_kwargs, ssl_context=self.ssl_context
         )
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": self._counting_pool(HTTPConnectionPool),
+            "https": self._counting_pool(HTTPSConnectionPool),
+        }
+
+    def send(self, request, *args, **kwargs):
+        r = super().send(request, *args, **kwargs)
+        with self._lock:
+            self.stats.requests += 1
+        return r
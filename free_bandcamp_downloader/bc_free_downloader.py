@@ -1,32 +1,93 @@
-import glob
-import html
-import json
 import os
 import re
+import threading
 import time
 import zipfile
-import mutagen
-import pyrfc6266
 import requests
 
-from bs4 import BeautifulSoup
-from tqdm import tqdm
-from dataclasses import dataclass
 from http.cookiejar import MozillaCookieJar
-from typing import Dict, List, Literal, Optional, Tuple, TypedDict, Union
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Literal,
+    Optional,
+    Set,
+    Tuple,
+    TypedDict,
+    Union,
+)
 from urllib.parse import urljoin
-from guerrillamail import GuerrillaMailSession
 from urllib3 import Retry
 
-from free_bandcamp_downloader import logger
+from free_bandcamp_downloader import logger, tagging
 from free_bandcamp_downloader.bandcamp_http_adapter import BandcampHTTPAdapter
+from free_bandcamp_downloader.collection import CollectionSync, collection_key
+from free_bandcamp_downloader.email_watcher import EmailWatcher
+from free_bandcamp_downloader.extract import (
+    BandcampPage,
+    PageExtractor,
+    as_page,
+    make_extractor,
+)
+from free_bandcamp_downloader.http_cache import HTTPCache
+from free_bandcamp_downloader.mail import GuerrillaMailProvider, InboxPool, MailProvider
+from free_bandcamp_downloader.metrics import stage_metrics
+from free_bandcamp_downloader.options import FORMATS, BCFreeDownloaderOptions
+from free_bandcamp_downloader.rate_limit import RateLimiter, may_retry
+from free_bandcamp_downloader.stream_unzip import (
+    CorruptZipError,
+    StreamUnzipError,
+    ZipStreamExtractor,
+)
+from free_bandcamp_downloader.transfer import (
+    CorruptDownloadError,
+    IncompleteDownloadError,
+    PartFile,
+    RangeNotSupportedError,
+    SegmentedDownload,
+    StreamVerifier,
+    TransferOptions,
+    copy_response,
+)
+
+if TYPE_CHECKING:
+    from bs4 import BeautifulSoup
 
 TralbumId = Tuple[Literal["album", "track", "url"], Union[int, str]]
+# the parsing helpers accept a soup, a PageExtractor or a BandcampPage
+# only a BandcampPage keeps its decoded blobs between calls
+Page = Union["BeautifulSoup", PageExtractor, BandcampPage]
+
+
+class TransferRet(TypedDict):
+    file_name: str
+    # set if the zip was extracted while downloading, file_name is then
+    # the directory the files were extracted to
+    files: Optional[List[str]]
+    # `<algorithm>:<hex digest>` of the downloaded file, see
+    # TransferOptions.digest
+    digest: Optional[str]
 
 
 class DownloadRet(TypedDict):
     id: TralbumId
     file_name: str
+    files: Optional[List[str]]
+    digest: Optional[str]
+
+
+class ResolvedDownload(TypedDict):
+    id: TralbumId
+    download_url: str
+
+
+class ReleaseOffer(TypedDict):
+    kind: Optional[Literal["free", "email", "purchased"]]
+    download_page_url: Optional[str]
+    fan_id: Optional[int]
 
 
 class AlbumInfo(TypedDict):
@@ -35,6 +96,9 @@ class AlbumInfo(TypedDict):
     is_downloaded: Optional[bool]
     email_queued: Optional[bool]
     file_name: Optional[str]
+    files: Optional[List[str]]
+    digest: Optional[str]
+    download: Optional[ResolvedDownload]
 
 
 class LabelReleaseInfo(TypedDict):
@@ -55,58 +119,130 @@ class PageInfo(TypedDict):
     info: LabelInfo | AlbumInfo
 
 
-@dataclass
-class BCFreeDownloaderOptions:
-    country: str = "United States"
-    zipcode: str = "00000"
-    email: str = "auto"
-    format: str = "FLAC"
-    dir: str = "."
-    cookies: Optional[str] = None
-    identity: Optional[str] = None
-
-
 class BCFreeDownloadError(Exception):
     pass
 
 
+# progress bar of a file transfer, counts the bytes into the transfer metrics
+# bytes are passed on at most every `interval` seconds, segments of a transfer
+# update it from several threads
+class TransferProgress:
+    def __init__(self, total: int, initial: int = 0, interval: float = 0.1):
+        from tqdm import tqdm
+
+        self.bar = tqdm(total=total, initial=initial, unit="iB", unit_scale=True)
+        self.interval = interval
+        self._pending = 0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def update(self, n: int = 1):
+        with self._lock:
+            self._pending += n
+            now = time.monotonic()
+            if now - self._last < self.interval:
+                return
+            self._last = now
+            self._flush()
+
+    def _flush(self):
+        pending, self._pending = self._pending, 0
+        if pending:
+            stage_metrics.add_bytes("transfer", pending)
+            self.bar.update(pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        with self._lock:
+            self._flush()
+        self.bar.close()
+
+
+def requests_response_to_filename(r: requests.Response) -> str:
+    import pyrfc6266
+
+    return pyrfc6266.requests_response_to_filename(r)
+
+
 class BCFreeDownloader:
     CHUNK_SIZE = 1024 * 1024
+    # attempts to resume an interrupted transfer from the same link
+    RESUME_ATTEMPTS = 3
+    # threads downloading links from emails as they arrive
+    EMAIL_WORKERS = 2
+    # attempts of a request the server keeps answering with 429 or 5xx
+    THROTTLED_ATTEMPTS = 10
     LINK_REGEX = re.compile(r'<a href="(?P<url>[^"]*)">')
     RETRY_URL_REGEX = re.compile(r'"retry_url":"(?P<retry_url>[^"]*)"')
-    FORMATS = {
-        "FLAC": "flac",
-        "V0MP3": "mp3-v0",
-        "320MP3": "mp3-320",
-        "AAC": "aac-hi",
-        "Ogg": "vorbis",
-        "ALAC": "alac",
-        "WAV": "wav",
-        "AIFF": "aiff-lossless",
-    }
-
-    def __init__(self, options: BCFreeDownloaderOptions):
+    COLLECTION_SEARCH_URL = "https://bandcamp.com/api/fancollection/1/search_items"
+    FORMATS = FORMATS
+
+    def __init__(
+        self,
+        options: BCFreeDownloaderOptions,
+        http_cache: Optional[HTTPCache] = None,
+        transfer_options: Optional[TransferOptions] = None,
+        mail_provider: Optional[MailProvider] = None,
+        inboxes: int = 1,
+        rate_limiter: Optional[RateLimiter] = None,
+        pool_connections: int = 100,
+        pool_maxsize: int = 10,
+        collection_sync: Optional[CollectionSync] = None,
+    ):
         self.options = options
-        self.mail_session = None
+        # resolves purchased releases from an index of the whole collection
+        self.collection_sync = collection_sync
+        # shared by all requests, see _request
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.transfer_options = transfer_options or TransferOptions()
+        # only used for release and label pages, see get_url_page
+        self.http_cache = http_cache
+        # inboxes for email 'auto', created when the first release needs one
+        self.mail_provider = mail_provider or GuerrillaMailProvider()
+        self.inboxes = inboxes
+        self.inbox_pool: Optional[InboxPool] = None
+        # set by _init_email, which only creates inboxes for email 'auto'
+        self._email_initialized = False
         self.queued_emails: Dict[TralbumId, AlbumInfo] = {}
+        # queued releases whose email is being downloaded
+        self._email_transfers: Set[TralbumId] = set()
+        self._queue_lock = threading.Lock()
+        # started when the first release is queued, see resolve_album
+        self.email_watcher: Optional[EmailWatcher] = None
         self.session = None
         self.email = None
-        self._init_session()
+        self._init_session(pool_connections, pool_maxsize)
 
     def _init_email(self):
         logger.info("Starting mail session...")
         if not self.options.email:
             self.options.email = "auto"
         if self.options.email == "auto":
-            self.mail_session = GuerrillaMailSession()
-            self.options.email = self.mail_session.get_session_state()["email_address"]
+            self.inbox_pool = InboxPool(self.mail_provider, self.inboxes)
+            self.options.email = self.inbox_pool.address
+        self._email_initialized = True
 
-    def _init_session(self):
+    # see BandcampHTTPAdapter for the pool sizes
+    def _init_session(self, pool_connections: int = 100, pool_maxsize: int = 10):
         self.session = requests.Session()
+        # throttling responses are retried by _request, this only retries
+        # connection errors
         retries = Retry(
-            total=10, backoff_factor=10, backoff_max=60, allowed_methods={"POST", "GET"}
+            total=10,
+            status=0,
+            backoff_factor=10,
+            backoff_max=60,
+            allowed_methods={"POST", "GET"},
+            respect_retry_after_header=False,
+        )
+        self.adapter = BandcampHTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=retries,
         )
-        self.session.mount("https://", BandcampHTTPAdapter(max_retries=retries))
+        self.session.mount("https://", self.adapter)
         if self.options.cookies:
             cj = MozillaCookieJar(self.options.cookies)
             cj.load()
@@ -114,195 +250,483 @@ class BCFreeDownloader:
         if self.options.identity:
             self.session.cookies.set("identity", self.options.identity)
 
-    def _download_file(self, download_page_url: str, format: str) -> DownloadRet:
-        soup = self.get_url_soup(download_page_url)
+    def close(self):
+        """Stop the email watcher and close the inboxes, the HTTP cache and
+        the connections"""
+        if self.email_watcher is not None:
+            self.email_watcher.close()
+        if self.inbox_pool is not None:
+            self.inbox_pool.close()
+        if self.http_cache is not None:
+            self.http_cache.close()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _resolve_download(
+        self, download_page_url: str, format: str
+    ) -> ResolvedDownload:
+        with stage_metrics.time("resolve"):
+            # download links expire, never cache these
+            page = self.get_url_page(download_page_url, cache=False)
+            return BCFreeDownloader.get_download_info(page, format)
+
+    def _use_segments(self, r: requests.Response, meta: Dict) -> bool:
+        options = self.transfer_options
+        return (
+            options.segments > 1
+            and meta["size"] >= options.segment_threshold
+            and r.headers.get("Accept-Ranges") == "bytes"
+        )
 
-        data = json.loads(soup.find("div", {"id": "pagedata"}).attrs["data-blob"])[
-            "digital_items"
-        ][0]
-        download_url = data["downloads"][self.FORMATS[format]]["url"]
-        id = (data["type"], int(data["item_id"]))
+    # download a large file over several connections at once
+    def _transfer_segmented(
+        self, download_url: str, part: PartFile, meta: Dict, verifier: StreamVerifier
+    ) -> TransferRet:
+        def get(url: str, headers: Dict[str, str]) -> requests.Response:
+            return self.get_url(url, budget="cdn", stream=True, headers=headers)
+
+        transfer = SegmentedDownload(
+            get,
+            download_url,
+            part,
+            meta,
+            self.transfer_options.segments,
+            self.transfer_options.chunk_size,
+        )
+        if transfer.done:
+            logger.info(f"Resuming {part.file_name} at {transfer.done} bytes")
+        with TransferProgress(meta["size"]) as pbar:
+            transfer.run(pbar)
+        # segments arrive out of order, check the file once it's complete
+        verifier.catch_up(part.part_path, meta["size"])
+        digest = verifier.finish(meta["size"])
+        part.finish()
+        return {"file_name": part.file_name, "files": None, "digest": digest}
+
+    # download the rest of a file from `offset` over one connection, returns
+    # the digest of the file
+    def _transfer_sequential(
+        self,
+        r: requests.Response,
+        part: PartFile,
+        meta: Dict,
+        offset: int,
+        verifier: StreamVerifier,
+    ) -> Optional[str]:
+        options = self.transfer_options
+        # bytes of an earlier run weren't seen by the verifier
+        verifier.catch_up(part.part_path, offset)
+        if not options.preallocate:
+            part.save_meta(meta)
+            with TransferProgress(meta["size"], offset) as pbar:
+                with open(part.part_path, "r+b" if offset else "wb") as f:
+                    f.seek(offset)
+                    f.truncate()
+
+                    def append(chunk: memoryview):
+                        f.write(chunk)
+                        verifier.update(chunk)
+
+                    copy_response(r, append, pbar, options.chunk_size)
+            return verifier.finish(meta["size"])
+
+        # the file has its full size from the start, so its progress is kept
+        # in the sidecar
+        meta = PartFile.sequential_meta(meta, offset)
+        segment = meta["segments"][0]
+        part.save_meta(meta)
+        unsaved = 0
+        with TransferProgress(meta["size"], offset) as pbar:
+            with open(part.part_path, "r+b" if offset else "wb") as f:
+                part.preallocate(f, meta["size"])
+                f.seek(offset)
+
+                def write(chunk: memoryview):
+                    nonlocal unsaved
+                    f.write(chunk)
+                    verifier.update(chunk)
+                    segment[2] += len(chunk)
+                    unsaved += len(chunk)
+                    if unsaved >= SegmentedDownload.SAVE_INTERVAL:
+                        f.flush()
+                        part.save_meta(meta)
+                        unsaved = 0
+
+                try:
+                    copy_response(
+                        r, write, pbar, options.chunk_size, meta["size"] - offset
+                    )
+                finally:
+                    f.flush()
+                    part.save_meta(meta)
+        return verifier.finish(meta["size"])
+
+    # download a zip straight into its directory, see TransferOptions.stream_unzip
+    def _transfer_extracting(
+        self,
+        download_url: str,
+        r: requests.Response,
+        extractor: ZipStreamExtractor,
+        meta: Dict,
+        verifier: StreamVerifier,
+    ) -> TransferRet:
+        offset = extractor.consumed
+        if offset:
+            logger.info(f"Resuming {extractor.dir_name} at {offset} bytes")
+            r.close()
+            r = self.get_url(
+                download_url,
+                budget="cdn",
+                stream=True,
+                headers=PartFile.range_headers(offset, meta),
+            )
+            if r.status_code != 206:
+                extractor.reset()
+                verifier.reset()
+                offset = 0
 
-        def download(download_url: str) -> str:
-            with self.get_url(download_url, stream=True) as r:
-                size = int(r.headers["content-length"])
-                name = pyrfc6266.requests_response_to_filename(r)
-                file_name = os.path.join(self.options.dir, name)
-                with tqdm(total=size, unit="iB", unit_scale=True) as pbar:
-                    with open(file_name, "wb") as f:
-                        for chunk in r.iter_content(chunk_size=self.CHUNK_SIZE):
-                            f.write(chunk)
-                            pbar.update(len(chunk))
-                return file_name
+        # the extractor checks the zip itself
+        def feed(chunk: memoryview):
+            extractor.feed(chunk)
+            verifier.update(chunk)
 
         try:
-            file_name = download(download_url)
-        except Exception:
-            statdownload_url = download_url.replace("/download/", "/statdownload/")
-            with self.get_url(statdownload_url) as r:
-                download_url = self.RETRY_URL_REGEX.search(r.text).group("retry_url")
-            if download_url:
-                file_name = download(download_url)
-            else:
+            with TransferProgress(meta["size"], offset) as pbar:
+                copy_response(r, feed, pbar, self.transfer_options.chunk_size)
+        finally:
+            r.close()
+        if extractor.consumed != meta["size"]:
+            raise IncompleteDownloadError(
+                f"{extractor.dir_name} ended after {extractor.consumed} "
+                f"of {meta['size']} bytes"
+            )
+        digest = verifier.finish(meta["size"])
+        return {
+            "file_name": extractor.dir_name,
+            "files": extractor.close(),
+            "digest": digest,
+        }
+
+    # `finalize` is called with every file extracted from a zip if the zip
+    # is extracted while downloading
+    def _transfer_file(
+        self, download_url: str, finalize: Optional[Callable[[str], None]] = None
+    ) -> TransferRet:
+        stream_unzip = finalize is not None and self.transfer_options.stream_unzip
+        # kept between attempts, so an interrupted extraction is resumed
+        extractor: Optional[ZipStreamExtractor] = None
+        extractor_meta = None
+        # kept between attempts too, so bytes are only checked once
+        verifier: Optional[StreamVerifier] = None
+        verifier_key = None
+
+        def download(download_url: str) -> TransferRet:
+            nonlocal extractor, extractor_meta, verifier, verifier_key
+            r = self.get_url(download_url, budget="cdn", stream=True)
+            try:
+                meta = PartFile.response_meta(r)
+                name = requests_response_to_filename(r)
+                file_name = os.path.join(self.options.dir, name)
+                part = PartFile(file_name)
+                extracting = stream_unzip and name.endswith(".zip")
+                if verifier is None or verifier_key != (file_name, extracting):
+                    verifier = StreamVerifier(
+                        self.transfer_options.digest,
+                        zip=name.endswith(".zip") and not extracting,
+                    )
+                    verifier_key = (file_name, extracting)
+
+                if extracting:
+                    if extractor is None or extractor_meta != meta:
+                        if extractor is not None:
+                            extractor.reset()
+                        extractor = ZipStreamExtractor(file_name[:-4], finalize)
+                        extractor_meta = meta
+                        verifier.reset()
+                    return self._transfer_extracting(
+                        download_url, r, extractor, meta, verifier
+                    )
+
+                if self._use_segments(r, meta):
+                    r.close()
+                    try:
+                        return self._transfer_segmented(
+                            download_url, part, meta, verifier
+                        )
+                    except RangeNotSupportedError as ex:
+                        logger.info(f"{ex}, downloading over one connection")
+                        part.discard()
+                        r = self.get_url(download_url, budget="cdn", stream=True)
+                        meta = PartFile.response_meta(r)
+
+                offset = part.resume_offset(meta)
+                if offset:
+                    logger.info(f"Resuming {file_name} at {offset} bytes")
+                    r.close()
+                    r = self.get_url(
+                        download_url,
+                        budget="cdn",
+                        stream=True,
+                        headers=PartFile.range_headers(offset, meta),
+                    )
+                    if r.status_code != 206:
+                        # range not honored or the file changed, start over
+                        offset = 0
+                        meta = PartFile.response_meta(r)
+                digest = self._transfer_sequential(r, part, meta, offset, verifier)
+            except (CorruptDownloadError, CorruptZipError):
+                # never resume from damaged bytes
+                part.discard()
+                if extractor is not None:
+                    extractor.reset()
+                verifier.reset()
+                raise
+            finally:
+                r.close()
+            part.finish()
+            return {"file_name": file_name, "files": None, "digest": digest}
+
+        def download_resuming(download_url: str) -> TransferRet:
+            nonlocal stream_unzip
+            for attempt in range(self.RESUME_ATTEMPTS):
+                try:
+                    return download(download_url)
+                except StreamUnzipError as ex:
+                    # can't be extracted on the fly, download the zip instead
+                    logger.info(f"{ex}, downloading the zip file instead")
+                    extractor.reset()
+                    stream_unzip = False
+                    return download_resuming(download_url)
+                except (requests.RequestException, IncompleteDownloadError) as ex:
+                    if attempt == self.RESUME_ATTEMPTS - 1:
+                        raise
+                    logger.info(f"Download interrupted ({ex}), resuming...")
+
+        def transfer(download_url: str) -> TransferRet:
+            try:
+                return download_resuming(download_url)
+            except Exception as ex:
+                corrupt = isinstance(ex, (CorruptDownloadError, CorruptZipError))
+                if corrupt:
+                    logger.info(f"Download is corrupt ({ex}), downloading again...")
+                # otherwise the link probably expired, what was downloaded so
+                # far is kept in the part file and resumed from the fresh link
+                statdownload_url = download_url.replace("/download/", "/statdownload/")
+                with self.get_url(statdownload_url) as r:
+                    download_url = BCFreeDownloader.get_retry_url(r.text)
+                if download_url:
+                    return download_resuming(download_url)
+                if extractor is not None:
+                    extractor.reset()
+                if corrupt:
+                    raise
                 # retry requires email address
                 raise BCFreeDownloadError(
                     "Download expired. Make sure your payment email is linked "
                     "to your fan account (Settings > Fan > Payment email addresses)"
                 )
 
-        logger.info(f"Downloaded {file_name}")
+        with stage_metrics.time("transfer"):
+            ret = transfer(download_url)
 
-        return {"id": id, "file_name": file_name}
+        if ret["files"] is not None:
+            logger.info(f"Downloaded and extracted {ret['file_name']}")
+        else:
+            logger.info(f"Downloaded {ret['file_name']}")
 
-    # unzip the provided file and return all file paths
+        return ret
+
+    def _download_file(
+        self,
+        download_page_url: str,
+        format: str,
+        finalize: Optional[Callable[[str], None]] = None,
+    ) -> DownloadRet:
+        resolved = self._resolve_download(download_page_url, format)
+        ret = self._transfer_file(resolved["download_url"], finalize)
+        return {
+            "id": resolved["id"],
+            "file_name": ret["file_name"],
+            "files": ret["files"],
+            "digest": ret["digest"],
+        }
+
+    # unzip the provided file and return the paths of the extracted files
     @staticmethod
     def unzip_album(file_name: str) -> List[str]:
         dir_name = file_name[:-4]
+        start = time.perf_counter()
         with zipfile.ZipFile(file_name, "r") as f:
-            f.extractall(dir_name)
+            members = [member for member in f.infolist() if not member.is_dir()]
+            files = [f.extract(member, dir_name) for member in members]
+        stage_metrics.observe(
+            "unzip",
+            time.perf_counter() - start,
+            sum(member.file_size for member in members),
+        )
         logger.info(f"Unzipped {file_name}.")
         os.remove(file_name)
-        return glob.glob(os.path.join(dir_name, "*"))
+        return files
+
+    # tags files as they are extracted while downloading, if enabled
+    def _album_finalizer(self, head_data: Dict) -> Optional[Callable[[str], None]]:
+        if not self.transfer_options.stream_unzip:
+            return None
+        tags = tagging.build_tags(head_data)
+
+        def finalize(file_name: str):
+            result = tagging.tag_file(file_name, tags)
+            stage_metrics.observe("tag", result.seconds, error=bool(result.error))
+            if result.error:
+                logger.error(f"Could not tag {file_name}: {result.error}")
+
+        return finalize
 
     # Tag downloaded audio file with url & comment
+    # see tagging.Tagger for tagging many files at once
     @staticmethod
-    def tag_file(file_name: str, head_data: Dict):
-        try:
-            f = mutagen.File(file_name)
-            if f is None:
-                return
-
-            f["website"] = head_data["@id"]
-            if head_data.get("keywords"):
-                f["genre"] = head_data["keywords"]
-            comment = ""
-            comment += head_data.get("description", "").strip()
-            comment += "\n\n" + head_data.get("creditText", "")
-            f["comment"] = comment.strip()
-            f.save()
-        except Exception:
-            # only should happen if the file doesn't support tags
-            pass
+    def tag_file(file_name: str, head_data: Dict) -> tagging.TagResult:
+        result = tagging.tag_file(file_name, tagging.build_tags(head_data))
+        stage_metrics.observe("tag", result.seconds, error=bool(result.error))
+        return result
 
-    def _download_purchased_album(
-        self, user_id: int, tralbum_data: Dict
-    ) -> DownloadRet:
+    def _find_purchased_download_page(self, user_id: int, tralbum_data: Dict) -> str:
         logger.info("Downloading album from collection...")
+        if self.collection_sync is not None:
+            download_page_url = self.collection_sync.download_page(
+                self.post_url_json, user_id, tralbum_data
+            )
+            if download_page_url is not None:
+                return download_page_url
+            logger.debug("Album is not in the collection index, searching for it")
         logger.debug(f"Searching for album: '{tralbum_data['current']['title']}'")
-        data = {
-            "fan_id": user_id,
-            "search_key": tralbum_data["current"]["title"],
-            "search_type": "collection",
-        }
         results = self.post_url_json(
-            "https://bandcamp.com/api/fancollection/1/search_items", json=data
+            self.COLLECTION_SEARCH_URL,
+            json=BCFreeDownloader.get_collection_search_form(user_id, tralbum_data),
         )
-        tralbums = results["tralbums"]
-        redownload_urls = results["redownload_urls"]
-        wanted_id = f"{tralbum_data['item_type'][0]}:{tralbum_data['id']}"
-        try:
-            tralbum = next(
-                filter(
-                    lambda tralbum: f"{tralbum['tralbum_type']}:{tralbum['tralbum_id']}"
-                    == wanted_id,
-                    tralbums,
-                )
-            )
-        except StopIteration:
-            raise BCFreeDownloadError("Could not find album in collection")
-        sale_id = f"{tralbum['sale_item_type']}{tralbum['sale_item_id']}"
-        if sale_id not in redownload_urls:
-            raise BCFreeDownloadError("Could not find album download URL in collection")
-        download_url = redownload_urls[sale_id]
-        logger.debug(f"Got download URL: {download_url}")
-        return self._download_file(download_url, self.options.format)
+        return BCFreeDownloader.get_redownload_url(results, tralbum_data)
 
-    # download from release page
-    def download_album(self, soup: BeautifulSoup) -> AlbumInfo:
-        album_data = BCFreeDownloader.get_album_info(soup)
+    def _download_purchased_album(
+        self, user_id: int, tralbum_data: Dict
+    ) -> DownloadRet:
+        download_page_url = self._find_purchased_download_page(user_id, tralbum_data)
+        return self._download_file(download_page_url, self.options.format)
+
+    # find the download link of a release page without transferring it
+    # free releases get `download` set, email releases get queued
+    def resolve_album(self, page: Page) -> AlbumInfo:
+        album_data = BCFreeDownloader.get_album_info(page)
         tralbum_data = album_data["tralbum_data"]
         head_data = album_data["head_data"]
         album_data["is_downloaded"] = False
         album_data["email_queued"] = False
+        album_data["download"] = None
+        album_data["files"] = None
+        album_data["digest"] = None
         url = tralbum_data["url"]
 
-        logger.debug(f"tralbum data: {tralbum_data}")
-        logger.debug(f"album head data: {head_data}")
-
-        if not tralbum_data["hasAudio"]:
-            logger.error(f"{url} has no audio.")
-            return album_data
-
-        head_id = head_data.get("@id")
-        # fallback if a track link was provided
-        # track releases have this inAlbum key even if they're standalone
-        album_release = head_data.get("inAlbum", head_data)["albumRelease"]
-        # find the albumRelease object that matches the overall album @id link
-        # this will ensure that strictly the page release is downloaded
-        album_release = next(obj for obj in album_release if obj["@id"] == head_id)
-
-        if "offers" not in album_release:
-            logger.error(f"{url} has no available offers.")
-
-        if tralbum_data["freeDownloadPage"]:
-            logger.info(f"{url} does not require email")
-            dlret = self._download_file(
-                tralbum_data["freeDownloadPage"], self.options.format
-            )
-        elif "offers" in album_release and album_release["offers"]["price"] == 0.0:
-            logger.info(f"{url} requires email")
-            if self.mail_session is None:
-                self._init_email()
-            email_post_url = urljoin(url, "/email_download")
+        # lazy formatting, these blobs are large
+        logger.debug("tralbum data: %s", tralbum_data)
+        logger.debug("album head data: %s", head_data)
+
+        offer = BCFreeDownloader.get_release_offer(page, album_data)
+        if offer["kind"] == "free":
+            download_page_url = offer["download_page_url"]
+        elif offer["kind"] == "email":
+            with self._queue_lock:
+                if not self._email_initialized:
+                    self._init_email()
+            type = tralbum_data["current"]["type"]
+            id = tralbum_data["current"]["id"]
+            address = None
+            if self.inbox_pool is not None:
+                address = self.inbox_pool.address_for((type, id))
             r = self.post_url_json(
-                email_post_url,
-                data={
-                    "encoding_name": "none",
-                    "item_id": tralbum_data["current"]["id"],
-                    "item_type": tralbum_data["current"]["type"],
-                    "address": self.options.email,
-                    "country": self.options.country,
-                    "postcode": self.options.zipcode,
-                },
+                urljoin(url, "/email_download"),
+                data=BCFreeDownloader.get_email_form(
+                    tralbum_data, self.options, address
+                ),
             )
 
             if not r["ok"]:
+                if self.inbox_pool is not None:
+                    self.inbox_pool.release((type, id))
                 raise ValueError(f"Bad response when sending email address: {r}")
-            type = tralbum_data["current"]["type"]
-            id = tralbum_data["current"]["id"]
             album_data["email_queued"] = True
-            self.queued_emails[(type, id)] = album_data
+            with self._queue_lock:
+                self.queued_emails[(type, id)] = album_data
+                if self.email_watcher is None and self.inbox_pool is not None:
+                    self.email_watcher = EmailWatcher(self, self.EMAIL_WORKERS)
+            if self.email_watcher is not None:
+                self.email_watcher.notify()
             return album_data
-        elif tralbum_data["is_purchased"]:
-            collection_info = soup.find(
-                "script", {"data-tralbum-collect-info": True}
-            ).attrs["data-tralbum-collect-info"]
-            collection_info = json.loads(collection_info)
-            dlret = self._download_purchased_album(
-                collection_info["fan_id"], tralbum_data
+        elif offer["kind"] == "purchased":
+            download_page_url = self._find_purchased_download_page(
+                offer["fan_id"], tralbum_data
             )
         else:
-            logger.error(
-                f"{url} is not free. If you have purchased this album, "
-                "use the --cookies flag or --identity flag to pass your login cookie."
-            )
             return album_data
 
-        album_data["is_downloaded"] = True
-        album_data["file_name"] = dlret["file_name"]
+        album_data["download"] = self._resolve_download(
+            download_page_url, self.options.format
+        )
 
         return album_data
 
+    # transfer a release previously resolved by resolve_album
+    def transfer_album(self, album_data: AlbumInfo) -> AlbumInfo:
+        ret = self._transfer_file(
+            album_data["download"]["download_url"],
+            self._album_finalizer(album_data["head_data"]),
+        )
+        album_data["file_name"] = ret["file_name"]
+        album_data["files"] = ret["files"]
+        album_data["digest"] = ret["digest"]
+        album_data["is_downloaded"] = True
+        return album_data
+
+    # download from release page
+    def download_album(self, page: Page) -> AlbumInfo:
+        album_data = self.resolve_album(page)
+        if album_data["download"] is None:
+            return album_data
+        return self.transfer_album(album_data)
+
     # unconditionally download from release page
-    def download_label(self, soup: BeautifulSoup) -> LabelInfo:
-        info = BCFreeDownloader.get_label_info(soup)
+    # with jobs > 1 releases are downloaded concurrently by a DownloadPipeline
+    def download_label(self, page: Page, jobs: int = 1) -> LabelInfo:
+        page = as_page(page)
+        label_info = page.band_data
+        if label_info is None:
+            raise BCFreeDownloadError("Page has no data-band script.")
+        info = {"label_info": label_info, "releases": []}
 
-        for release in info["releases"]:
+        # collect the releases while they are handed out, not before
+        def releases() -> Iterator[LabelReleaseInfo]:
+            for release in BCFreeDownloader.iter_label_releases(page):
+                info["releases"].append(release)
+                yield release
+
+        if jobs > 1:
+            from free_bandcamp_downloader.pipeline import DownloadPipeline
+
+            pipeline = DownloadPipeline(self, jobs)
+            pipeline.run(releases=releases(), flush_emails=False)
+            for key, ret in pipeline.results.items():
+                info["releases"][key[-1]]["release_info"] = ret
+            return info
+
+        for release in releases():
             logger.info(f"Downloading {release['url']}")
 
-            soup = self.get_url_soup(release["url"])
+            page = self.get_url_page(release["url"])
             try:
-                ret = self.download_album(soup)
+                ret = self.download_album(page)
                 release["release_info"] = ret
             except BCFreeDownloadError as ex:
                 logger.info(ex)
@@ -314,70 +738,142 @@ class BCFreeDownloader:
     # with the `page_type` set to album|song|band
     # exception if download error
     def download_url(self, url: str):
-        soup = self.get_url_soup(url)
+        page = self.get_url_page(url)
 
-        page_info = self.get_page_info(soup)
-        page_type = page_info.get("type")
+        # dispatch on og:type alone, get_page_info would decode a label's
+        # whole grid before download_label reads it again
+        page_type = page.og_type
         if page_type == "album" or page_type == "song":
-            ret = self.download_album(soup)
+            ret = self.download_album(page)
+        elif page_type == "band":
+            ret = self.download_label(page)
         else:
-            ret = self.download_label(soup)
+            raise BCFreeDownloadError("Page does not have a valid og:type value")
 
         ret["page_type"] = page_type
 
         return ret
 
-    def flush_email_downloads(self) -> List[AlbumInfo]:
-        checked_ids = set()
-        downloaded = []
-        while len(self.queued_emails) > 0:
-            logger.info(
-                f"Waiting for {len(self.queued_emails)} emails from Bandcamp..."
+    # download the release a download link from an email is for
+    # called by the email watcher, returns None if the release wasn't queued
+    # the release stays queued until it has been transferred, so a failed
+    # attempt can be retried with the same email
+    def _download_queued_email(self, download_url: str) -> Optional[AlbumInfo]:
+        resolved = self._resolve_download(download_url, self.options.format)
+        id = resolved["id"]
+        with self._queue_lock:
+            album_data = self.queued_emails.get(id)
+            if album_data is not None and id in self._email_transfers:
+                logger.debug(f"{id} is being downloaded, ignoring its email")
+                return None
+            if album_data is not None:
+                self._email_transfers.add(id)
+        if album_data is None:
+            logger.debug(f"{id} was not queued, ignoring its email")
+            return None
+        try:
+            ret = self._transfer_file(
+                resolved["download_url"],
+                self._album_finalizer(album_data["head_data"]),
             )
-            time.sleep(5)
-            for email in self.mail_session.get_email_list():
-                email_id = email.guid
-                if email_id in checked_ids:
-                    continue
-
-                checked_ids.add(email_id)
-                if (
-                    email.sender == "noreply@bandcamp.com"
-                    and "download" in email.subject
-                ):
-                    logger.info(f'Received email "{email.subject}"')
-                    content = self.mail_session.get_email(email_id).body
-                    match = self.LINK_REGEX.search(content)
-                    if match:
-                        download_url = match.group("url")
-                        dlret = self._download_file(download_url, self.options.format)
-                        self.queued_emails[dlret["id"]]["file_name"] = dlret[
-                            "file_name"
-                        ]
-                        downloaded.append(self.queued_emails[dlret["id"]])
-                        self.queued_emails.pop(dlret["id"])
-                    else:
-                        logger.error(f"Could not find download URL in body: {content}")
-        return downloaded
+        except BaseException:
+            with self._queue_lock:
+                self._email_transfers.discard(id)
+            raise
+        else:
+            with self._queue_lock:
+                self.queued_emails.pop(id, None)
+                self._email_transfers.discard(id)
+            self.inbox_pool.release(id)
+        album_data["file_name"] = ret["file_name"]
+        album_data["files"] = ret["files"]
+        album_data["digest"] = ret["digest"]
+        album_data["is_downloaded"] = True
+        return album_data
+
+    # wait for the emails of all queued releases, which are downloaded in the
+    # background as they arrive, and return the releases downloaded so far
+    def flush_email_downloads(self) -> List[AlbumInfo]:
+        with stage_metrics.time("email"):
+            return self._flush_email_downloads()
+
+    def _flush_email_downloads(self) -> List[AlbumInfo]:
+        if self.email_watcher is None:
+            with self._queue_lock:
+                if self.queued_emails:
+                    logger.error(
+                        f"Download links of {len(self.queued_emails)} releases "
+                        f"were sent to {self.options.email}"
+                    )
+                    self.queued_emails.clear()
+            return []
+        return self.email_watcher.wait()
 
     # get_url_x can't be staticmethods because of special session context
-    def get_url(self, url: str, **kwargs) -> requests.Response:
-        r = self.session.get(url, **kwargs)
+    # send a request through the rate limiter, retrying while throttled, see
+    # may_retry for the requests that aren't
+    # `budget` is "cdn" for file transfers, "page" for everything else
+    def _request(
+        self, method: str, url: str, budget: str = "page", **kwargs
+    ) -> requests.Response:
+        for attempt in range(self.THROTTLED_ATTEMPTS):
+            self.rate_limiter.acquire(url, budget)
+            r = self.session.request(method, url, **kwargs)
+            delay = self.rate_limiter.update(url, r, budget)
+            if (
+                delay is None
+                or not may_retry(method, r.status_code, r.headers)
+                or attempt == self.THROTTLED_ATTEMPTS - 1
+            ):
+                break
+            logger.info(f"{r.status_code} for {url}, retrying in {delay:.1f}s")
+            r.close()
+        return r
+
+    def get_url(
+        self, url: str, cache: bool = False, budget: str = "page", **kwargs
+    ) -> requests.Response:
+        def get(url: str, **kwargs) -> requests.Response:
+            return self._request("GET", url, budget, **kwargs)
+
+        # transfers are measured as a whole, see _transfer_file
+        if kwargs.get("stream"):
+            return self._get_url(get, url, cache, **kwargs)
+        with stage_metrics.time("fetch"):
+            r = self._get_url(get, url, cache, **kwargs)
+        stage_metrics.add_bytes("fetch", len(r.content))
+        return r
+
+    def _get_url(
+        self, get: Callable[..., requests.Response], url: str, cache: bool, **kwargs
+    ) -> requests.Response:
+        if cache and self.http_cache is not None:
+            r = self.http_cache.get(get, url, **kwargs)
+        else:
+            r = get(url, **kwargs)
         r.raise_for_status()
         return r
 
-    def get_url_soup(self, url: str, **kwargs) -> BeautifulSoup:
+    def get_url_soup(self, url: str, **kwargs) -> "BeautifulSoup":
+        from bs4 import BeautifulSoup
+
         return BeautifulSoup(self.get_url(url, **kwargs).text, "html.parser")
 
+    # fetch a page for the parsing helpers, using the configured parser backend
+    # pages go through the http cache unless `cache` is False
+    def get_url_page(self, url: str, cache: bool = True, **kwargs) -> BandcampPage:
+        r = self.get_url(url, cache=cache, **kwargs)
+        return BandcampPage(make_extractor(r.text, self.options.parser), url)
+
     def get_url_info(self, url: str, **kwargs) -> PageInfo:
-        soup = self.get_url_soup(url, **kwargs)
+        page = self.get_url_page(url, **kwargs)
         try:
-            return self.get_page_info(soup)
+            return self.get_page_info(page)
         except Exception:
             raise BCFreeDownloadError(f"Could not get page info for {url}")
 
     def post_url(self, url: str, **kwargs) -> requests.Response:
-        r = self.session.post(url, **kwargs)
+        r = self._request("POST", url, **kwargs)
         r.raise_for_status()
         return r
 
@@ -386,68 +882,181 @@ class BCFreeDownloader:
 
     # get the album/label info of a bandcamp page
     @staticmethod
-    def get_page_info(soup: BeautifulSoup) -> PageInfo:
-        page_type = soup.head.find("meta", attrs={"property": "og:type"}).get("content")
+    def get_page_info(page: Page) -> PageInfo:
+        page = as_page(page)
+        page_type = page.og_type
 
         if page_type == "album" or page_type == "song":
-            return {"type": page_type, "info": BCFreeDownloader.get_album_info(soup)}
+            return {"type": page_type, "info": BCFreeDownloader.get_album_info(page)}
         if page_type == "band":
-            return {"type": page_type, "info": BCFreeDownloader.get_label_info(soup)}
+            return {"type": page_type, "info": BCFreeDownloader.get_label_info(page)}
         else:
             # only bandcamp pages are supported
             raise BCFreeDownloadError("Page does not have a valid og:type value")
 
     @staticmethod
-    def get_label_info(soup: BeautifulSoup) -> LabelInfo:
-        label_info = soup.find("script", attrs={"data-band": True})
+    def get_label_info(page: Page) -> LabelInfo:
+        page = as_page(page)
+        label_info = page.band_data
         if label_info is None:
             raise BCFreeDownloadError("Page has no data-band script.")
-        label_info = json.loads(label_info["data-band"])
+        releases = list(BCFreeDownloader.iter_label_releases(page))
+        return {"label_info": label_info, "releases": releases}
 
-        releases = []
+    # yield the releases of a label page as they are parsed, so the first ones
+    # can be downloaded before the rest of the grid has been read
+    @staticmethod
+    def iter_label_releases(page: Page) -> Iterator[LabelReleaseInfo]:
+        page = as_page(page)
+        label_info = page.band_data
+        if label_info is None:
+            raise BCFreeDownloadError("Page has no data-band script.")
         # needed for releases
         local_url = label_info["local_url"]
+        # a release can be both in the grid and in the client items
+        seen: Set[TralbumId] = set()
+
+        def release(type: str, id: int, url: str, band_id: int) -> LabelReleaseInfo:
+            # fixup local urls into global ones
+            if url[0] == "/":
+                url = urljoin(local_url, url)
+            return {"type": type, "id": id, "url": url, "band_id": band_id}
 
         # bandcamp splits the release between this music-grid html and some json blob
-        grid = soup.find("ol", id="music-grid")
-        for li in grid.find_all("li"):
-            if "display:none" in li.get("style", ""):
+        for li in page.iter_grid_items():
+            if "display:none" in li["style"]:
+                continue
+            data = li["item_id"].split("-")
+            id = (data[0], int(data[1]))
+            if id in seen:
+                continue
+            seen.add(id)
+            yield release(*id, li["href"], int(li["band_id"]))
+
+        for obj in page.iter_client_items():
+            if obj.get("filtered"):
                 continue
+            id = (obj["type"], obj["id"])
+            if id in seen:
+                continue
+            seen.add(id)
+            yield release(*id, obj["page_url"], obj.get("band_id"))
+
+    @staticmethod
+    def get_album_info(page: Page) -> AlbumInfo:
+        page = as_page(page)
+        with stage_metrics.time("parse"):
+            tralbum_data = page.tralbum_data
+            head_data = page.head_data
+        if tralbum_data is None:
+            raise BCFreeDownloadError("Page has no data-tralbum script.")
+        if head_data is None:
+            raise BCFreeDownloadError("Page has no ld+json script.")
+
+        return {"tralbum_data": tralbum_data, "head_data": head_data}
+
+    # decide how a release can be downloaded
+    @staticmethod
+    def get_release_offer(page: Page, album_data: AlbumInfo) -> ReleaseOffer:
+        tralbum_data = album_data["tralbum_data"]
+        head_data = album_data["head_data"]
+        url = tralbum_data["url"]
+        offer = {"kind": None, "download_page_url": None, "fan_id": None}
+
+        if not tralbum_data["hasAudio"]:
+            logger.error(f"{url} has no audio.")
+            return offer
 
-            data = li["data-item-id"].split("-")
-            # most important fields
-            releases.append(
-                {
-                    "type": data[0],
-                    "id": int(data[1]),
-                    "url": li.a["href"],
-                    "band_id": int(li["data-band-id"]),
-                }
+        head_id = head_data.get("@id")
+        # fallback if a track link was provided
+        # track releases have this inAlbum key even if they're standalone
+        album_release = head_data.get("inAlbum", head_data)["albumRelease"]
+        # find the albumRelease object that matches the overall album @id link
+        # this will ensure that strictly the page release is downloaded
+        album_release = next(obj for obj in album_release if obj["@id"] == head_id)
+
+        if "offers" not in album_release:
+            logger.error(f"{url} has no available offers.")
+
+        if tralbum_data["freeDownloadPage"]:
+            logger.info(f"{url} does not require email")
+            offer["kind"] = "free"
+            offer["download_page_url"] = tralbum_data["freeDownloadPage"]
+        elif "offers" in album_release and album_release["offers"]["price"] == 0.0:
+            logger.info(f"{url} requires email")
+            offer["kind"] = "email"
+        elif tralbum_data["is_purchased"]:
+            offer["kind"] = "purchased"
+            offer["fan_id"] = as_page(page).collect_info["fan_id"]
+        else:
+            logger.error(
+                f"{url} is not free. If you have purchased this album, "
+                "use the --cookies flag or --identity flag to pass your login cookie."
             )
+        return offer
+
+    @staticmethod
+    def get_email_form(
+        tralbum_data: Dict,
+        options: BCFreeDownloaderOptions,
+        address: Optional[str] = None,
+    ) -> Dict:
+        return {
+            "encoding_name": "none",
+            "item_id": tralbum_data["current"]["id"],
+            "item_type": tralbum_data["current"]["type"],
+            "address": address or options.email,
+            "country": options.country,
+            "postcode": options.zipcode,
+        }
+
+    @staticmethod
+    def get_collection_search_form(user_id: int, tralbum_data: Dict) -> Dict:
+        return {
+            "fan_id": user_id,
+            "search_key": tralbum_data["current"]["title"],
+            "search_type": "collection",
+        }
 
-        client_items = grid.get("data-client-items")
-        if client_items:
-            for obj in json.loads(html.unescape(client_items)):
-                if obj.get("filtered"):
-                    continue
-                # normalize to fit the other half
-                obj["url"] = obj.pop("page_url")
-                releases.append(obj)
+    # find the download page of a release in a collection search result
+    @staticmethod
+    def get_redownload_url(results: Dict, tralbum_data: Dict) -> str:
+        tralbums = results["tralbums"]
+        redownload_urls = results["redownload_urls"]
+        wanted_id = collection_key(tralbum_data)
+        try:
+            tralbum = next(
+                filter(
+                    lambda tralbum: f"{tralbum['tralbum_type']}:{tralbum['tralbum_id']}"
+                    == wanted_id,
+                    tralbums,
+                )
+            )
+        except StopIteration:
+            raise BCFreeDownloadError("Could not find album in collection")
+        sale_id = f"{tralbum['sale_item_type']}{tralbum['sale_item_id']}"
+        if sale_id not in redownload_urls:
+            raise BCFreeDownloadError("Could not find album download URL in collection")
+        download_url = redownload_urls[sale_id]
+        logger.debug(f"Got download URL: {download_url}")
+        return download_url
 
-        # fixup local urls into global ones
-        for release in releases:
-            if release["url"][0] == "/":
-                release["url"] = urljoin(local_url, release["url"])
+    # get the file url and release id from a download page
+    @staticmethod
+    def get_download_info(page: Page, format: str) -> ResolvedDownload:
+        data = as_page(page).pagedata["digital_items"][0]
+        download_url = data["downloads"][BCFreeDownloader.FORMATS[format]]["url"]
+        id = (data["type"], int(data["item_id"]))
 
-        return {"label_info": label_info, "releases": releases}
+        return {"id": id, "download_url": download_url}
 
+    # get the fresh download url from a statdownload response, if any
     @staticmethod
-    def get_album_info(soup: BeautifulSoup) -> AlbumInfo:
-        tralbum_data = soup.find("script", {"data-tralbum": True}).attrs["data-tralbum"]
-        tralbum_data = json.loads(tralbum_data)
-        head_data = soup.head.find(
-            "script", {"type": "application/ld+json"}, recursive=False
-        ).string
-        head_data = json.loads(head_data)
+    def get_retry_url(text: str) -> Optional[str]:
+        return BCFreeDownloader.RETRY_URL_REGEX.search(text).group("retry_url")
 
-        return {"tralbum_data": tralbum_data, "head_data": head_data}
+    # get the download url from a bandcamp download email
+    @staticmethod
+    def get_email_download_url(content: str) -> Optional[str]:
+        match = BCFreeDownloader.LINK_REGEX.search(content)
+        return match.group("url") if match else None
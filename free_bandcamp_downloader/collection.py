@@ -0,0 +1,124 @@
+import json
+import os
+import threading
+import time
+
+from typing import Callable, Dict, Optional
+
+from free_bandcamp_downloader import logger
+
+COLLECTION_ITEMS_URL = "https://bandcamp.com/api/fancollection/1/collection_items"
+
+
+# the `tralbum_type:tralbum_id` key of a release in a fan's collection
+def collection_key(tralbum_data: Dict) -> str:
+    return f"{tralbum_data['item_type'][0]}:{tralbum_data['id']}"
+
+
+class CollectionIndex:
+    """Download pages of every release in a fan's collection, keyed by
+    `collection_key`, from one paged pass over the collection"""
+
+    def __init__(self, fan_id: int, urls: Dict[str, str], fetched_at: float):
+        self.fan_id = fan_id
+        self.urls = urls
+        self.fetched_at = fetched_at
+
+    def get(self, tralbum_data: Dict) -> Optional[str]:
+        return self.urls.get(collection_key(tralbum_data))
+
+    @classmethod
+    def fetch(
+        cls,
+        post_json: Callable[..., Dict],
+        fan_id: int,
+        count: int = 500,
+        url: str = COLLECTION_ITEMS_URL,
+    ) -> "CollectionIndex":
+        fetched_at = time.time()
+        # items older than the token are returned, newest first
+        token = f"{int(fetched_at)}::a::"
+        urls = {}
+        while True:
+            results = post_json(
+                url, json={"fan_id": fan_id, "older_than_token": token, "count": count}
+            )
+            redownload_urls = results.get("redownload_urls") or {}
+            for item in results["items"]:
+                sale_id = f"{item['sale_item_type']}{item['sale_item_id']}"
+                if sale_id in redownload_urls:
+                    key = f"{item['tralbum_type']}:{item['tralbum_id']}"
+                    urls[key] = redownload_urls[sale_id]
+            if not results.get("more_available") or not results["items"]:
+                break
+            token = results["last_token"]
+        return cls(fan_id, urls, fetched_at)
+
+    @classmethod
+    def load(cls, file_name: str) -> "CollectionIndex":
+        with open(file_name) as f:
+            data = json.load(f)
+        return cls(data["fan_id"], data["urls"], data["fetched_at"])
+
+    def save(self, file_name: str):
+        data = {"fan_id": self.fan_id, "fetched_at": self.fetched_at, "urls": self.urls}
+        tmp = file_name + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, file_name)
+
+
+class CollectionSync:
+    """Resolves purchased releases from a CollectionIndex of the fan's whole
+    collection instead of one collection search per release.
+
+    The index of a fan is fetched the first time one of their releases is
+    looked up and kept in `path` (if given) for `ttl` seconds, so later runs
+    don't page through the collection again. Releases bought after the index
+    was fetched aren't in it, `download_page` returns None for those.
+    """
+
+    def __init__(self, path: Optional[str] = None, ttl: float = 86400):
+        self.path = path
+        self.ttl = ttl
+        self._indexes: Dict[int, CollectionIndex] = {}
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    def _file_name(self, fan_id: int) -> Optional[str]:
+        return os.path.join(self.path, f"{fan_id}.json") if self.path else None
+
+    def _load(self, fan_id: int) -> Optional[CollectionIndex]:
+        file_name = self._file_name(fan_id)
+        if file_name is None or not os.path.exists(file_name):
+            return None
+        try:
+            index = CollectionIndex.load(file_name)
+        except (OSError, ValueError, KeyError) as ex:
+            logger.debug(f"Could not read collection index {file_name}: {ex}")
+            return None
+        if time.time() - index.fetched_at > self.ttl:
+            return None
+        return index
+
+    def index(self, post_json: Callable[..., Dict], fan_id: int) -> CollectionIndex:
+        # one fetch per fan, even with several releases resolved concurrently
+        with self._lock:
+            index = self._indexes.get(fan_id)
+            if index is None:
+                index = self._load(fan_id)
+            if index is None:
+                logger.info("Indexing collection...")
+                index = CollectionIndex.fetch(post_json, fan_id)
+                logger.info(f"Indexed {len(index.urls)} releases in collection")
+                file_name = self._file_name(fan_id)
+                if file_name is not None:
+                    index.save(file_name)
+            self._indexes[fan_id] = index
+            return index
+
+    def download_page(
+        self, post_json: Callable[..., Dict], fan_id: int, tralbum_data: Dict
+    ) -> Optional[str]:
+        return self.index(post_json, fan_id).get(tralbum_data)
@@ -0,0 +1,182 @@
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, List, Tuple
+
+from free_bandcamp_downloader import logger
+from free_bandcamp_downloader.mail import Inbox, MailMessage
+
+if TYPE_CHECKING:
+    from free_bandcamp_downloader.bc_free_downloader import AlbumInfo, BCFreeDownloader
+
+
+class EmailWatcher:
+    """Watches the inboxes of a downloader for the download emails of the
+    releases it queued, from a background thread.
+
+    The inboxes are polled every `min_interval` seconds while mail keeps
+    arriving, backing off up to `max_interval` seconds while it doesn't, and
+    not at all while nothing is queued. Every download email is handed to
+    one of `workers` download threads as soon as it arrives. An email that
+    can't be downloaded is retried `MAX_ATTEMPTS` times and then counted as
+    failed, see wait.
+    """
+
+    MAX_ATTEMPTS = 3
+
+    def __init__(
+        self,
+        downloader: "BCFreeDownloader",
+        workers: int = 2,
+        min_interval: float = 2,
+        max_interval: float = 30,
+        backoff: float = 1.5,
+    ):
+        self.downloader = downloader
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._wake = threading.Event()
+        self._closed = False
+        self._interval = min_interval
+        self._next_poll = time.monotonic() + min_interval
+        # guards _downloaded, _running, _attempts and _failed, notified when
+        # a download finishes
+        self._cond = threading.Condition()
+        self._downloaded: List["AlbumInfo"] = []
+        self._running = 0
+        self._attempts: Dict[Tuple[int, str], int] = {}
+        # emails given up on, each is for one of the queued releases
+        self._failed = 0
+        self._thread = threading.Thread(
+            target=self._watch, name="email-watcher", daemon=True
+        )
+        self._thread.start()
+
+    def notify(self):
+        """A release was queued, its email is expected within a few seconds"""
+        with self._cond:
+            self._interval = self.min_interval
+            self._next_poll = min(self._next_poll, time.monotonic() + self.min_interval)
+        self._wake.set()
+
+    def _queued_count(self) -> int:
+        with self.downloader._queue_lock:
+            return len(self.downloader.queued_emails)
+
+    def _watch(self):
+        while not self._closed:
+            if not self._queued_count():
+                # nothing to wait for until the next release is queued
+                self._wake.wait()
+                self._wake.clear()
+                with self._cond:
+                    self._next_poll = time.monotonic() + self.min_interval
+                continue
+            with self._cond:
+                delay = self._next_poll - time.monotonic()
+            if delay > 0:
+                self._wake.wait(delay)
+                self._wake.clear()
+                continue
+            try:
+                found = self._poll()
+            except Exception as ex:
+                logger.error(f"Could not check email: {ex}")
+                found = 0
+            with self._cond:
+                if found:
+                    self._interval = self.min_interval
+                else:
+                    self._interval = min(
+                        self._interval * self.backoff, self.max_interval
+                    )
+                self._next_poll = time.monotonic() + self._interval
+            logger.debug(f"Checking email again in {self._interval:.1f}s")
+
+    # returns the number of new download emails
+    def _poll(self) -> int:
+        found = 0
+        for inbox, message in self.downloader.inbox_pool.poll():
+            if (
+                message.sender != "noreply@bandcamp.com"
+                or "download" not in message.subject
+            ):
+                continue
+            logger.info(f'Received email "{message.subject}" at {inbox.address}')
+            found += 1
+            with self._cond:
+                self._running += 1
+            self._pool.submit(self._download, inbox, message)
+        return found
+
+    def _download(self, inbox: Inbox, message: MailMessage):
+        album_data = None
+        failed = False
+        try:
+            content = inbox.get_body(message.id)
+            download_url = self.downloader.get_email_download_url(content)
+            if download_url:
+                album_data = self.downloader._download_queued_email(download_url)
+            else:
+                logger.error(f"Could not find download URL in body: {content}")
+                failed = True
+        except Exception as ex:
+            logger.error(f'Could not download from "{message.subject}": {ex}')
+            failed = True
+        retry = False
+        with self._cond:
+            if album_data is not None:
+                self._downloaded.append(album_data)
+            if failed:
+                key = (id(inbox), message.id)
+                self._attempts[key] = self._attempts.get(key, 0) + 1
+                if self._attempts[key] < self.MAX_ATTEMPTS:
+                    retry = True
+                else:
+                    logger.error(f'Giving up on "{message.subject}"')
+                    self._failed += 1
+            self._running -= 1
+            self._cond.notify_all()
+        if retry:
+            self.downloader.inbox_pool.forget(inbox, message)
+            self.notify()
+
+    # give up on the releases left in the queue once only failed emails are
+    # outstanding, their emails can't be told apart
+    def _fail_remaining(self):
+        with self.downloader._queue_lock:
+            remaining = list(self.downloader.queued_emails.items())
+            self.downloader.queued_emails.clear()
+        for key, album_data in remaining:
+            self.downloader.inbox_pool.release(key)
+            logger.error(
+                f"Could not download {album_data['tralbum_data']['url']} "
+                "from its email"
+            )
+        self._failed = 0
+
+    def wait(self) -> List["AlbumInfo"]:
+        """Wait until every queued release has been downloaded and return the
+        ones downloaded since the last call"""
+        with self._cond:
+            while self._running or self._queued_count():
+                if not self._running and self._queued_count() <= self._failed:
+                    self._fail_remaining()
+                    break
+                if self._queued_count():
+                    logger.info(
+                        f"Waiting for {self._queued_count()} emails from Bandcamp..."
+                    )
+                self._cond.wait(30)
+            downloaded, self._downloaded = self._downloaded, []
+        return downloaded
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        # a poll in progress still hands its emails to the pool
+        self._thread.join()
+        self._pool.shutdown()
@@ -0,0 +1,354 @@
+import html
+import json
+import re
+
+from functools import cached_property
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, TypedDict
+
+if TYPE_CHECKING:
+    from bs4 import BeautifulSoup
+
+
+class GridItem(TypedDict):
+    item_id: str
+    band_id: str
+    href: Optional[str]
+    style: str
+
+
+class MusicGrid(TypedDict):
+    items: List[GridItem]
+    client_items: Optional[str]
+
+
+class PageExtractor:
+    """Pulls the handful of blobs the downloader needs out of a Bandcamp page.
+
+    Every method returns the raw (already HTML-unescaped) text of a blob, or
+    None if the page doesn't have it. JSON decoding is left to the caller.
+    """
+
+    def og_type(self) -> Optional[str]:
+        raise NotImplementedError
+
+    # data-tralbum attribute of release pages
+    def tralbum_data(self) -> Optional[str]:
+        raise NotImplementedError
+
+    # ld+json script in the head of release pages
+    def head_data(self) -> Optional[str]:
+        raise NotImplementedError
+
+    # data-band attribute of label pages
+    def band_data(self) -> Optional[str]:
+        raise NotImplementedError
+
+    # data-tralbum-collect-info attribute of purchased release pages
+    def collect_info(self) -> Optional[str]:
+        raise NotImplementedError
+
+    # data-blob attribute of the #pagedata div of download pages
+    def pagedata(self) -> Optional[str]:
+        raise NotImplementedError
+
+    def music_grid(self) -> Optional[MusicGrid]:
+        raise NotImplementedError
+
+    # items of the music grid one by one, without collecting them first
+    def iter_grid_items(self) -> Iterator[GridItem]:
+        grid = self.music_grid()
+        if grid is not None:
+            yield from grid["items"]
+
+    # data-client-items attribute of the music grid
+    def client_items(self) -> Optional[str]:
+        grid = self.music_grid()
+        return grid["client_items"] if grid is not None else None
+
+
+class SoupExtractor(PageExtractor):
+    """Extractor backed by a full BeautifulSoup tree"""
+
+    def __init__(self, soup: "BeautifulSoup"):
+        self.soup = soup
+
+    @classmethod
+    def from_text(cls, text: str) -> "SoupExtractor":
+        from bs4 import BeautifulSoup
+
+        return cls(BeautifulSoup(text, "html.parser"))
+
+    def _script_attr(self, attr: str) -> Optional[str]:
+        script = self.soup.find("script", {attr: True})
+        return script.attrs[attr] if script else None
+
+    def og_type(self) -> Optional[str]:
+        head = self.soup.head
+        meta = head and head.find("meta", attrs={"property": "og:type"})
+        return meta.get("content") if meta else None
+
+    def tralbum_data(self) -> Optional[str]:
+        return self._script_attr("data-tralbum")
+
+    def head_data(self) -> Optional[str]:
+        head = self.soup.head
+        script = head and head.find(
+            "script", {"type": "application/ld+json"}, recursive=False
+        )
+        return script.string if script else None
+
+    def band_data(self) -> Optional[str]:
+        return self._script_attr("data-band")
+
+    def collect_info(self) -> Optional[str]:
+        return self._script_attr("data-tralbum-collect-info")
+
+    def pagedata(self) -> Optional[str]:
+        div = self.soup.find("div", {"id": "pagedata"})
+        return div.attrs.get("data-blob") if div else None
+
+    def music_grid(self) -> Optional[MusicGrid]:
+        grid = self.soup.find("ol", id="music-grid")
+        if grid is None:
+            return None
+        items = []
+        for li in grid.find_all("li"):
+            items.append(
+                {
+                    "item_id": li.get("data-item-id"),
+                    "band_id": li.get("data-band-id"),
+                    "href": li.a["href"] if li.a else None,
+                    "style": li.get("style", ""),
+                }
+            )
+        return {"items": items, "client_items": grid.get("data-client-items")}
+
+
+class FastExtractor(PageExtractor):
+    """Extractor that scans the raw page text for the few tags it needs
+    instead of building a tree. Anything it can't find is looked up again
+    in a BeautifulSoup tree, which is only built on such a miss."""
+
+    # a start tag, allowing '>' inside quoted attribute values
+    TAG_REGEX = re.compile(r"""<([a-zA-Z][a-zA-Z0-9]*)((?:[^>"']|"[^"]*"|'[^']*')*)>""")
+    ATTR_REGEX = re.compile(
+        r"""([^\s"'>/=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'=<>`]+)))?"""
+    )
+    GRID_TAG_REGEX = re.compile(
+        r"""<(li|a)\b((?:[^>"']|"[^"]*"|'[^']*')*)>""", re.IGNORECASE
+    )
+
+    def __init__(self, text: str):
+        self.text = text
+        self._soup_extractor: Optional[SoupExtractor] = None
+
+    def _fallback(self) -> SoupExtractor:
+        if self._soup_extractor is None:
+            self._soup_extractor = SoupExtractor.from_text(self.text)
+        return self._soup_extractor
+
+    @classmethod
+    def _parse_attrs(cls, attrs: str) -> Dict[str, str]:
+        parsed = {}
+        for m in cls.ATTR_REGEX.finditer(attrs):
+            name = m.group(1).lower()
+            if name in parsed:
+                continue
+            value = m.group(2)
+            if value is None:
+                value = m.group(3)
+            if value is None:
+                value = m.group(4) or ""
+            parsed[name] = html.unescape(value)
+        return parsed
+
+    # find the first `tag` start tag that has `attr` (with `value`, if given)
+    # returns the parsed attributes and the end offset of the tag
+    def _find_tag(
+        self, tag: str, attr: str, value: Optional[str] = None, end: int = -1
+    ):
+        text = self.text
+        if end < 0:
+            end = len(text)
+        needle = value if value is not None else attr
+        pos = text.find(needle, 0, end)
+        while pos != -1:
+            start = text.rfind("<", 0, pos)
+            m = self.TAG_REGEX.match(text, start) if start != -1 else None
+            if m and m.end() > pos and m.group(1).lower() == tag:
+                attrs = self._parse_attrs(m.group(2))
+                if attr in attrs and (value is None or attrs[attr] == value):
+                    return attrs, m.end()
+            pos = text.find(needle, pos + len(needle), end)
+        return None, -1
+
+    def _head_end(self) -> int:
+        end = self.text.find("</head>")
+        return end if end != -1 else len(self.text)
+
+    def _script_attr(self, attr: str) -> Optional[str]:
+        attrs, _ = self._find_tag("script", attr)
+        if attrs is None:
+            return self._fallback()._script_attr(attr)
+        return attrs[attr]
+
+    def og_type(self) -> Optional[str]:
+        attrs, _ = self._find_tag("meta", "property", "og:type", self._head_end())
+        if attrs is None:
+            return self._fallback().og_type()
+        return attrs.get("content")
+
+    def tralbum_data(self) -> Optional[str]:
+        return self._script_attr("data-tralbum")
+
+    def head_data(self) -> Optional[str]:
+        attrs, start = self._find_tag(
+            "script", "type", "application/ld+json", self._head_end()
+        )
+        if attrs is None:
+            return self._fallback().head_data()
+        end = self.text.find("</script>", start)
+        if end == -1:
+            return self._fallback().head_data()
+        return self.text[start:end]
+
+    def band_data(self) -> Optional[str]:
+        return self._script_attr("data-band")
+
+    def collect_info(self) -> Optional[str]:
+        return self._script_attr("data-tralbum-collect-info")
+
+    def pagedata(self) -> Optional[str]:
+        attrs, _ = self._find_tag("div", "id", "pagedata")
+        if attrs is None:
+            return self._fallback().pagedata()
+        return attrs.get("data-blob")
+
+    # attributes, start and end offset of the music grid, None if not found
+    def _grid(self):
+        attrs, start = self._find_tag("ol", "id", "music-grid")
+        if attrs is None:
+            return None
+        end = self.text.find("</ol>", start)
+        if end == -1:
+            return None
+        return attrs, start, end
+
+    def music_grid(self) -> Optional[MusicGrid]:
+        grid = self._grid()
+        if grid is None:
+            return self._fallback().music_grid()
+        return {
+            "items": list(self.iter_grid_items()),
+            "client_items": grid[0].get("data-client-items"),
+        }
+
+    def iter_grid_items(self) -> Iterator[GridItem]:
+        grid = self._grid()
+        if grid is None:
+            yield from self._fallback().iter_grid_items()
+            return
+        _, start, end = grid
+
+        item = None
+        for m in self.GRID_TAG_REGEX.finditer(self.text, start, end):
+            tag_attrs = self._parse_attrs(m.group(2))
+            if m.group(1).lower() == "li":
+                if item is not None:
+                    yield item
+                item = {
+                    "item_id": tag_attrs.get("data-item-id"),
+                    "band_id": tag_attrs.get("data-band-id"),
+                    "href": None,
+                    "style": tag_attrs.get("style", ""),
+                }
+            elif item is not None and item["href"] is None:
+                # first link inside the item, like li.a
+                item["href"] = tag_attrs.get("href")
+        if item is not None:
+            yield item
+
+    def client_items(self) -> Optional[str]:
+        grid = self._grid()
+        if grid is None:
+            return self._fallback().client_items()
+        return grid[0].get("data-client-items")
+
+
+EXTRACTORS = {
+    "fast": FastExtractor,
+    "soup": SoupExtractor.from_text,
+}
+
+
+def make_extractor(text: str, backend: str = "fast") -> PageExtractor:
+    if backend not in EXTRACTORS:
+        raise ValueError(
+            f"Unknown page parser {backend!r}, use one of {list(EXTRACTORS)}"
+        )
+    return EXTRACTORS[backend](text)
+
+
+class BandcampPage:
+    """A fetched page whose blobs are extracted and JSON-decoded lazily, at
+    most once each. The parsing helpers of BCFreeDownloader take one of these
+    (or anything `as_page` accepts) so a page can be passed from
+    get_page_info to download_album without being parsed again."""
+
+    def __init__(self, extractor: PageExtractor, url: Optional[str] = None):
+        self.extractor = extractor
+        self.url = url
+
+    @staticmethod
+    def _decode(blob: Optional[str]) -> Optional[Any]:
+        return json.loads(blob) if blob is not None else None
+
+    @cached_property
+    def og_type(self) -> Optional[str]:
+        return self.extractor.og_type()
+
+    @cached_property
+    def tralbum_data(self) -> Optional[Dict]:
+        return self._decode(self.extractor.tralbum_data())
+
+    @cached_property
+    def head_data(self) -> Optional[Dict]:
+        return self._decode(self.extractor.head_data())
+
+    @cached_property
+    def band_data(self) -> Optional[Dict]:
+        return self._decode(self.extractor.band_data())
+
+    @cached_property
+    def collect_info(self) -> Optional[Dict]:
+        return self._decode(self.extractor.collect_info())
+
+    @cached_property
+    def pagedata(self) -> Optional[Dict]:
+        return self._decode(self.extractor.pagedata())
+
+    @cached_property
+    def music_grid(self) -> Optional[MusicGrid]:
+        return self.extractor.music_grid()
+
+    @cached_property
+    def client_items(self) -> List[Dict]:
+        return list(self.iter_client_items())
+
+    # unlike music_grid and client_items these aren't kept, so a label's
+    # releases can be processed without holding all of them in memory
+    def iter_grid_items(self) -> Iterator[GridItem]:
+        return self.extractor.iter_grid_items()
+
+    def iter_client_items(self) -> Iterator[Dict]:
+        blob = self.extractor.client_items()
+        if blob:
+            yield from json.loads(html.unescape(blob))
+
+
+def as_page(page) -> BandcampPage:
+    if isinstance(page, BandcampPage):
+        return page
+    if isinstance(page, PageExtractor):
+        return BandcampPage(page)
+    return BandcampPage(SoupExtractor(page))
@@ -0,0 +1,375 @@
+import os
+import sqlite3
+import threading
+import time
+
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from free_bandcamp_downloader import logger
+
+# same as bc_free_downloader.TralbumId, kept here so the history can be
+# used without importing the downloader
+HistoryId = Tuple[str, object]
+
+SQLITE_MAGIC = b"SQLite format 3\x00"
+
+
+def is_sqlite_file(path: str) -> bool:
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+    except FileNotFoundError:
+        return False
+
+
+def normalize_url(url: str) -> str:
+    """Key of a release url in the history: https, lower case host, no query,
+    fragment or trailing slash, so the same page is found however it's linked"""
+    parts = urlsplit(url.strip())
+    if not parts.netloc:
+        return url.strip()
+    path = parts.path.rstrip("/")
+    return f"https://{parts.netloc.lower()}{path}"
+
+
+def parse_text_history(line: str) -> Optional[HistoryId]:
+    """Parse a line of the old downloaded.txt format: `a:<id>`, `t:<id>` or a url"""
+    line = line.strip()
+    if not line:
+        return None
+    type = line[:2]
+    if type == "a:":
+        return ("album", int(line[2:]))
+    if type == "t:":
+        return ("track", int(line[2:]))
+    return ("url", normalize_url(line))
+
+
+class DownloadHistory:
+    """Download history in a SQLite database indexed by (type, id) and url.
+
+    Lookups are answered by the index instead of loading the whole history.
+    Urls are stored and looked up normalized, see `normalize_url`.
+    Additions are written in batches of `batch_size` (or after `batch_interval`
+    seconds), each in its own transaction, so several processes can share one
+    history. Call `commit()` or `close()` to write out the last batch.
+    """
+
+    def __init__(self, path: str, batch_size: int = 32, batch_interval: float = 5):
+        self.path = path
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self._pending: List[Tuple[str, str, Optional[str], float, Optional[str]]] = []
+        self._pending_keys = set()
+        self._pending_urls: Dict[str, HistoryId] = {}
+        self._last_commit = time.monotonic()
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._transaction():
+            self._db.execute("""CREATE TABLE IF NOT EXISTS downloads (
+                    type TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    url TEXT,
+                    added_at REAL NOT NULL,
+                    digest TEXT,
+                    PRIMARY KEY (type, id)
+                ) WITHOUT ROWID""")
+            columns = self._db.execute("PRAGMA table_info(downloads)").fetchall()
+            if "digest" not in [column[1] for column in columns]:
+                # histories written before digests were recorded
+                self._db.execute("ALTER TABLE downloads ADD COLUMN digest TEXT")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS downloads_url ON downloads (url)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            # snapshots of watched label pages, see watch.LabelWatch
+            self._db.execute("""CREATE TABLE IF NOT EXISTS labels (
+                    url TEXT PRIMARY KEY,
+                    first_checked_at REAL NOT NULL,
+                    checked_at REAL NOT NULL,
+                    next_check_at REAL
+                )""")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS label_releases (
+                    label TEXT NOT NULL,
+                    type TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    url TEXT,
+                    first_seen_at REAL NOT NULL,
+                    done INTEGER NOT NULL,
+                    PRIMARY KEY (label, type, id)
+                ) WITHOUT ROWID""")
+            if self._get_meta("normalized-urls") is None:
+                self._normalize_urls()
+
+    # histories written before urls were normalized
+    def _normalize_urls(self):
+        rows = self._db.execute(
+            "SELECT type, id, url FROM downloads WHERE url IS NOT NULL OR type = 'url'"
+        ).fetchall()
+        for type, id, url in rows:
+            if type == "url":
+                self._db.execute(
+                    "UPDATE OR IGNORE downloads SET id = ? "
+                    "WHERE type = 'url' AND id = ?",
+                    (normalize_url(id), id),
+                )
+            elif url is not None:
+                self._db.execute(
+                    "UPDATE downloads SET url = ? WHERE type = ? AND id = ?",
+                    (normalize_url(url), type, id),
+                )
+        self._db.execute("INSERT OR REPLACE INTO meta VALUES ('normalized-urls', '1')")
+
+    @classmethod
+    def open(cls, history_file: str, **kwargs) -> "DownloadHistory":
+        """Open the history for `history_file`.
+
+        A SQLite file (or a path ending in .sqlite3/.db) is used directly. For
+        a downloaded.txt style text file the database lives next to it in
+        `<history_file>.sqlite3`, and lines of the text file that haven't been
+        imported yet are imported first.
+        """
+        if is_sqlite_file(history_file) or history_file.endswith((".sqlite3", ".db")):
+            return cls(history_file, **kwargs)
+        history = cls(history_file + ".sqlite3", **kwargs)
+        if os.path.exists(history_file):
+            history.import_text(history_file)
+        return history
+
+    def _transaction(self):
+        db = self._db
+
+        class Transaction:
+            def __enter__(self):
+                # take the write lock up front so concurrent writers queue
+                # instead of failing with SQLITE_BUSY on upgrade
+                db.execute("BEGIN IMMEDIATE")
+
+            def __exit__(self, exc_type, exc, tb):
+                db.execute("ROLLBACK" if exc_type else "COMMIT")
+
+        return Transaction()
+
+    @staticmethod
+    def _key(id: HistoryId) -> Tuple[str, str]:
+        return (id[0], str(id[1]))
+
+    def is_downloaded(self, id: Optional[HistoryId], url: Optional[str] = None) -> bool:
+        with self._lock:
+            if id is not None:
+                key = self._key(id)
+                if key in self._pending_keys:
+                    return True
+                row = self._db.execute(
+                    "SELECT url FROM downloads WHERE type = ? AND id = ?", key
+                ).fetchone()
+                if row is not None:
+                    if row[0] is None and url is not None:
+                        # ids imported from downloaded.txt have no url, record
+                        # it so find_url skips the page on the next run
+                        with self._transaction():
+                            self._db.execute(
+                                "UPDATE downloads SET url = ? "
+                                "WHERE type = ? AND id = ? AND url IS NULL",
+                                (normalize_url(url), *key),
+                            )
+                    return True
+            if url is not None:
+                return self.find_url(url) is not None
+            return False
+
+    def find_url(self, url: str) -> Optional[HistoryId]:
+        """Id of the downloaded release at `url`, None if it isn't in the history"""
+        url = normalize_url(url)
+        with self._lock:
+            if url in self._pending_urls:
+                return self._pending_urls[url]
+            if ("url", url) in self._pending_keys:
+                return ("url", url)
+            row = self._db.execute(
+                "SELECT type, id FROM downloads WHERE url = ? UNION ALL "
+                "SELECT type, id FROM downloads WHERE type = 'url' AND id = ? LIMIT 1",
+                (url, url),
+            ).fetchone()
+        if row is None:
+            return None
+        type, id = row
+        return (type, int(id) if type != "url" else id)
+
+    def digest(self, id: HistoryId) -> Optional[str]:
+        """Digest recorded for the release, None if there is none"""
+        self.commit()
+        row = self._db.execute(
+            "SELECT digest FROM downloads WHERE type = ? AND id = ?", self._key(id)
+        ).fetchone()
+        return row[0] if row else None
+
+    def __contains__(self, id: HistoryId) -> bool:
+        return self.is_downloaded(id)
+
+    def add(
+        self, id: HistoryId, url: Optional[str] = None, digest: Optional[str] = None
+    ):
+        """Record a downloaded release, with the `<algorithm>:<hex digest>` of
+        its file if known"""
+        with self._lock:
+            key = self._key(id)
+            if url is not None:
+                url = normalize_url(url)
+                self._pending_urls[url] = id
+            self._pending.append((key[0], key[1], url, time.time(), digest))
+            self._pending_keys.add(key)
+            if (
+                len(self._pending) >= self.batch_size
+                or time.monotonic() - self._last_commit >= self.batch_interval
+            ):
+                self.commit()
+
+    def commit(self):
+        with self._lock:
+            if self._pending:
+                with self._transaction():
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO downloads "
+                        "(type, id, url, added_at, digest) VALUES (?, ?, ?, ?, ?)",
+                        self._pending,
+                    )
+                self._pending = []
+                self._pending_keys = set()
+                self._pending_urls = {}
+            self._last_commit = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self.commit()
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self) -> Iterator[HistoryId]:
+        self.commit()
+        for type, id in self._db.execute("SELECT type, id FROM downloads"):
+            yield (type, int(id) if type != "url" else id)
+
+    def __len__(self) -> int:
+        self.commit()
+        return self._db.execute("SELECT COUNT(*) FROM downloads").fetchone()[0]
+
+    def label_snapshot(self, label_url: str) -> Dict[HistoryId, bool]:
+        """Releases seen on a watched label page, and whether each of them
+        was taken care of"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT type, id, done FROM label_releases WHERE label = ?",
+                (normalize_url(label_url),),
+            ).fetchall()
+        return {(type, int(id)): bool(done) for type, id, done in rows}
+
+    def label_next_check(self, label_url: str) -> Optional[float]:
+        """When a watched label is due for a check, None if it never was
+        checked"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT next_check_at FROM labels WHERE url = ?",
+                (normalize_url(label_url),),
+            ).fetchone()
+        return row[0] if row else None
+
+    def update_label(
+        self,
+        label_url: str,
+        releases: Iterable[Tuple[HistoryId, str, bool]],
+        checked_at: float,
+    ) -> Tuple[float, int]:
+        """Add the `(id, url, done)` releases seen on a check of a watched
+        label to its snapshot. Releases stay done once they are. Returns when
+        the label was first checked and how many releases it has published
+        since then."""
+        label = normalize_url(label_url)
+        with self._lock, self._transaction():
+            self._db.executemany(
+                "INSERT INTO label_releases (label, type, id, url, first_seen_at, done) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (label, type, id) DO UPDATE SET "
+                "url = excluded.url, done = MAX(done, excluded.done)",
+                [
+                    (label, id[0], str(id[1]), url, checked_at, int(done))
+                    for id, url, done in releases
+                ],
+            )
+            self._db.execute(
+                "INSERT INTO labels (url, first_checked_at, checked_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (url) DO UPDATE SET checked_at = excluded.checked_at",
+                (label, checked_at, checked_at),
+            )
+            (first_checked_at,) = self._db.execute(
+                "SELECT first_checked_at FROM labels WHERE url = ?", (label,)
+            ).fetchone()
+            (published,) = self._db.execute(
+                "SELECT COUNT(*) FROM label_releases "
+                "WHERE label = ? AND first_seen_at > ?",
+                (label, first_checked_at),
+            ).fetchone()
+        return first_checked_at, published
+
+    def schedule_label(self, label_url: str, next_check_at: float):
+        with self._lock, self._transaction():
+            self._db.execute(
+                "UPDATE labels SET next_check_at = ? WHERE url = ?",
+                (next_check_at, normalize_url(label_url)),
+            )
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        row = self._db.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def import_text(self, path: str) -> int:
+        """Import the lines of a downloaded.txt style history that were added
+        since the last import. Returns the number of imported lines."""
+        meta_key = f"imported:{os.path.abspath(path)}"
+        with self._lock:
+            self.commit()
+            with self._transaction():
+                offset = int(self._get_meta(meta_key) or 0)
+                if os.path.getsize(path) < offset:
+                    # the file was rewritten, start over
+                    offset = 0
+                count = 0
+                now = time.time()
+                with open(path, "rb") as f:
+                    f.seek(offset)
+                    rows = []
+                    for raw in f:
+                        if not raw.endswith(b"\n"):
+                            # a line that is still being written
+                            break
+                        offset += len(raw)
+                        id = parse_text_history(raw.decode())
+                        if id is None:
+                            continue
+                        rows.append((id[0], str(id[1]), None, now))
+                        count += 1
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO downloads (type, id, url, added_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+                self._db.execute(
+                    "INSERT OR REPLACE INTO meta VALUES (?, ?)", (meta_key, str(offset))
+                )
+        if count:
+            logger.info(f"Imported {count} entries from {path} into {self.path}")
+        return count
@@ -0,0 +1,197 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+import requests
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    revalidated: int = 0
+    misses: int = 0
+    stored: int = 0
+    evicted: int = 0
+
+    def __str__(self):
+        lookups = self.hits + self.revalidated + self.misses
+        return (
+            f"{self.hits} hits, {self.revalidated} revalidated, "
+            f"{self.misses} misses of {lookups} lookups, "
+            f"{self.stored} stored, {self.evicted} evicted"
+        )
+
+
+@dataclass
+class CacheEntry:
+    url: str
+    file: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    encoding: Optional[str]
+    content_type: Optional[str]
+    stored_at: float
+    size: int
+
+
+class HTTPCache:
+    """Persistent cache for page GET requests.
+
+    Bodies are stored as files next to a SQLite index keyed by URL. Entries
+    younger than `ttl` seconds are served without a request, older ones are
+    revalidated with If-None-Match/If-Modified-Since when the server sent an
+    ETag or Last-Modified. The least recently used entries are evicted once
+    the bodies take up more than `max_size` bytes.
+    """
+
+    def __init__(self, path: str, ttl: float = 3600, max_size: int = 256 * 1024**2):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.stats = CacheStats()
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(path, "index.sqlite3"), check_same_thread=False
+        )
+        self._db.execute("""CREATE TABLE IF NOT EXISTS entries (
+                url TEXT PRIMARY KEY,
+                file TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                encoding TEXT,
+                content_type TEXT,
+                stored_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                size INTEGER NOT NULL
+            )""")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)"
+        )
+        self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _lookup(self, url: str) -> Optional[CacheEntry]:
+        row = self._db.execute(
+            "SELECT url, file, etag, last_modified, encoding, content_type, "
+            "stored_at, size FROM entries WHERE url = ?",
+            (url,),
+        ).fetchone()
+        if row is None:
+            return None
+        entry = CacheEntry(*row)
+        if not os.path.exists(os.path.join(self.path, entry.file)):
+            self._delete(entry)
+            return None
+        return entry
+
+    def _delete(self, entry: CacheEntry):
+        self._db.execute("DELETE FROM entries WHERE url = ?", (entry.url,))
+        try:
+            os.remove(os.path.join(self.path, entry.file))
+        except FileNotFoundError:
+            pass
+
+    def _response(self, entry: CacheEntry) -> requests.Response:
+        r = requests.Response()
+        with open(os.path.join(self.path, entry.file), "rb") as f:
+            r._content = f.read()
+        r.status_code = 200
+        r.url = entry.url
+        r.encoding = entry.encoding
+        if entry.content_type:
+            r.headers["Content-Type"] = entry.content_type
+        r.headers["X-Cache"] = "HIT"
+        return r
+
+    def _touch(self, entry: CacheEntry, revalidated: bool = False):
+        now = time.time()
+        if revalidated:
+            self._db.execute(
+                "UPDATE entries SET stored_at = ?, accessed_at = ? WHERE url = ?",
+                (now, now, entry.url),
+            )
+        else:
+            self._db.execute(
+                "UPDATE entries SET accessed_at = ? WHERE url = ?", (now, entry.url)
+            )
+        self._db.commit()
+
+    def _store(self, url: str, r: requests.Response):
+        file = hashlib.sha256(url.encode()).hexdigest() + ".body"
+        tmp = os.path.join(self.path, file + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(r.content)
+        os.replace(tmp, os.path.join(self.path, file))
+        now = time.time()
+        self._db.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                url,
+                file,
+                r.headers.get("ETag"),
+                r.headers.get("Last-Modified"),
+                r.encoding,
+                r.headers.get("Content-Type"),
+                now,
+                now,
+                len(r.content),
+            ),
+        )
+        self.stats.stored += 1
+        self._evict()
+        self._db.commit()
+
+    def _evict(self):
+        total = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()[0]
+        if total <= self.max_size:
+            return
+        rows = self._db.execute(
+            "SELECT url, file, size FROM entries ORDER BY accessed_at"
+        ).fetchall()
+        for url, file, size in rows:
+            if total <= self.max_size:
+                break
+            self._delete(CacheEntry(url, file, None, None, None, None, 0, size))
+            total -= size
+            self.stats.evicted += 1
+
+    def get(
+        self, get: Callable[..., requests.Response], url: str, **kwargs
+    ) -> requests.Response:
+        """GET `url` with `get` (e.g. `session.get`), answering from the cache
+        if possible"""
+        with self._lock:
+            entry = self._lookup(url)
+            if entry is not None and time.time() - entry.stored_at < self.ttl:
+                self.stats.hits += 1
+                self._touch(entry)
+                return self._response(entry)
+
+        headers: Dict[str, str] = dict(kwargs.pop("headers", None) or {})
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        r = get(url, headers=headers, **kwargs)
+
+        with self._lock:
+            if r.status_code == 304 and entry is not None:
+                self.stats.revalidated += 1
+                self._touch(entry, revalidated=True)
+                return self._response(entry)
+            self.stats.misses += 1
+            if r.status_code == 200:
+                self._store(url, r)
+        return r
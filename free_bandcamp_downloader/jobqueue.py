@@ -0,0 +1,404 @@
+import json
+import os
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from free_bandcamp_downloader import logger
+from free_bandcamp_downloader.history import HistoryId, normalize_url
+
+if TYPE_CHECKING:
+    from free_bandcamp_downloader.bc_free_downloader import (
+        AlbumInfo,
+        LabelReleaseInfo,
+    )
+
+# states of a job, in the order a release moves through them
+DISCOVERED = "discovered"
+RESOLVED = "resolved"
+DOWNLOADING = "downloading"
+AWAITING_EMAIL = "awaiting-email"
+POST_PROCESSING = "post-processing"
+DONE = "done"
+FAILED = "failed"
+
+# a worker that stopped in one of these didn't get to finish the job
+IN_FLIGHT = (RESOLVED, DOWNLOADING, AWAITING_EMAIL)
+TERMINAL = (DONE, FAILED)
+
+
+def read_urls(path: str) -> Iterator[str]:
+    """Urls in a file, one per line, or in stdin if `path` is `-`. Empty
+    lines and lines starting with `#` are skipped."""
+    f = sys.stdin if path == "-" else open(path)
+    try:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+class JobQueue:
+    """A batch of urls to download in a SQLite database, so a run that
+    crashed or was interrupted can be resumed by running it again.
+
+    Every input url and every release found on a label page is a job,
+    deduplicated by its normalized url (see `history.normalize_url`), that
+    moves from DISCOVERED through RESOLVED, DOWNLOADING or AWAITING_EMAIL
+    and POST_PROCESSING to DONE or FAILED. Each state is committed as soon as
+    it is reached. Jobs that failed are tried again by up to `max_attempts`
+    runs.
+
+    Several workers (processes, also on other machines if the file system
+    locks SQLite files properly) can share one queue. A worker `claim`s the
+    jobs it works on, and the releases it downloads with `claim_release`,
+    with a lease of `lease` seconds that a background thread renews while
+    the worker is alive. Leases that ran out belong to workers that died,
+    as do those of workers on this machine whose process is gone:
+    `reclaim()` puts their jobs in flight back to DISCOVERED, where their
+    files are resumed from their `.part` files, and takes over the ones that
+    were downloaded but not post-processed yet. `close()` gives back the
+    claims of this worker right away.
+
+    Without a `path`, the queue lives in a temporary file that is deleted
+    on `close()`.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_attempts: int = 3,
+        lease: float = 300,
+        worker: Optional[str] = None,
+    ):
+        self.temporary = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="bcdl-queue-", suffix=".sqlite3")
+            os.close(fd)
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.worker = worker or (
+            f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        )
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._transaction():
+            self._db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                    seq INTEGER PRIMARY KEY,
+                    key TEXT NOT NULL UNIQUE,
+                    url TEXT NOT NULL,
+                    label TEXT,
+                    state TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL,
+                    post TEXT,
+                    owner TEXT,
+                    lease_until REAL
+                )""")
+            columns = self._db.execute("PRAGMA table_info(jobs)").fetchall()
+            if "owner" not in [column[1] for column in columns]:
+                # queues written before they could be shared
+                self._db.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+                self._db.execute("ALTER TABLE jobs ADD COLUMN lease_until REAL")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, seq)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner)")
+            # releases being downloaded, so a release that several jobs lead
+            # to is downloaded by one worker
+            self._db.execute("""CREATE TABLE IF NOT EXISTS releases (
+                    type TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    owner TEXT NOT NULL,
+                    lease_until REAL NOT NULL,
+                    PRIMARY KEY (type, id)
+                ) WITHOUT ROWID""")
+        self._stop = threading.Event()
+        self._renewer = threading.Thread(
+            target=self._renew_leases, name="bcdl-lease", daemon=True
+        )
+        self._renewer.start()
+
+    def _transaction(self):
+        db = self._db
+
+        class Transaction:
+            def __enter__(self):
+                db.execute("BEGIN IMMEDIATE")
+
+            def __exit__(self, exc_type, exc, tb):
+                db.execute("ROLLBACK" if exc_type else "COMMIT")
+
+        return Transaction()
+
+    def add(self, urls: Iterable[str], label: Optional[str] = None) -> int:
+        """Add the urls that aren't in the queue yet, returns how many were
+        added"""
+        now = time.time()
+        rows = [
+            (normalize_url(url), url.strip(), label, DISCOVERED, now) for url in urls
+        ]
+        with self._lock, self._transaction():
+            before = self._db.total_changes
+            self._db.executemany(
+                "INSERT OR IGNORE INTO jobs (key, url, label, state, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            return self._db.total_changes - before
+
+    def filter_releases(
+        self, label_url: str, releases: Iterable["LabelReleaseInfo"]
+    ) -> Iterator["LabelReleaseInfo"]:
+        """Add the releases of a label page as jobs and yield the ones that
+        still have to be downloaded, claimed for this worker. Releases that
+        are jobs of this worker already are left to those jobs."""
+        for release in releases:
+            self.add([release["url"]], label=normalize_url(label_url))
+            now = time.time()
+            with self._lock:
+                claimed = self._db.execute(
+                    "UPDATE jobs SET owner = ?, lease_until = ? "
+                    "WHERE key = ? AND state = ? "
+                    "AND (owner IS NULL OR lease_until < ?)",
+                    (
+                        self.worker,
+                        now + self.lease,
+                        normalize_url(release["url"]),
+                        DISCOVERED,
+                        now,
+                    ),
+                ).rowcount
+            if claimed:
+                yield release
+
+    def set_state(self, url: str, state: str, album_info: Optional["AlbumInfo"] = None):
+        """Move the job of `url` to `state`. The downloaded release is kept
+        with POST_PROCESSING, so post-processing can be finished by a later
+        run."""
+        post = None
+        if state == POST_PROCESSING and album_info is not None:
+            current = album_info["tralbum_data"]["current"]
+            post = json.dumps(
+                {
+                    "id": [current["type"], current["id"]],
+                    "url": album_info["tralbum_data"]["url"],
+                    "file_name": album_info["file_name"],
+                    "files": album_info.get("files"),
+                    "digest": album_info.get("digest"),
+                    "head_data": album_info["head_data"],
+                }
+            )
+        now = time.time()
+        # finished jobs aren't anyone's anymore
+        owner = None if state in TERMINAL else self.worker
+        lease_until = None if state in TERMINAL else now + self.lease
+        with self._lock:
+            updated = self._db.execute(
+                "UPDATE jobs SET state = ?, updated_at = ?, post = ?, "
+                "attempts = attempts + ?, owner = ?, lease_until = ? "
+                "WHERE key = ? AND (owner IS NULL OR owner = ?)",
+                (
+                    state,
+                    now,
+                    post,
+                    int(state == FAILED),
+                    owner,
+                    lease_until,
+                    normalize_url(url),
+                    self.worker,
+                ),
+            ).rowcount
+        if not updated:
+            logger.warning(f"{url} was taken over by another worker")
+
+    def retry_failed(self) -> int:
+        """Put the jobs that failed fewer than `max_attempts` times back to
+        DISCOVERED, returns how many there were"""
+        with self._lock, self._transaction():
+            retried = self._db.execute(
+                "UPDATE jobs SET state = ? WHERE state = ? AND attempts < ?",
+                (DISCOVERED, FAILED, self.max_attempts),
+            ).rowcount
+        if retried:
+            logger.info(f"Retrying {retried} failed jobs")
+        return retried
+
+    def _expire_dead_workers(self):
+        # workers on this machine are known dead without waiting for their
+        # leases, e.g. the run before this one that crashed
+        host = socket.gethostname()
+        with self._lock:
+            owners = [
+                owner
+                for (owner,) in self._db.execute(
+                    "SELECT DISTINCT owner FROM jobs WHERE owner IS NOT NULL"
+                )
+            ]
+        for owner in owners:
+            parts = owner.rsplit(":", 2)
+            # only workers named host:pid:... can be checked
+            if len(parts) != 3 or not parts[1].isdigit():
+                continue
+            if owner == self.worker or parts[0] != host:
+                continue
+            try:
+                os.kill(int(parts[1]), 0)
+            except ProcessLookupError:
+                with self._lock, self._transaction():
+                    self._db.execute(
+                        "UPDATE jobs SET lease_until = 0 WHERE owner = ?", (owner,)
+                    )
+                    self._db.execute("DELETE FROM releases WHERE owner = ?", (owner,))
+            except OSError:
+                # alive but not ours to signal
+                pass
+
+    def reclaim(self) -> List[Tuple[str, Dict]]:
+        """Make the jobs of workers that stopped without finishing them
+        available again. Returns the url and release of each of their jobs
+        that was downloaded but not post-processed, now claimed by this
+        worker."""
+        self._expire_dead_workers()
+        now = time.time()
+        expired = "(owner IS NULL OR lease_until < ?)"
+        with self._lock, self._transaction():
+            reset = self._db.execute(
+                "UPDATE jobs SET state = ?, owner = NULL, lease_until = NULL "
+                f"WHERE state IN ({', '.join('?' * len(IN_FLIGHT))}) AND {expired}",
+                (DISCOVERED, *IN_FLIGHT, now),
+            ).rowcount
+            rows = self._db.execute(
+                f"SELECT seq, url, post FROM jobs WHERE state = ? AND {expired} "
+                "ORDER BY seq",
+                (POST_PROCESSING, now),
+            ).fetchall()
+            self._db.executemany(
+                "UPDATE jobs SET owner = ?, lease_until = ? WHERE seq = ?",
+                [(self.worker, now + self.lease, seq) for seq, _, _ in rows],
+            )
+        if reset or rows:
+            logger.info(
+                f"Taking over {reset} interrupted and {len(rows)} downloaded jobs"
+            )
+        return [(url, json.loads(post)) for _, url, post in rows]
+
+    def claim(self, size: int) -> List[str]:
+        """Claim up to `size` jobs that no worker has started yet, in the
+        order they were added, and return their urls"""
+        now = time.time()
+        with self._lock, self._transaction():
+            rows = self._db.execute(
+                "SELECT seq, url FROM jobs WHERE state = ? "
+                "AND (owner IS NULL OR lease_until < ?) ORDER BY seq LIMIT ?",
+                (DISCOVERED, now, size),
+            ).fetchall()
+            self._db.executemany(
+                "UPDATE jobs SET owner = ?, lease_until = ? WHERE seq = ?",
+                [(self.worker, now + self.lease, seq) for seq, _ in rows],
+            )
+        return [url for _, url in rows]
+
+    def claim_release(self, id: HistoryId) -> bool:
+        """Claim a release for this worker to download, False if another
+        worker is downloading it"""
+        now = time.time()
+        with self._lock:
+            return bool(
+                self._db.execute(
+                    "INSERT INTO releases (type, id, owner, lease_until) "
+                    "VALUES (?, ?, ?, ?) ON CONFLICT (type, id) DO UPDATE SET "
+                    "owner = excluded.owner, lease_until = excluded.lease_until "
+                    "WHERE owner = excluded.owner OR lease_until < ?",
+                    (id[0], str(id[1]), self.worker, now + self.lease, now),
+                ).rowcount
+            )
+
+    def finish_release(self, id: HistoryId):
+        """Give up the claim on a release this worker is done with"""
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM releases WHERE type = ? AND id = ? AND owner = ?",
+                (id[0], str(id[1]), self.worker),
+            )
+
+    def in_flight_elsewhere(self) -> int:
+        """Number of unfinished jobs other workers hold leases on"""
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE owner IS NOT NULL AND owner != ? "
+                "AND lease_until >= ?",
+                (self.worker, time.time()),
+            ).fetchone()[0]
+
+    def renew(self):
+        lease_until = time.time() + self.lease
+        with self._lock, self._transaction():
+            self._db.execute(
+                "UPDATE jobs SET lease_until = ? WHERE owner = ?",
+                (lease_until, self.worker),
+            )
+            self._db.execute(
+                "UPDATE releases SET lease_until = ? WHERE owner = ?",
+                (lease_until, self.worker),
+            )
+
+    def _renew_leases(self):
+        # a few renewals per lease, so a slow one doesn't let it run out
+        while not self._stop.wait(self.lease / 3):
+            try:
+                self.renew()
+            except sqlite3.Error as ex:
+                logger.error(f"Could not renew the leases of {self.worker}: {ex}")
+
+    def release(self):
+        """Give back the claims of this worker, its jobs in flight are
+        started over by whoever claims them next"""
+        with self._lock, self._transaction():
+            self._db.execute(
+                "UPDATE jobs SET state = ? WHERE owner = ? "
+                f"AND state IN ({', '.join('?' * len(IN_FLIGHT))})",
+                (DISCOVERED, self.worker, *IN_FLIGHT),
+            )
+            self._db.execute(
+                "UPDATE jobs SET owner = NULL, lease_until = NULL WHERE owner = ?",
+                (self.worker,),
+            )
+            self._db.execute("DELETE FROM releases WHERE owner = ?", (self.worker,))
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(
+                self._db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state")
+            )
+
+    def close(self):
+        self._stop.set()
+        self._renewer.join()
+        with self._lock:
+            self.release()
+            self._db.close()
+        if self.temporary:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(self.path + suffix):
+                    os.remove(self.path + suffix)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,182 @@
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, Hashable, List, Optional, Set, Tuple
+
+from free_bandcamp_downloader import logger
+
+if TYPE_CHECKING:
+    from guerrillamail import GuerrillaMailSession
+
+
+@dataclass
+class MailMessage:
+    id: str
+    sender: str
+    subject: str
+
+
+class Inbox:
+    """A disposable mail address that can be read"""
+
+    address: str
+
+    def list_messages(self) -> List[MailMessage]:
+        """The messages in the inbox, or only the ones that arrived since the
+        last call"""
+        raise NotImplementedError
+
+    def get_body(self, id: str) -> str:
+        raise NotImplementedError
+
+
+class MailProvider:
+    """Creates inboxes. Implement this (and Inbox) to receive the download
+    emails through another service, or a local stand-in for testing."""
+
+    def new_inbox(self) -> Inbox:
+        raise NotImplementedError
+
+
+class GuerrillaInbox(Inbox):
+    # messages listed at a time
+    PAGE_SIZE = 20
+
+    def __init__(self, session: "GuerrillaMailSession"):
+        self.session = session
+        # sessions aren't thread safe
+        self._lock = threading.Lock()
+        with self._lock:
+            self.address = session.get_session_state()["email_address"]
+        # id of the newest message listed so far
+        self._newest = 0
+
+    def list_messages(self) -> List[MailMessage]:
+        """The messages that arrived since the last call"""
+        emails = []
+        with self._lock:
+            # the list is newest first, one page at a time, so older pages are
+            # only needed while a full page has no message listed before
+            while True:
+                page = self.session.get_email_list(offset=len(emails))
+                listed = {email.guid for email in emails}
+                new = [
+                    email
+                    for email in page
+                    if int(email.guid) > self._newest and email.guid not in listed
+                ]
+                emails += new
+                if len(new) < len(page) or len(page) < self.PAGE_SIZE:
+                    break
+            if emails:
+                self._newest = max(int(email.guid) for email in emails)
+        return [
+            MailMessage(email.guid, email.sender, email.subject) for email in emails
+        ]
+
+    def get_body(self, id: str) -> str:
+        with self._lock:
+            return self.session.get_email(id).body
+
+
+class GuerrillaMailProvider(MailProvider):
+    """Inboxes from guerrillamail.com, or a server with the same API at
+    `base_url`"""
+
+    def __init__(self, base_url: Optional[str] = None):
+        self.base_url = base_url
+
+    def new_inbox(self) -> GuerrillaInbox:
+        from guerrillamail import GuerrillaMailSession
+
+        kwargs = {"base_url": self.base_url} if self.base_url else {}
+        return GuerrillaInbox(GuerrillaMailSession(**kwargs))
+
+
+class InboxPool:
+    """Spreads email-gated releases over up to `size` inboxes of `provider`,
+    so no single address gets all of a label's download emails.
+
+    Inboxes are created as they are needed. `address_for(key)` picks the
+    inbox with the fewest outstanding emails and remembers it for `key`
+    until `release(key)`. `poll()` checks every inbox that still expects
+    mail concurrently and returns the messages it hasn't returned before,
+    and the ones given back with `forget`.
+    """
+
+    def __init__(self, provider: MailProvider, size: int = 1):
+        self.provider = provider
+        self.size = max(size, 1)
+        self.inboxes: List[Inbox] = []
+        # key -> inbox the email for it was sent to
+        self.assigned: Dict[Hashable, Inbox] = {}
+        self._pending: Dict[int, int] = {}
+        self._seen: Set[Tuple[int, str]] = set()
+        self._retry: List[Tuple[Inbox, MailMessage]] = []
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=self.size)
+
+    def _new_inbox(self) -> Inbox:
+        inbox = self.provider.new_inbox()
+        self.inboxes.append(inbox)
+        self._pending[id(inbox)] = 0
+        return inbox
+
+    @property
+    def address(self) -> str:
+        """Address of the first inbox"""
+        with self._lock:
+            if not self.inboxes:
+                self._new_inbox()
+            return self.inboxes[0].address
+
+    def address_for(self, key: Hashable) -> str:
+        with self._lock:
+            if key in self.assigned:
+                return self.assigned[key].address
+            idle = [i for i in self.inboxes if self._pending[id(i)] == 0]
+            if not idle and len(self.inboxes) < self.size:
+                inbox = self._new_inbox()
+            else:
+                inbox = min(self.inboxes, key=lambda i: self._pending[id(i)])
+            self.assigned[key] = inbox
+            self._pending[id(inbox)] += 1
+            return inbox.address
+
+    def release(self, key: Hashable):
+        with self._lock:
+            inbox = self.assigned.pop(key, None)
+            if inbox is not None:
+                self._pending[id(inbox)] -= 1
+
+    @staticmethod
+    def _list_messages(inbox: Inbox) -> List[MailMessage]:
+        try:
+            return inbox.list_messages()
+        except Exception as ex:
+            logger.error(f"Could not check email of {inbox.address}: {ex}")
+            return []
+
+    def poll(self) -> List[Tuple[Inbox, MailMessage]]:
+        with self._lock:
+            waiting = [i for i in self.inboxes if self._pending[id(i)] > 0]
+            new, self._retry = self._retry, []
+        polled = self._pool.map(self._list_messages, waiting)
+        for inbox, messages in zip(waiting, polled):
+            for message in messages:
+                seen_key = (id(inbox), message.id)
+                if seen_key in self._seen:
+                    continue
+                self._seen.add(seen_key)
+                new.append((inbox, message))
+        return new
+
+    def forget(self, inbox: Inbox, message: MailMessage):
+        """Return `message` from the next `poll()` again, to retry it. Inboxes
+        may not list it again."""
+        with self._lock:
+            self._retry.append((inbox, message))
+
+    def close(self):
+        self._pool.shutdown()
@@ -0,0 +1,166 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+@dataclass
+class StageMetrics:
+    count: int = 0
+    errors: int = 0
+    # summed over all calls, so with concurrent jobs this can be longer
+    # than the run
+    seconds: float = 0
+    max_seconds: float = 0
+    bytes: int = 0
+    # calls per bucket of LATENCY_BUCKETS, the last one is for slower calls
+    buckets: List[int] = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+
+    def observe(self, seconds: float, error: bool = False):
+        self.count += 1
+        self.errors += error
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    # bytes per second spent in this stage
+    @property
+    def throughput(self) -> float:
+        return self.bytes / self.seconds if self.seconds else 0
+
+    def to_dict(self) -> Dict:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "seconds": self.seconds,
+            "mean_seconds": self.seconds / self.count if self.count else 0,
+            "max_seconds": self.max_seconds,
+            "bytes": self.bytes,
+            "throughput": self.throughput,
+            "latency_buckets": {
+                str(le): n for le, n in zip(LATENCY_BUCKETS + ("+Inf",), self.buckets)
+            },
+        }
+
+    def __str__(self):
+        s = f"{self.count} in {self.seconds:.1f}s"
+        if self.errors:
+            s += f", {self.errors} failed"
+        if self.bytes:
+            s += (
+                f", {self.bytes / 1024**2:.1f} MiB at "
+                f"{self.throughput / 1024**2:.1f} MiB/s"
+            )
+        return s
+
+
+class Metrics:
+    """Counts, latencies and bytes of every stage of a run: page fetches
+    ("fetch"), page parsing ("parse"), download link resolution ("resolve"),
+    file transfers ("transfer"), waiting for emails ("email"), unzipping
+    ("unzip") and tagging ("tag").
+
+    Written at the end of a run as a JSON report with `write_json`, or in the
+    Prometheus text format with `write_prometheus` for node_exporter's
+    textfile collector.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.stages: Dict[str, StageMetrics] = {}
+        self._lock = threading.Lock()
+
+    def _stage(self, stage: str) -> StageMetrics:
+        if stage not in self.stages:
+            self.stages[stage] = StageMetrics()
+        return self.stages[stage]
+
+    def observe(self, stage: str, seconds: float, bytes: int = 0, error: bool = False):
+        with self._lock:
+            metrics = self._stage(stage)
+            metrics.observe(seconds, error)
+            metrics.bytes += bytes
+
+    def add_bytes(self, stage: str, bytes: int):
+        with self._lock:
+            self._stage(stage).bytes += bytes
+
+    @contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        """Time the block as one call of `stage`, failed if it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.observe(stage, time.perf_counter() - start, error=True)
+            raise
+        self.observe(stage, time.perf_counter() - start)
+
+    def report(self) -> Dict:
+        with self._lock:
+            return {
+                "started_at": self.started_at,
+                "elapsed": time.time() - self.started_at,
+                "stages": {
+                    name: stage.to_dict() for name, stage in self.stages.items()
+                },
+            }
+
+    def prometheus(self) -> str:
+        report = self.report()
+        lines = [
+            "# HELP bcdl_run_duration_seconds Duration of the run",
+            "# TYPE bcdl_run_duration_seconds gauge",
+            f"bcdl_run_duration_seconds {report['elapsed']}",
+            "# HELP bcdl_stage_duration_seconds Latency of the calls of a stage",
+            "# TYPE bcdl_stage_duration_seconds histogram",
+        ]
+        for name, stage in report["stages"].items():
+            total = 0
+            for le, n in stage["latency_buckets"].items():
+                total += n
+                lines.append(
+                    f'bcdl_stage_duration_seconds_bucket{{stage="{name}",le="{le}"}} '
+                    f"{total}"
+                )
+            lines.append(
+                f'bcdl_stage_duration_seconds_sum{{stage="{name}"}} {stage["seconds"]}'
+            )
+            lines.append(
+                f'bcdl_stage_duration_seconds_count{{stage="{name}"}} {stage["count"]}'
+            )
+        for metric, key, help in (
+            ("bcdl_stage_errors_total", "errors", "Failed calls of a stage"),
+            ("bcdl_stage_bytes_total", "bytes", "Bytes processed by a stage"),
+        ):
+            lines.append(f"# HELP {metric} {help}")
+            lines.append(f"# TYPE {metric} counter")
+            for name, stage in report["stages"].items():
+                lines.append(f'{metric}{{stage="{name}"}} {stage[key]}')
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _write(file_name: str, text: str):
+        # the textfile collector may read at any time, never show it half written
+        tmp = file_name + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(text)
+        os.replace(tmp, file_name)
+
+    def write_json(self, file_name: str):
+        self._write(file_name, json.dumps(self.report(), indent=2))
+
+    def write_prometheus(self, file_name: str):
+        self._write(file_name, self.prometheus())
+
+
+# metrics of the current run, shared by all downloaders like the logger
+stage_metrics = Metrics()
@@ -0,0 +1,29 @@
+# options of the downloader, kept apart from it so the command line can read
+# and write its config without importing the HTTP and parsing libraries
+
+from dataclasses import dataclass
+from typing import Optional
+
+# format names of the command line -> keys of the downloads of a release
+FORMATS = {
+    "FLAC": "flac",
+    "V0MP3": "mp3-v0",
+    "320MP3": "mp3-320",
+    "AAC": "aac-hi",
+    "Ogg": "vorbis",
+    "ALAC": "alac",
+    "WAV": "wav",
+    "AIFF": "aiff-lossless",
+}
+
+
+@dataclass
+class BCFreeDownloaderOptions:
+    country: str = "United States"
+    zipcode: str = "00000"
+    email: str = "auto"
+    format: str = "FLAC"
+    dir: str = "."
+    cookies: Optional[str] = None
+    identity: Optional[str] = None
+    parser: str = "fast"
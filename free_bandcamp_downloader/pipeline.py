@@ -0,0 +1,352 @@
+import heapq
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from free_bandcamp_downloader import logger, jobqueue
+from free_bandcamp_downloader.bc_free_downloader import (
+    AlbumInfo,
+    BCFreeDownloader,
+    LabelReleaseInfo,
+    Page,
+    TralbumId,
+)
+
+# position of a release in the run, e.g. (url index,) or (url index, release index)
+# history is committed in ascending key order
+ReleaseKey = Tuple[int, ...]
+
+_PENDING = object()
+
+
+class Stage:
+    """A bounded worker pool for one step of the pipeline"""
+
+    def __init__(self, name: str, workers: int, bound: Optional[int] = None):
+        self.name = name
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=f"bcdl-{name}"
+        )
+        # limits how many items can wait for this stage at once so a fast
+        # upstream stage can't pile up parsed pages in memory
+        self.slots = threading.BoundedSemaphore(bound) if bound else None
+
+    def submit(self, fn: Callable, *args):
+        if self.slots:
+            self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            if self.slots:
+                self.slots.release()
+            raise
+        if self.slots:
+            future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class OrderedCommitter:
+    """Hands finished releases to `commit` in key order, no matter in which
+    order they finish. A key only blocks the ones after it until it is resolved,
+    either with a result or with None if there is nothing to commit."""
+
+    def __init__(self, commit: Callable[[AlbumInfo], None]):
+        self._commit = commit
+        self._results: Dict[ReleaseKey, object] = {}
+        self._heap: List[ReleaseKey] = []
+        self._lock = threading.Lock()
+
+    def register(self, key: ReleaseKey):
+        with self._lock:
+            self._results[key] = _PENDING
+            heapq.heappush(self._heap, key)
+
+    def resolve(self, key: ReleaseKey, result: Optional[AlbumInfo] = None):
+        with self._lock:
+            # a release that failed in post-processing was already committed
+            if self._results.get(key) is not _PENDING:
+                return
+            self._results[key] = result
+            while self._heap and self._results[self._heap[0]] is not _PENDING:
+                result = self._results.pop(heapq.heappop(self._heap))
+                if result is not None:
+                    self._commit(result)
+
+
+class DownloadPipeline:
+    """Runs page fetch/parse, download link resolution, byte transfer and
+    post-processing of releases in separate bounded worker pools.
+
+    `should_download(id, url)` is consulted (and says why not) before a
+    release is fetched,
+    `on_downloaded(album_info)` is called in input order once a release has
+    been downloaded, and `post_process(album_info)` runs afterwards in the
+    post-processing pool. `label_releases(url, releases)` can filter the
+    releases of a label page before they are fetched. `on_state(url, state,
+    album_info)` is told about every `jobqueue` state an input url or label
+    release reaches, with the release once it was downloaded, and
+    `on_released(id)` once a release `should_download` let through is done
+    or failed. Unless
+    `keep_results` is True, releases are dropped from `results` once they are
+    done, so a run fed from a queue of any size doesn't keep all of them.
+    """
+
+    def __init__(
+        self,
+        downloader: BCFreeDownloader,
+        jobs: int,
+        should_download: Optional[Callable[[TralbumId, str], bool]] = None,
+        on_downloaded: Optional[Callable[[AlbumInfo], None]] = None,
+        post_process: Optional[Callable[[AlbumInfo], None]] = None,
+        label_releases: Optional[
+            Callable[[str, Iterable[LabelReleaseInfo]], Iterable[LabelReleaseInfo]]
+        ] = None,
+        on_state: Optional[Callable[[str, str, Optional[AlbumInfo]], None]] = None,
+        on_released: Optional[Callable[[TralbumId], None]] = None,
+        keep_results: bool = True,
+    ):
+        self.downloader = downloader
+        self.keep_results = keep_results
+        self.should_download = should_download
+        self.on_downloaded = on_downloaded
+        self.post_process = post_process
+        self.label_releases = label_releases
+        self.on_state = on_state
+        self.on_released = on_released
+        # fetch workers submit label releases back into their own pool,
+        # so that one can't be bounded without risking a deadlock
+        self.fetch = Stage("fetch", jobs)
+        self.resolve = Stage("resolve", jobs, bound=2 * jobs)
+        self.transfer = Stage("transfer", jobs, bound=2 * jobs)
+        self.post = Stage("post", jobs, bound=2 * jobs)
+        self.committer = OrderedCommitter(self._commit)
+        self.results: Dict[ReleaseKey, AlbumInfo] = {}
+        self.failed: Dict[ReleaseKey, Exception] = {}
+        # releases of label pages
+        self.releases: Dict[ReleaseKey, LabelReleaseInfo] = {}
+
+        self._urls: Dict[ReleaseKey, str] = {}
+        self._owners: Dict[TralbumId, ReleaseKey] = {}
+        # owner key -> its release, until it is done
+        self._claimed: Dict[ReleaseKey, TralbumId] = {}
+        # owner key -> earliest key that asked for the same release
+        self._aliases: Dict[ReleaseKey, ReleaseKey] = {}
+        self._finished: Set[ReleaseKey] = set()
+        self._email_keys: Dict[TralbumId, ReleaseKey] = {}
+        self._lock = threading.Lock()
+        self._outstanding = 0
+        self._idle = threading.Condition(self._lock)
+
+    def _state(
+        self, key: ReleaseKey, state: str, album_info: Optional[AlbumInfo] = None
+    ):
+        if self.on_state:
+            self.on_state(self._urls[key], state, album_info)
+        if state in jobqueue.TERMINAL:
+            id = self._claimed.pop(key, None)
+            if id is not None and self.on_released:
+                self.on_released(id)
+        if state == jobqueue.DONE and not self.keep_results:
+            self.results.pop(key, None)
+
+    def _commit(self, album_info: AlbumInfo):
+        if self.on_downloaded:
+            self.on_downloaded(album_info)
+
+    def _claim(self, key: ReleaseKey, id: TralbumId, url: str) -> bool:
+        with self._lock:
+            # the same release may show up under several input urls,
+            # its history entry goes to the earliest of them
+            owner = self._owners.get(id)
+            if owner is not None:
+                # the earliest url gets the history entry, the others are
+                # done with the release
+                self._state(key, jobqueue.DONE)
+                if owner in self._finished:
+                    self.committer.resolve(key)
+                    return False
+                alias = self._aliases.get(owner, owner)
+                if key < alias:
+                    self._aliases[owner] = key
+                    if alias != owner:
+                        self.committer.resolve(alias)
+                else:
+                    self.committer.resolve(key)
+                return False
+            if self.should_download and not self.should_download(id, url):
+                self._state(key, jobqueue.DONE)
+                self.committer.resolve(key)
+                return False
+            self._owners[id] = key
+            self._claimed[key] = id
+            return True
+
+    def _finish(self, key: ReleaseKey, result: Optional[AlbumInfo] = None):
+        with self._lock:
+            self._finished.add(key)
+            alias = self._aliases.pop(key, None)
+        if alias is not None:
+            self.committer.resolve(alias, result)
+            result = None
+        self.committer.resolve(key, result)
+
+    def _submit(self, stage: Stage, key: ReleaseKey, fn: Callable, *args):
+        with self._lock:
+            self._outstanding += 1
+
+        def run():
+            try:
+                fn(key, *args)
+            except Exception as ex:
+                logger.error(f"Failed to download {self._urls.get(key)}: {ex}")
+                self.failed[key] = ex
+                self._state(key, jobqueue.FAILED)
+                self._finish(key)
+            finally:
+                with self._lock:
+                    self._outstanding -= 1
+                    self._idle.notify_all()
+
+        stage.submit(run)
+
+    def _wait_outstanding(self, limit: int):
+        with self._lock:
+            while self._outstanding >= limit:
+                self._idle.wait()
+
+    def _wait_idle(self):
+        self._wait_outstanding(1)
+
+    def _fetch_url(self, key: ReleaseKey, url: str):
+        page = self.downloader.get_url_page(url)
+        if page.og_type == "band":
+            # releases are fetched while the rest of the label is still parsed
+            releases = self.downloader.iter_label_releases(page)
+            if self.label_releases:
+                releases = self.label_releases(url, releases)
+            self._add_releases(key, releases)
+            self._state(key, jobqueue.DONE)
+            self.committer.resolve(key)
+            return
+        url_info = self.downloader.get_page_info(page)
+        tralbum = url_info["info"]["tralbum_data"]
+        id = (tralbum["current"]["type"], tralbum["current"]["id"])
+        if self._claim(key, id, tralbum["url"]):
+            self._submit(self.resolve, key, self._resolve, page)
+
+    def _add_releases(self, key: ReleaseKey, releases: Iterable[LabelReleaseInfo]):
+        for i, release in enumerate(releases):
+            child = key + (i,)
+            self._urls[child] = release["url"]
+            self.releases[child] = release
+            self.committer.register(child)
+            if self._claim(child, (release["type"], release["id"]), release["url"]):
+                self._submit(self.fetch, child, self._fetch_release, release["url"])
+
+    def _fetch_release(self, key: ReleaseKey, url: str):
+        logger.info(f"Downloading {url}")
+        page = self.downloader.get_url_page(url)
+        self._submit(self.resolve, key, self._resolve, page)
+
+    def _resolve(self, key: ReleaseKey, page: Page):
+        album_info = self.downloader.resolve_album(page)
+        self.results[key] = album_info
+        if album_info["download"] is not None:
+            self._state(key, jobqueue.RESOLVED)
+            self._submit(self.transfer, key, self._transfer, album_info)
+            return
+        if album_info["email_queued"]:
+            current = album_info["tralbum_data"]["current"]
+            with self._lock:
+                self._email_keys[(current["type"], current["id"])] = key
+            self._state(key, jobqueue.AWAITING_EMAIL)
+        else:
+            # nothing to download, e.g. a release that isn't free
+            self._state(key, jobqueue.DONE)
+        self._finish(key)
+
+    def _transfer(self, key: ReleaseKey, album_info: AlbumInfo):
+        self._state(key, jobqueue.DOWNLOADING)
+        self.downloader.transfer_album(album_info)
+        self._downloaded(key, album_info)
+        self._finish(key, album_info)
+
+    def _downloaded(self, key: ReleaseKey, album_info: AlbumInfo):
+        if self.post_process:
+            self._state(key, jobqueue.POST_PROCESSING, album_info)
+            self._submit(self.post, key, self._post, album_info)
+        else:
+            self._state(key, jobqueue.DONE, album_info)
+
+    def _post(self, key: ReleaseKey, album_info: AlbumInfo):
+        self.post_process(album_info)
+        self._state(key, jobqueue.DONE)
+
+    def run(
+        self,
+        urls: Iterable[str] = (),
+        releases: Iterable[LabelReleaseInfo] = (),
+        flush_emails: bool = True,
+        backlog: Optional[int] = None,
+    ) -> List[AlbumInfo]:
+        """Download everything in `urls` (release or label pages) and
+        `releases` (already parsed label releases), then wait for queued
+        emails unless `flush_emails` is False. With a `backlog`, the next url
+        is only taken while fewer tasks than that are in flight, so `urls` can
+        claim jobs from a queue as they are needed. Returns the downloaded
+        releases in input order."""
+        try:
+            for i, url in enumerate(urls):
+                if backlog is not None:
+                    self._wait_outstanding(backlog)
+                self._urls[(i,)] = url
+                self.committer.register((i,))
+                self._submit(self.fetch, (i,), self._fetch_url, url)
+            self._add_releases((-1,), releases)
+            self._wait_idle()
+            if flush_emails:
+                self._flush_emails()
+        finally:
+            for stage in (self.fetch, self.resolve, self.transfer, self.post):
+                stage.shutdown()
+
+        return [
+            self.results[key]
+            for key in sorted(self.results)
+            if self.results[key].get("is_downloaded")
+        ]
+
+    def unfinished(self) -> Set[TralbumId]:
+        """Label releases that failed or whose download email never came"""
+        ids = set()
+        for key, release in self.releases.items():
+            album_info = self.results.get(key)
+            if key in self.failed or (
+                album_info is not None
+                and album_info["email_queued"]
+                and not album_info.get("is_downloaded")
+            ):
+                ids.add((release["type"], release["id"]))
+        return ids
+
+    def _flush_emails(self):
+        # emails arrive in any order, commit them in input order as well
+        email_downloads = self.downloader.flush_email_downloads()
+        email_keys = []
+        for album_info in email_downloads:
+            current = album_info["tralbum_data"]["current"]
+            key = self._email_keys[(current["type"], current["id"])]
+            album_info["is_downloaded"] = True
+            self.results[key] = album_info
+            email_keys.append(key)
+        for key in sorted(email_keys):
+            self._commit(self.results[key])
+            self._downloaded(key, self.results[key])
+        for key in set(self._email_keys.values()) - set(email_keys):
+            logger.error(f"No download email came for {self._urls[key]}")
+            self._state(key, jobqueue.FAILED)
+        self._wait_idle()
@@ -0,0 +1,171 @@
+import email.utils
+import threading
+import time
+
+from dataclasses import dataclass
+from typing import Dict, Mapping, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+
+# statuses that mean the server wants us to slow down
+THROTTLE_STATUSES = {429, 500, 502, 503, 504}
+# a POST may have been processed despite a 5xx, so it is only sent again on
+# these statuses, and only if the server said when to retry it
+UNSAFE_RETRY_STATUSES = {429, 503}
+
+
+@dataclass
+class RateLimitStats:
+    requests: int = 0
+    throttled: int = 0
+    # seconds spent waiting for a token or a Retry-After pause
+    waited: float = 0
+
+    def __str__(self):
+        return (
+            f"{self.requests} requests, {self.throttled} throttled, "
+            f"{self.waited:.1f}s waited in total"
+        )
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header, given as seconds or a date"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0)
+
+
+def may_retry(method: str, status: int, headers: Mapping[str, str]) -> bool:
+    """Whether a throttled request can be sent again"""
+    if method.upper() in ("GET", "HEAD"):
+        return True
+    return status in UNSAFE_RETRY_STATUSES and "Retry-After" in headers
+
+
+class TokenBucket:
+    """Allows `rate` requests per second on average, in bursts of up to
+    `burst`. The rate is adapted with AIMD: it grows by `increase` after
+    every successful request and is halved when the server throttles, down
+    to `min_rate`."""
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float,
+        min_rate: float,
+        max_rate: float,
+        increase: float,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.tokens = burst
+        self.updated = time.monotonic()
+        # no tokens are handed out before this time
+        self.paused_until = 0.0
+        self.failures = 0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # take a token, returns how long to sleep before using it
+    def reserve(self, now: float) -> float:
+        self._refill(now)
+        self.tokens -= 1
+        wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+        return max(wait, self.paused_until - now)
+
+    def succeeded(self):
+        self.failures = 0
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttled(self, now: float, retry_after: Optional[float]) -> float:
+        self.failures += 1
+        self._refill(now)
+        self.rate = max(self.min_rate, self.rate / 2)
+        if retry_after is None:
+            retry_after = min(2**self.failures, 60)
+        self.paused_until = max(self.paused_until, now + retry_after)
+        # start from an empty bucket after the pause
+        self.tokens = min(self.tokens, 0)
+        return retry_after
+
+
+class RateLimiter:
+    """Token buckets shared by all requests of a downloader, one per host and
+    budget. Page and API requests use the "page" budget, file transfers the
+    "cdn" budget, so large downloads don't use up the page request rate.
+
+    Call `acquire` before a request and `update` with its response. Throttled
+    responses (429 and 5xx) slow the host down and pause it for Retry-After
+    seconds, or an exponential backoff if the header is missing.
+    """
+
+    def __init__(
+        self,
+        rate: float = 10,
+        cdn_rate: float = 20,
+        burst: float = 10,
+        min_rate: float = 0.2,
+        max_rate: float = 50,
+        increase: float = 0.1,
+    ):
+        self.rates = {"page": rate, "cdn": cdn_rate}
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.stats = RateLimitStats()
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, url: str, budget: str) -> TokenBucket:
+        key = (budget, urlsplit(url).hostname or "")
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            rate = self.rates[budget]
+            bucket = TokenBucket(
+                rate,
+                self.burst,
+                min(self.min_rate, rate),
+                max(self.max_rate, rate),
+                self.increase,
+            )
+            self._buckets[key] = bucket
+        return bucket
+
+    def acquire(self, url: str, budget: str = "page"):
+        """Block until a request to `url` is allowed"""
+        with self._lock:
+            wait = self._bucket(url, budget).reserve(time.monotonic())
+            self.stats.requests += 1
+            self.stats.waited += wait
+        if wait > 0:
+            time.sleep(wait)
+
+    def update(
+        self, url: str, r: requests.Response, budget: str = "page"
+    ) -> Optional[float]:
+        """Adapt to the response of a request. Returns the seconds after which
+        a throttled request may be retried, None if it wasn't throttled"""
+        with self._lock:
+            bucket = self._bucket(url, budget)
+            if r.status_code not in THROTTLE_STATUSES:
+                bucket.succeeded()
+                return None
+            self.stats.throttled += 1
+            return bucket.throttled(
+                time.monotonic(), parse_retry_after(r.headers.get("Retry-After"))
+            )
@@ -0,0 +1,410 @@
+import os
+import struct
+import zlib
+
+from typing import BinaryIO, Callable, Dict, List, Optional
+
+LOCAL_HEADER = b"PK\x03\x04"
+DATA_DESCRIPTOR = b"PK\x07\x08"
+CENTRAL_HEADER = b"PK\x01\x02"
+END_OF_CENTRAL_DIRECTORY = b"PK\x05\x06"
+# any of these after the last member ends the entries we care about
+CENTRAL_DIRECTORY = (CENTRAL_HEADER, END_OF_CENTRAL_DIRECTORY, b"PK\x06\x06")
+
+LOCAL_HEADER_STRUCT = struct.Struct("<4sHHHHHIIIHH")
+CENTRAL_HEADER_STRUCT = struct.Struct("<4sHHHHHHIIIHHHHHII")
+END_OF_CENTRAL_DIRECTORY_STRUCT = struct.Struct("<4sHHHHIIH")
+ZIP64_EXTRA_ID = 0x0001
+STORED = 0
+DEFLATED = 8
+
+
+class StreamUnzipError(Exception):
+    """The zip can't be extracted from a stream, e.g. a stored member
+    without sizes in its local header, or an unsupported compression"""
+
+
+class CorruptZipError(Exception):
+    """The zip doesn't match its own CRC-32s, sizes or central directory, so
+    it was damaged on the way"""
+
+
+def safe_member_path(dir_name: str, name: str) -> str:
+    """Path of a member below `dir_name`, ignoring absolute paths and `..`
+    components the same way ZipFile.extract does"""
+    parts = [
+        part
+        for part in name.replace("\\", "/").split("/")
+        if part not in ("", ".", "..")
+    ]
+    return os.path.join(dir_name, *parts)
+
+
+class ZipStreamReader:
+    """Reads a zip file from its bytes as they arrive, using the local file
+    headers instead of the central directory at the end of the file.
+
+    The CRC-32 and sizes of every member are checked as soon as its data has
+    been read, and once the whole file has been fed `close` checks that the
+    central directory lists the same members. Subclasses get the uncompressed
+    data of each member through `_member_data`.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forget everything fed so far"""
+        # bytes of the zip fed so far
+        self.consumed = 0
+        # checked members in the order of the zip
+        self.members: List[Dict] = []
+        self._buf = bytearray()
+        self._central = bytearray()
+        self._state = "header"
+        self._member: Optional[Dict] = None
+        self._remaining = 0
+        self._compressed = 0
+        self._size = 0
+        self._crc = 0
+        self._inflate = None
+
+    @property
+    def done(self) -> bool:
+        return self._state == "done"
+
+    def feed(self, chunk: bytes):
+        self.consumed += len(chunk)
+        if self._state == "done":
+            self._central += chunk
+            return
+        self._buf += chunk
+        while self._step():
+            pass
+
+    def close(self):
+        """Check that the whole zip was fed and that its central directory
+        matches the members"""
+        # every byte was fed, so a zip that stops early is damaged
+        if self._state == "header":
+            raise CorruptZipError("Zip ends before its central directory")
+        if self._state != "done":
+            raise CorruptZipError(f"Zip ends in the middle of a member ({self._state})")
+        self._check_central_directory()
+
+    # process as much of the buffer as possible, False if more bytes are needed
+    def _step(self) -> bool:
+        if self._state == "header":
+            return self._read_header()
+        if self._state == "data":
+            return self._read_data()
+        if self._state == "descriptor":
+            return self._read_descriptor()
+        return False
+
+    def _begin_member(self, member: Dict):
+        pass
+
+    def _member_data(self, data: bytes):
+        pass
+
+    def _end_member(self, member: Dict):
+        pass
+
+    def _read_header(self) -> bool:
+        buf = self._buf
+        if len(buf) < 4:
+            return False
+        signature = bytes(buf[:4])
+        if signature in CENTRAL_DIRECTORY:
+            self._state = "done"
+            self._central, self._buf = buf, bytearray()
+            return False
+        if signature != LOCAL_HEADER:
+            raise StreamUnzipError(f"Unexpected signature {signature!r} in zip")
+        if len(buf) < LOCAL_HEADER_STRUCT.size:
+            return False
+        (
+            _,
+            _,
+            flags,
+            method,
+            _,
+            _,
+            crc,
+            compressed_size,
+            size,
+            name_len,
+            extra_len,
+        ) = LOCAL_HEADER_STRUCT.unpack_from(buf)
+        header_len = LOCAL_HEADER_STRUCT.size + name_len + extra_len
+        if len(buf) < header_len:
+            return False
+
+        name_end = LOCAL_HEADER_STRUCT.size + name_len
+        raw_name = bytes(buf[LOCAL_HEADER_STRUCT.size : name_end])
+        extra = bytes(buf[name_end:header_len])
+        offset = self.consumed - len(buf)
+        del buf[:header_len]
+
+        # same as ZipFile: utf-8 if flagged, cp437 otherwise
+        name = raw_name.decode("utf-8" if flags & 0x800 else "cp437")
+        if flags & 0x1:
+            raise StreamUnzipError(f"{name} is encrypted")
+        if method not in (STORED, DEFLATED):
+            raise StreamUnzipError(f"{name} uses unsupported compression {method}")
+
+        if compressed_size == 0xFFFFFFFF or size == 0xFFFFFFFF:
+            size, compressed_size = self._zip64_values(extra, size, compressed_size)
+        # the sizes in the data descriptor are 8 bytes whenever there is a
+        # zip64 extra field, even if the local header has zeros instead of
+        # 0xFFFFFFFF
+        zip64 = self._zip64_extra(extra) is not None
+        has_descriptor = bool(flags & 0x8)
+        if has_descriptor and method == STORED and compressed_size == 0:
+            raise StreamUnzipError(f"{name} is stored without a size")
+
+        self._member = {
+            "name": name,
+            "raw_name": raw_name,
+            "offset": offset,
+            "method": method,
+            "crc": crc,
+            "compressed_size": compressed_size,
+            "size": size,
+            "has_descriptor": has_descriptor,
+            # sizes are only known after the data if they are in a descriptor
+            "sized": not has_descriptor or compressed_size != 0,
+            "zip64": zip64,
+        }
+        self._remaining = compressed_size
+        self._compressed = 0
+        self._size = 0
+        self._crc = 0
+        self._inflate = zlib.decompressobj(-15) if method == DEFLATED else None
+        self._begin_member(self._member)
+        self._state = "data"
+        return True
+
+    @staticmethod
+    def _zip64_extra(extra: bytes) -> Optional[bytes]:
+        """Data of the zip64 extra field, None if there isn't one"""
+        pos = 0
+        while pos + 4 <= len(extra):
+            id, length = struct.unpack_from("<HH", extra, pos)
+            if id == ZIP64_EXTRA_ID:
+                return extra[pos + 4 : pos + 4 + length]
+            pos += 4 + length
+        return None
+
+    @staticmethod
+    def _zip64_values(extra: bytes, *values: int) -> List[int]:
+        """Replace the `values` that are 0xFFFFFFFF with the ones from the
+        zip64 extra field, which has them in the same order"""
+        data = ZipStreamReader._zip64_extra(extra)
+        if data is None:
+            raise StreamUnzipError("Zip64 sizes missing from header")
+        offset = 0
+        values = list(values)
+        for i, value in enumerate(values):
+            if value == 0xFFFFFFFF:
+                if offset + 8 > len(data):
+                    raise StreamUnzipError("Zip64 sizes missing from header")
+                (values[i],) = struct.unpack_from("<Q", data, offset)
+                offset += 8
+        return values
+
+    def _write(self, data: bytes):
+        if self._inflate is not None:
+            try:
+                data = self._inflate.decompress(data)
+            except zlib.error as ex:
+                raise CorruptZipError(f"Bad data in {self._member['name']}: {ex}")
+        self._write_uncompressed(data)
+
+    def _write_uncompressed(self, data: bytes):
+        if data:
+            self._crc = zlib.crc32(data, self._crc)
+            self._size += len(data)
+            self._member_data(data)
+
+    def _read_data(self) -> bool:
+        buf = self._buf
+        if self._member["sized"]:
+            n = min(self._remaining, len(buf))
+            if n:
+                with memoryview(buf) as view:
+                    self._write(view[:n])
+                del buf[:n]
+                self._remaining -= n
+                self._compressed += n
+            if self._remaining:
+                return False
+        else:
+            # deflated without a size, the deflate stream knows where it ends
+            if not buf:
+                return False
+            with memoryview(buf) as view:
+                self._write(view)
+            self._compressed += len(buf)
+            buf.clear()
+            if not self._inflate.eof:
+                return False
+            buf += self._inflate.unused_data
+            self._compressed -= len(self._inflate.unused_data)
+        if self._inflate is not None:
+            self._write_uncompressed(self._inflate.flush())
+        if self._member["has_descriptor"]:
+            self._state = "descriptor"
+        else:
+            self._check_member()
+        return True
+
+    def _read_descriptor(self) -> bool:
+        buf = self._buf
+        size_len = 8 if self._member["zip64"] else 4
+        length = 4 + 2 * size_len
+        if len(buf) < 4:
+            return False
+        if bytes(buf[:4]) == DATA_DESCRIPTOR:
+            length += 4
+            start = 4
+        else:
+            start = 0
+        if len(buf) < length:
+            return False
+        size_format = "<Q" if self._member["zip64"] else "<I"
+        (self._member["crc"],) = struct.unpack_from("<I", buf, start)
+        (self._member["compressed_size"],) = struct.unpack_from(
+            size_format, buf, start + 4
+        )
+        (self._member["size"],) = struct.unpack_from(
+            size_format, buf, start + 4 + size_len
+        )
+        del buf[:length]
+        self._check_member()
+        return True
+
+    def _check_member(self):
+        member = self._member
+        if self._crc != member["crc"]:
+            raise CorruptZipError(f"Bad CRC-32 for {member['name']}")
+        if (self._compressed, self._size) != (
+            member["compressed_size"],
+            member["size"],
+        ):
+            raise CorruptZipError(f"Bad size for {member['name']}")
+        self.members.append(member)
+        self._end_member(member)
+        self._member = None
+        self._state = "header"
+
+    def _check_central_directory(self):
+        data = self._central
+        pos = 0
+        for member in self.members:
+            end = pos + CENTRAL_HEADER_STRUCT.size
+            if bytes(data[pos : pos + 4]) != CENTRAL_HEADER or len(data) < end:
+                raise CorruptZipError(f"Central directory is missing {member['name']}")
+            (
+                *_,
+                crc,
+                compressed_size,
+                size,
+                name_len,
+                extra_len,
+                comment_len,
+                _,
+                _,
+                _,
+                offset,
+            ) = CENTRAL_HEADER_STRUCT.unpack_from(data, pos)
+            raw_name = bytes(data[end : end + name_len])
+            extra = bytes(data[end + name_len : end + name_len + extra_len])
+            pos = end + name_len + extra_len + comment_len
+            if 0xFFFFFFFF in (size, compressed_size, offset):
+                size, compressed_size, offset = self._zip64_values(
+                    extra, size, compressed_size, offset
+                )
+            if (raw_name, crc, compressed_size, size, offset) != (
+                member["raw_name"],
+                member["crc"],
+                member["compressed_size"],
+                member["size"],
+                member["offset"],
+            ):
+                raise CorruptZipError(
+                    f"Central directory doesn't match {member['name']}"
+                )
+        if bytes(data[pos : pos + 4]) == CENTRAL_HEADER:
+            raise CorruptZipError("Central directory lists members not in the zip")
+        end = data.find(END_OF_CENTRAL_DIRECTORY, pos)
+        if end < 0 or len(data) < end + END_OF_CENTRAL_DIRECTORY_STRUCT.size:
+            raise CorruptZipError("End of central directory is missing")
+        entries = END_OF_CENTRAL_DIRECTORY_STRUCT.unpack_from(data, end)[4]
+        if entries != 0xFFFF and entries != len(self.members):
+            raise CorruptZipError(
+                f"Central directory has {entries} of {len(self.members)} members"
+            )
+
+
+class ZipStreamExtractor(ZipStreamReader):
+    """Extracts a zip file from its bytes as they arrive, see ZipStreamReader.
+
+    Each member is written to a temporary file next to its final path and
+    passed to `finalize` once its CRC has been checked, before it is renamed
+    into place, so it can be tagged without being opened a second time.
+    """
+
+    def __init__(self, dir_name: str, finalize: Optional[Callable[[str], None]] = None):
+        self.dir_name = dir_name
+        self.finalize = finalize
+        super().__init__()
+
+    def reset(self):
+        """Forget everything fed so far and remove the extracted files"""
+        if getattr(self, "_out", None) is not None:
+            self._out.close()
+            os.remove(self._tmp_path)
+        for path in getattr(self, "files", []):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        super().reset()
+        self.files: List[str] = []
+        self._out: Optional[BinaryIO] = None
+        self._tmp_path: Optional[str] = None
+
+    def close(self) -> List[str]:
+        """Check the zip like ZipStreamReader.close and return the extracted
+        files"""
+        super().close()
+        return self.files
+
+    def _begin_member(self, member: Dict):
+        name = member["name"]
+        path = safe_member_path(self.dir_name, name)
+        if name.endswith("/") or path == self.dir_name:
+            os.makedirs(path, exist_ok=True)
+            self._out = None
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            member["path"] = path
+            root, ext = os.path.splitext(path)
+            # keep the extension so taggers can tell the file type
+            self._tmp_path = f"{root}.part{ext}"
+            self._out = open(self._tmp_path, "wb")
+
+    def _member_data(self, data: bytes):
+        if self._out is not None:
+            self._out.write(data)
+
+    def _end_member(self, member: Dict):
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+            if self.finalize is not None:
+                self.finalize(self._tmp_path)
+            os.replace(self._tmp_path, member["path"])
+            self.files.append(member["path"])
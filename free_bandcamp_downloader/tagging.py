@@ -0,0 +1,86 @@
+import time
+
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+from free_bandcamp_downloader.metrics import stage_metrics
+
+
+@dataclass
+class TagResult:
+    file_name: str
+    # False if mutagen doesn't recognize the file, e.g. cover art
+    tagged: bool
+    error: Optional[str] = None
+    # time it took, measured where the file was tagged
+    seconds: float = 0
+
+
+def build_tags(head_data: Dict) -> Dict[str, str]:
+    """Tags for every file of a release, from its ld+json head data"""
+    tags = {"website": head_data["@id"]}
+    if head_data.get("keywords"):
+        tags["genre"] = head_data["keywords"]
+    comment = ""
+    comment += head_data.get("description", "").strip()
+    comment += "\n\n" + head_data.get("creditText", "")
+    tags["comment"] = comment.strip()
+    return tags
+
+
+def tag_file(file_name: str, tags: Dict[str, str]) -> TagResult:
+    """Write `tags` to an audio file. Module level so it can run in a process pool"""
+    import mutagen
+
+    start = time.perf_counter()
+    try:
+        f = mutagen.File(file_name)
+        if f is None:
+            result = TagResult(file_name, False)
+        else:
+            for key, value in tags.items():
+                f[key] = value
+            f.save()
+            result = TagResult(file_name, True)
+    except Exception as ex:
+        result = TagResult(file_name, False, f"{type(ex).__name__}: {ex}")
+    result.seconds = time.perf_counter() - start
+    return result
+
+
+class Tagger:
+    """Tags the files of releases on a pool of `jobs` threads, or processes
+    if `processes` is set. With one job files are tagged in the calling
+    thread. The pool is shared by all releases, so tagging of one album can
+    overlap with others when they are post-processed concurrently."""
+
+    def __init__(self, jobs: int = 1, processes: bool = False):
+        self.jobs = jobs
+        self._pool: Optional[Executor] = None
+        if jobs > 1:
+            pool_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+            self._pool = pool_class(max_workers=jobs)
+
+    def tag_files(self, files: Iterable[str], head_data: Dict) -> List[TagResult]:
+        tags = build_tags(head_data)
+        if self._pool is None:
+            results = [tag_file(file_name, tags) for file_name in files]
+        else:
+            futures = [
+                self._pool.submit(tag_file, file_name, tags) for file_name in files
+            ]
+            results = [future.result() for future in futures]
+        for result in results:
+            stage_metrics.observe("tag", result.seconds, error=bool(result.error))
+        return results
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,436 @@
+import errno
+import hashlib
+import http.client
+import json
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+import requests
+import urllib3
+
+from free_bandcamp_downloader import logger
+from free_bandcamp_downloader.stream_unzip import (
+    CorruptZipError,
+    StreamUnzipError,
+    ZipStreamReader,
+)
+
+# bounds of the adaptive chunk size, see ChunkSizer
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 4 * 1024**2
+
+
+@dataclass
+class TransferOptions:
+    # parallel connections for files of at least segment_threshold bytes
+    segments: int = 1
+    segment_threshold: int = 64 * 1024**2
+    # extract zips while they are downloaded instead of saving them first,
+    # each file is tagged before it is moved into place
+    stream_unzip: bool = False
+    # bytes read from the connection at once, None to adapt it to the speed
+    # of the connection
+    chunk_size: Optional[int] = None
+    # reserve the whole file on disk before writing it
+    preallocate: bool = True
+    # hashlib algorithm to hash downloads with while they are written, the
+    # digest is recorded in the history
+    digest: Optional[str] = None
+
+
+class IncompleteDownloadError(Exception):
+    pass
+
+
+class RangeNotSupportedError(Exception):
+    pass
+
+
+class CorruptDownloadError(Exception):
+    pass
+
+
+class ChunkSizer:
+    """Number of bytes to read next from a connection.
+
+    Fixed if `chunk_size` is given. Otherwise it starts at MIN_CHUNK_SIZE and
+    is doubled while reads take less than half of `target` seconds and halved
+    while they take more than twice that, so fast connections are read with
+    few large calls and slow ones still report progress and save resume
+    points regularly.
+    """
+
+    def __init__(self, chunk_size: Optional[int] = None, target: float = 0.1):
+        self.fixed = chunk_size is not None
+        self.size = chunk_size or MIN_CHUNK_SIZE
+        self.max_size = chunk_size or MAX_CHUNK_SIZE
+        self.target = target
+
+    def observe(self, n: int, seconds: float):
+        if self.fixed or n < self.size:
+            return
+        if seconds < self.target / 2:
+            self.size = min(self.size * 2, MAX_CHUNK_SIZE)
+        elif seconds > self.target * 2:
+            self.size = max(self.size // 2, MIN_CHUNK_SIZE)
+
+
+_buffers = threading.local()
+
+
+# a buffer of at least `size` bytes, reused by every transfer of this thread
+def transfer_buffer(size: int) -> bytearray:
+    buffer = getattr(_buffers, "buffer", None)
+    if buffer is None or len(buffer) < size:
+        buffer = _buffers.buffer = bytearray(size)
+    return buffer
+
+
+def _body_reader(r: requests.Response) -> Callable[[memoryview], int]:
+    fp = getattr(r.raw, "_fp", None)
+    # http.client reads straight into the buffer, urllib3's readinto reads a
+    # new bytes object and copies it on every call
+    if isinstance(fp, http.client.HTTPResponse) and not r.headers.get(
+        "Content-Encoding"
+    ):
+
+        def readinto(view: memoryview) -> int:
+            n = fp.readinto(view)
+            if fp.isclosed():
+                # end of the body, hand the connection back to the pool like
+                # urllib3 does after its last read
+                r.raw.release_conn()
+            return n
+
+        return readinto
+    # requests leaves decoding to iter_content, so an encoded body has to be
+    # read with decode_content
+    readinto = getattr(r.raw, "readinto", None)
+    if readinto is not None and not r.headers.get("Content-Encoding"):
+        return readinto
+
+    # urllib3 1.x can decode more than it was asked for
+    pending = bytearray()
+
+    def read(view: memoryview) -> int:
+        if not pending:
+            pending.extend(r.raw.read(len(view), decode_content=True))
+        n = min(len(view), len(pending))
+        view[:n] = pending[:n]
+        del pending[:n]
+        return n
+
+    return read
+
+
+class StreamVerifier:
+    """Checks a download from its bytes as they are written: counts them,
+    hashes them with the hashlib algorithm `digest` if given and, for zips,
+    checks the CRC-32 of every member and the central directory with a
+    ZipStreamReader. Nothing has to be read from disk again, except bytes
+    written before the verifier saw them, e.g. by an earlier run of a resumed
+    transfer, which `catch_up` reads from the part file.
+    """
+
+    def __init__(self, digest: Optional[str] = None, zip: bool = False):
+        self.digest = digest
+        self.zip = zip
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self._hash = hashlib.new(self.digest) if self.digest else None
+        self._zip = ZipStreamReader() if self.zip else None
+
+    def update(self, chunk: memoryview):
+        self.count += len(chunk)
+        if self._hash is not None:
+            self._hash.update(chunk)
+        if self._zip is not None:
+            try:
+                self._zip.feed(chunk)
+            except StreamUnzipError as ex:
+                logger.debug(f"Can't check zip while downloading: {ex}")
+                self._zip = None
+            except CorruptZipError as ex:
+                raise CorruptDownloadError(str(ex)) from ex
+
+    def catch_up(self, path: str, offset: int):
+        """Check the bytes of the file at `path` before `offset` that weren't
+        seen yet"""
+        if self.count > offset:
+            self.reset()
+        if self.count == offset:
+            return
+        buffer = memoryview(transfer_buffer(MAX_CHUNK_SIZE))
+        with open(path, "rb") as f:
+            f.seek(self.count)
+            while self.count < offset:
+                n = f.readinto(buffer[: min(len(buffer), offset - self.count)])
+                if not n:
+                    raise IncompleteDownloadError(
+                        f"{path} ended after {self.count} of {offset} bytes"
+                    )
+                self.update(buffer[:n])
+
+    def finish(self, size: int) -> Optional[str]:
+        """Check that `size` bytes were seen and that the zip is intact.
+        Returns the digest as `<algorithm>:<hex digest>` if one was asked for."""
+        if self.count != size:
+            raise IncompleteDownloadError(f"Got {self.count} of {size} bytes")
+        if self._zip is not None:
+            try:
+                self._zip.close()
+            except (StreamUnzipError, CorruptZipError) as ex:
+                # all bytes are there, so this isn't a zip being cut short
+                raise CorruptDownloadError(str(ex)) from ex
+        if self._hash is None:
+            return None
+        return f"{self.digest}:{self._hash.hexdigest()}"
+
+
+def copy_response(
+    r: requests.Response,
+    write: Callable[[memoryview], None],
+    progress,
+    chunk_size: Optional[int] = None,
+    limit: Optional[int] = None,
+) -> int:
+    """Copy the body of a streamed response to `write` through one reused
+    buffer, at most `limit` bytes. `write` gets a view of the buffer that is
+    only valid until it returns. Returns the number of bytes copied."""
+    sizer = ChunkSizer(chunk_size)
+    buffer = memoryview(transfer_buffer(sizer.max_size))
+    read = _body_reader(r)
+    copied = 0
+    while limit is None or copied < limit:
+        size = sizer.size if limit is None else min(sizer.size, limit - copied)
+        start = time.perf_counter()
+        try:
+            n = read(buffer[:size])
+        except (http.client.HTTPException, urllib3.exceptions.HTTPError, OSError) as ex:
+            raise IncompleteDownloadError(
+                f"Connection lost after {copied} bytes: {ex!r}"
+            ) from ex
+        if not n:
+            break
+        sizer.observe(n, time.perf_counter() - start)
+        write(buffer[:n])
+        copied += n
+        progress.update(n)
+    return copied
+
+
+class PartFile:
+    """A download in progress.
+
+    Bytes go to `<file>.part` and what is needed to resume them (size and
+    validators of the response) to the `<file>.part.json` sidecar. Once the
+    part file has the full size it is atomically renamed to `<file>`.
+    """
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.part_path = file_name + ".part"
+        self.meta_path = file_name + ".part.json"
+
+    @staticmethod
+    def response_meta(r: requests.Response) -> Dict:
+        return {
+            "size": int(r.headers["content-length"]),
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+        }
+
+    def load_meta(self) -> Optional[Dict]:
+        try:
+            with open(self.meta_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save_meta(self, meta: Dict):
+        tmp = self.meta_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self.meta_path)
+
+    @staticmethod
+    def sequential_meta(meta: Dict, offset: int) -> Dict:
+        """Sidecar of a preallocated sequential transfer, which keeps its
+        progress like a segmented transfer of one segment"""
+        return dict(meta, segments=[[0, meta["size"] - 1, offset]])
+
+    def preallocate(self, f, size: int):
+        """Reserve `size` bytes for the open part file `f`, which fails early
+        if the disk is full and keeps the file in one piece"""
+        if hasattr(os, "posix_fallocate") and size:
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+                return
+            except OSError as ex:
+                if ex.errno not in (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOSYS):
+                    raise
+        f.truncate(size)
+
+    @property
+    def written(self) -> int:
+        try:
+            return os.path.getsize(self.part_path)
+        except FileNotFoundError:
+            return 0
+
+    def resume_meta(self, meta: Dict) -> Optional[Dict]:
+        """The sidecar of the part file if it belongs to the same version of
+        the file as a response described by `meta`"""
+        old = self.load_meta()
+        if old is None or old["size"] != meta["size"]:
+            return None
+        for validator in ("etag", "last_modified"):
+            if old.get(validator) and meta.get(validator):
+                if old[validator] != meta[validator]:
+                    return None
+        return old
+
+    def resume_offset(self, meta: Dict) -> int:
+        """Number of bytes that can be kept for a sequential transfer of a
+        response described by `meta`"""
+        old = self.resume_meta(meta)
+        if old is None:
+            return 0
+        if "segments" in old:
+            # preallocated by a segmented transfer, only the first segment
+            # is known to be contiguous
+            return old["segments"][0][2]
+        return min(self.written, meta["size"])
+
+    @staticmethod
+    def range_headers(offset: int, meta: Dict) -> Dict[str, str]:
+        headers = {"Range": f"bytes={offset}-"}
+        # let the server send the whole file instead if it changed meanwhile
+        if meta.get("etag"):
+            headers["If-Range"] = meta["etag"]
+        elif meta.get("last_modified"):
+            headers["If-Range"] = meta["last_modified"]
+        return headers
+
+    def finish(self):
+        meta = self.load_meta()
+        size = meta["size"]
+        if "segments" in meta:
+            # preallocated, the size of the file says nothing
+            written = sum(segment[2] for segment in meta["segments"])
+        else:
+            written = self.written
+        if written != size:
+            raise IncompleteDownloadError(
+                f"{self.part_path} has {written} of {size} bytes"
+            )
+        os.replace(self.part_path, self.file_name)
+        os.remove(self.meta_path)
+
+    def discard(self):
+        for path in (self.part_path, self.meta_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def split_segments(size: int, count: int) -> List[List[int]]:
+    """Split `size` bytes into `count` [start, end, done] byte ranges"""
+    step = -(-size // count)
+    return [[start, min(start + step, size) - 1, 0] for start in range(0, size, step)]
+
+
+class SegmentedDownload:
+    """Fetches byte ranges of a file over several connections at once and
+    writes them at their offsets into a preallocated part file. Progress of
+    every range is kept in the sidecar, so an interrupted transfer can be
+    resumed with the remaining ranges.
+
+    `get(url, headers)` must return a streamed response.
+    """
+
+    # write the sidecar every this many bytes per segment
+    SAVE_INTERVAL = 16 * 1024**2
+
+    def __init__(
+        self,
+        get: Callable[[str, Dict[str, str]], requests.Response],
+        url: str,
+        part: PartFile,
+        meta: Dict,
+        segments: int,
+        chunk_size: Optional[int] = None,
+    ):
+        self.get = get
+        self.url = url
+        self.part = part
+        self.chunk_size = chunk_size
+        old = part.resume_meta(meta)
+        if old is not None and "segments" in old:
+            self.meta = old
+        else:
+            self.meta = dict(meta, segments=split_segments(meta["size"], segments))
+            part.discard()
+        self.done = sum(segment[2] for segment in self.meta["segments"])
+        self._lock = threading.Lock()
+
+    def _save(self):
+        with self._lock:
+            self.part.save_meta(self.meta)
+
+    def _fetch(self, segment: List[int], pbar):
+        start, end, done = segment
+        if start + done > end:
+            return
+        headers = PartFile.range_headers(start + done, self.meta)
+        headers["Range"] = f"bytes={start + done}-{end}"
+        with self.get(self.url, headers) as r:
+            if r.status_code != 206:
+                raise RangeNotSupportedError(
+                    f"Server answered a range request with {r.status_code}"
+                )
+            unsaved = 0
+            with open(self.part.part_path, "r+b") as f:
+                f.seek(start + done)
+
+                def write(chunk: memoryview):
+                    nonlocal unsaved
+                    f.write(chunk)
+                    segment[2] += len(chunk)
+                    unsaved += len(chunk)
+                    if unsaved >= self.SAVE_INTERVAL:
+                        f.flush()
+                        self._save()
+                        unsaved = 0
+
+                # never write past the end of the range
+                copy_response(r, write, pbar, self.chunk_size, end + 1 - start - done)
+        if start + segment[2] <= end:
+            raise IncompleteDownloadError(
+                f"Range {start}-{end} ended after {segment[2]} bytes"
+            )
+
+    def run(self, pbar):
+        """Fetch all missing ranges. Raises RangeNotSupportedError if the
+        server doesn't honor range requests."""
+        if not os.path.exists(self.part.part_path):
+            with open(self.part.part_path, "wb") as f:
+                self.part.preallocate(f, self.meta["size"])
+        self.part.save_meta(self.meta)
+        pbar.update(self.done)
+
+        segments = self.meta["segments"]
+        try:
+            with ThreadPoolExecutor(max_workers=len(segments)) as pool:
+                for future in [pool.submit(self._fetch, s, pbar) for s in segments]:
+                    future.result()
+        finally:
+            self._save()
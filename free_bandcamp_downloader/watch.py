@@ -0,0 +1,114 @@
+import time
+
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Set
+
+from free_bandcamp_downloader import logger
+from free_bandcamp_downloader.history import DownloadHistory, HistoryId
+
+if TYPE_CHECKING:
+    from free_bandcamp_downloader.bc_free_downloader import LabelReleaseInfo
+
+
+class LabelWatch:
+    """Fetches only the releases a label page didn't have on earlier runs.
+
+    The releases seen on every watched label page (both `music-grid` and
+    `data-client-items`) are kept in the download history, and each check
+    of the label hands on only the releases that aren't in that snapshot or
+    weren't taken care of last time, e.g. because they failed or their
+    download email never came.
+
+    Labels are checked again after the mean time between their releases
+    since they were first watched, divided by `checks_per_release` and kept
+    between `min_interval` and `max_interval` seconds, so quiet labels are
+    polled less often than busy ones.
+    """
+
+    def __init__(
+        self,
+        history: DownloadHistory,
+        min_interval: float = 6 * 3600,
+        max_interval: float = 7 * 86400,
+        checks_per_release: float = 4,
+    ):
+        self.history = history
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.checks_per_release = checks_per_release
+
+    def is_due(self, url: str, now: Optional[float] = None) -> bool:
+        next_check_at = self.history.label_next_check(url)
+        return next_check_at is None or next_check_at <= (now or time.time())
+
+    def due(self, urls: List[str]) -> List[str]:
+        """The urls that aren't labels checked too recently. Urls that were
+        never checked as a label are always due."""
+        now = time.time()
+        due = []
+        for url in urls:
+            if self.is_due(url, now):
+                due.append(url)
+            else:
+                next_check_at = self.history.label_next_check(url)
+                logger.info(
+                    f"Skipping {url}, next check in "
+                    f"{(next_check_at - now) / 3600:.1f}h"
+                )
+        return due
+
+    def interval(self, first_checked_at: float, published: int, now: float) -> float:
+        """Seconds until the next check of a label that has published
+        `published` releases since `first_checked_at`"""
+        mean = (now - first_checked_at) / (published + 1)
+        interval = mean / self.checks_per_release
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def crawl(self, url: str) -> "LabelCrawl":
+        return LabelCrawl(self, url)
+
+
+class LabelCrawl:
+    """One check of a watched label: `filter` the releases of its page, then
+    `finish` once they were downloaded to update the snapshot and schedule
+    the next check."""
+
+    def __init__(self, watch: LabelWatch, url: str):
+        self.watch = watch
+        self.url = url
+        self.snapshot = watch.history.label_snapshot(url)
+        # every release on the page -> its url
+        self.seen: Dict[HistoryId, str] = {}
+        self.handed_on = 0
+        # set once the whole page was read
+        self.complete = False
+
+    def filter(
+        self, releases: Iterable["LabelReleaseInfo"]
+    ) -> Iterator["LabelReleaseInfo"]:
+        for release in releases:
+            id = (release["type"], release["id"])
+            self.seen[id] = release["url"]
+            if not self.snapshot.get(id):
+                self.handed_on += 1
+                yield release
+        self.complete = True
+
+    def finish(self, unfinished: Set[HistoryId] = frozenset()):
+        """Record the releases of the page, all but the `unfinished` ones as
+        taken care of"""
+        if not self.complete:
+            # some releases may be missing, keep the last snapshot
+            logger.debug(f"{self.url} wasn't read to the end, not recording it")
+            return
+        now = time.time()
+        first_checked_at, published = self.watch.history.update_label(
+            self.url,
+            [(id, url, id not in unfinished) for id, url in self.seen.items()],
+            now,
+        )
+        interval = self.watch.interval(first_checked_at, published, now)
+        self.watch.history.schedule_label(self.url, now + interval)
+        logger.info(
+            f"{self.url}: {self.handed_on} of {len(self.seen)} releases were new, "
+            f"next check in {interval / 3600:.1f}h"
+        )
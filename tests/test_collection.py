@@ -0,0 +1,124 @@
+import json
+import time
+
+from typing import Dict, List
+
+import pytest
+
+from free_bandcamp_downloader.collection import (
+    COLLECTION_ITEMS_URL,
+    CollectionIndex,
+    CollectionSync,
+)
+
+FAN_ID = 42
+
+
+def item(i: int) -> Dict:
+    return {
+        "sale_item_type": "p",
+        "sale_item_id": 1000 + i,
+        "tralbum_type": "a",
+        "tralbum_id": i,
+        "token": f"{2000 - i}::a::",
+    }
+
+
+def tralbum(i: int) -> Dict:
+    return {"item_type": "album", "id": i}
+
+
+class CollectionItems:
+    """Stands in for the collection_items API: `items` newest first, pages
+    of up to `count` older than the token, and the download pages of the
+    releases that have one"""
+
+    def __init__(self, items: List[Dict]):
+        self.items = items
+        self.requests: List[Dict] = []
+
+    def __call__(self, url: str, json: Dict) -> Dict:
+        assert url == COLLECTION_ITEMS_URL
+        assert json["fan_id"] == FAN_ID
+        self.requests.append(json)
+        older = [
+            item
+            for item in self.items
+            if int(item["token"].split(":")[0])
+            < int(json["older_than_token"].split(":")[0])
+        ]
+        page = older[: json["count"]]
+        return {
+            "items": page,
+            "more_available": len(older) > len(page),
+            "last_token": page[-1]["token"] if page else None,
+            "redownload_urls": {
+                f"p{item['sale_item_id']}": f"https://bandcamp.com/download?id={i}"
+                for i, item in enumerate(page)
+                if item["tralbum_id"] % 5
+            },
+        }
+
+
+def test_fetch_pages():
+    post_json = CollectionItems([item(i) for i in range(12)])
+    index = CollectionIndex.fetch(post_json, FAN_ID, count=5)
+    assert len(post_json.requests) == 3
+    assert post_json.requests[0]["older_than_token"].endswith("::a::")
+    assert [r["older_than_token"] for r in post_json.requests[1:]] == [
+        "1996::a::",
+        "1991::a::",
+    ]
+    # releases without a download page aren't in the index
+    assert sorted(index.urls) == sorted(f"a:{i}" for i in range(12) if i % 5)
+    assert index.get(tralbum(1)) is not None
+    assert index.get(tralbum(5)) is None
+
+
+def test_fetch_empty():
+    post_json = CollectionItems([])
+    assert CollectionIndex.fetch(post_json, FAN_ID).urls == {}
+    assert len(post_json.requests) == 1
+
+
+def test_fetched_once():
+    post_json = CollectionItems([item(i) for i in range(3)])
+    sync = CollectionSync()
+    assert sync.download_page(post_json, FAN_ID, tralbum(1)) is not None
+    # bought after the index was fetched
+    post_json.items.insert(0, item(3))
+    assert sync.download_page(post_json, FAN_ID, tralbum(3)) is None
+    assert len(post_json.requests) == 1
+
+
+def test_cached(tmp_path):
+    post_json = CollectionItems([item(i) for i in range(3)])
+    page = CollectionSync(str(tmp_path)).download_page(post_json, FAN_ID, tralbum(2))
+    assert json.loads((tmp_path / f"{FAN_ID}.json").read_text())["fan_id"] == FAN_ID
+    # a later run reads the index instead of fetching it
+    sync = CollectionSync(str(tmp_path))
+    assert sync.download_page(post_json, FAN_ID, tralbum(2)) == page
+    assert len(post_json.requests) == 1
+
+
+def test_cache_expires(tmp_path):
+    post_json = CollectionItems([item(i) for i in range(3)])
+    CollectionSync(str(tmp_path), ttl=60).index(post_json, FAN_ID)
+    path = tmp_path / f"{FAN_ID}.json"
+    data = json.loads(path.read_text())
+    data["fetched_at"] = time.time() - 61
+    path.write_text(json.dumps(data))
+    post_json.items.insert(0, item(3))
+    sync = CollectionSync(str(tmp_path), ttl=60)
+    assert sync.download_page(post_json, FAN_ID, tralbum(3)) is not None
+    assert len(post_json.requests) == 2
+    assert json.loads(path.read_text())["fetched_at"] > data["fetched_at"]
+
+
+@pytest.mark.parametrize("contents", ["", "{", '{"fan_id": 42}'])
+def test_bad_cache(tmp_path, contents: str):
+    (tmp_path / f"{FAN_ID}.json").write_text(contents)
+    post_json = CollectionItems([item(1)])
+    sync = CollectionSync(str(tmp_path))
+    assert sync.download_page(post_json, FAN_ID, tralbum(1)) is not None
+    assert len(post_json.requests) == 1
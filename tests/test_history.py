@@ -0,0 +1,123 @@
+import sqlite3
+
+import pytest
+
+from free_bandcamp_downloader.history import (
+    DownloadHistory,
+    normalize_url,
+    parse_text_history,
+)
+
+URL = "https://artist.bandcamp.com/album/release"
+
+
+@pytest.fixture
+def history(tmp_path):
+    # only a full batch is written
+    history = DownloadHistory(
+        str(tmp_path / "history.sqlite3"), batch_size=3, batch_interval=float("inf")
+    )
+    yield history
+    history.close()
+
+
+def stored(history: DownloadHistory) -> int:
+    """Rows another process sees"""
+    db = sqlite3.connect(history.path)
+    try:
+        return db.execute("SELECT COUNT(*) FROM downloads").fetchone()[0]
+    finally:
+        db.close()
+
+
+def test_normalize_url():
+    assert normalize_url(" http://Artist.Bandcamp.com/album/release/?x=1#t ") == URL
+    assert normalize_url("not a url") == "not a url"
+
+
+def test_parse_text_history():
+    assert parse_text_history("a:123\n") == ("album", 123)
+    assert parse_text_history("t:4") == ("track", 4)
+    assert parse_text_history(URL + "/") == ("url", URL)
+    assert parse_text_history("  \n") is None
+
+
+def test_batches(history: DownloadHistory):
+    history.add(("album", 1), URL)
+    history.add(("track", 2))
+    assert stored(history) == 0
+    history.add(("album", 3))
+    assert stored(history) == 3
+    history.add(("album", 4))
+    history.commit()
+    assert stored(history) == 4
+
+
+def test_pending_visible(history: DownloadHistory):
+    history.add(("album", 1), URL)
+    assert stored(history) == 0
+    assert history.is_downloaded(("album", 1))
+    assert ("album", 1) in history
+    assert history.find_url("http://artist.bandcamp.com/album/release/") == (
+        "album",
+        1,
+    )
+    assert history.is_downloaded(None, URL + "?from=label")
+    assert not history.is_downloaded(("album", 2), URL + "-other")
+
+
+def test_committed_visible(history: DownloadHistory):
+    history.add(("album", 1), URL)
+    history.add(("url", URL + "-free"))
+    history.commit()
+    assert history.find_url(URL) == ("album", 1)
+    assert history.find_url(URL + "-free") == ("url", URL + "-free")
+    assert history.find_url(URL + "-other") is None
+    assert sorted(history, key=str) == [("album", 1), ("url", URL + "-free")]
+    assert len(history) == 2
+
+
+def test_digest(history: DownloadHistory):
+    history.add(("album", 1), URL, "sha256:abcd")
+    assert history.digest(("album", 1)) == "sha256:abcd"
+    assert history.digest(("album", 2)) is None
+
+
+def test_url_recorded_for_id(history: DownloadHistory, tmp_path):
+    path = tmp_path / "downloaded.txt"
+    path.write_text("a:1\n")
+    history.import_text(str(path))
+    assert history.find_url(URL) is None
+    assert history.is_downloaded(("album", 1), URL)
+    assert history.find_url(URL) == ("album", 1)
+
+
+def test_import_text_offsets(history: DownloadHistory, tmp_path):
+    path = tmp_path / "downloaded.txt"
+    path.write_text("a:1\nt:2\n\n" + URL + "\na:")
+    assert history.import_text(str(path)) == 3
+    assert history.import_text(str(path)) == 0
+    # the line that was still being written, and one more
+    with open(path, "a") as f:
+        f.write("4\na:5\n")
+    assert history.import_text(str(path)) == 2
+    assert {("album", 1), ("track", 2), ("url", URL), ("album", 4)} < set(history)
+    # rewritten shorter, imported again from the start
+    path.write_text("a:6\n")
+    assert history.import_text(str(path)) == 1
+    assert ("album", 6) in history
+    assert len(history) == 6
+
+
+def test_open_text(tmp_path):
+    path = tmp_path / "downloaded.txt"
+    path.write_text("a:1\n")
+    with DownloadHistory.open(str(path)) as history:
+        assert history.path == str(path) + ".sqlite3"
+        assert ("album", 1) in history
+    with open(path, "a") as f:
+        f.write("a:2\n")
+    with DownloadHistory.open(str(path)) as history:
+        assert len(history) == 2
+    with DownloadHistory.open(str(path) + ".sqlite3") as history:
+        assert len(history) == 2
@@ -0,0 +1,196 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from typing import List, Optional
+
+import pytest
+
+from free_bandcamp_downloader import jobqueue
+from free_bandcamp_downloader.jobqueue import JobQueue, read_urls
+
+LEASE = 0.3
+URLS = [f"https://artist.bandcamp.com/album/a{i}" for i in range(5)]
+
+
+@pytest.fixture
+def open_queue(tmp_path):
+    """Opens workers on one queue file, closed at the end of the test"""
+    queues: List[JobQueue] = []
+
+    def open_queue(worker: Optional[str] = None, **kwargs) -> JobQueue:
+        kwargs.setdefault("lease", LEASE)
+        queue = JobQueue(str(tmp_path / "queue.sqlite3"), worker=worker, **kwargs)
+        queues.append(queue)
+        return queue
+
+    yield open_queue
+    for queue in queues:
+        if not queue._stop.is_set():
+            queue.close()
+
+
+def kill(queue: JobQueue):
+    """Stops a worker without giving back its claims"""
+    queue._stop.set()
+    queue._renewer.join()
+    queue._db.close()
+
+
+def album_info(id: int) -> dict:
+    return {
+        "tralbum_data": {
+            "current": {"type": "album", "id": id},
+            "url": URLS[id],
+        },
+        "file_name": f"a{id}.zip",
+        "files": [f"a{id}/01.flac"],
+        "digest": None,
+        "head_data": {"title": f"A{id}"},
+    }
+
+
+def test_read_urls(tmp_path):
+    path = tmp_path / "urls.txt"
+    path.write_text("# label\n" + URLS[0] + "\n\n  " + URLS[1] + "  \n")
+    assert list(read_urls(str(path))) == URLS[:2]
+
+
+def test_add_and_claim(open_queue):
+    queue = open_queue()
+    assert queue.add(URLS) == 5
+    # the same jobs however they are linked
+    assert queue.add([URLS[0] + "/", URLS[1].replace("https", "http")]) == 0
+    assert queue.claim(2) == URLS[:2]
+    assert queue.claim(10) == URLS[2:]
+    assert queue.claim(10) == []
+
+
+def test_states(open_queue):
+    queue = open_queue(max_attempts=2)
+    queue.add(URLS[:3])
+    queue.claim(3)
+    queue.set_state(URLS[0], jobqueue.DOWNLOADING)
+    queue.set_state(URLS[1], jobqueue.DONE)
+    queue.set_state(URLS[2], jobqueue.FAILED)
+    assert queue.counts() == {"downloading": 1, "done": 1, "failed": 1}
+    assert queue.retry_failed() == 1
+    assert queue.claim(3) == [URLS[2]]
+    queue.set_state(URLS[2], jobqueue.FAILED)
+    # failed max_attempts times
+    assert queue.retry_failed() == 0
+
+
+def test_two_workers(open_queue):
+    first, second = open_queue("first"), open_queue("second")
+    first.add(URLS)
+    assert first.claim(3) == URLS[:3]
+    assert second.claim(3) == URLS[3:]
+    assert first.in_flight_elsewhere() == 2
+    assert second.in_flight_elsewhere() == 3
+    # the second worker can't move jobs of the first
+    second.set_state(URLS[0], jobqueue.DONE)
+    assert first.counts() == {"discovered": 5}
+
+
+def test_lease_renewed(open_queue):
+    first, second = open_queue("first"), open_queue("second")
+    first.add(URLS[:1])
+    first.claim(1)
+    time.sleep(3 * LEASE)
+    second.reclaim()
+    assert second.claim(1) == []
+    assert second.in_flight_elsewhere() == 1
+
+
+def test_lease_expires(open_queue):
+    first, second = open_queue("first"), open_queue("second")
+    first.add(URLS[:3])
+    first.claim(3)
+    first.set_state(URLS[0], jobqueue.DOWNLOADING)
+    first.set_state(URLS[1], jobqueue.POST_PROCESSING, album_info(1))
+    kill(first)
+    assert second.claim(3) == []
+    time.sleep(LEASE + 0.1)
+    assert second.in_flight_elsewhere() == 0
+    # the downloaded job is taken over, the interrupted one started over
+    reclaimed = second.reclaim()
+    assert [url for url, _ in reclaimed] == [URLS[1]]
+    assert reclaimed[0][1]["id"] == ["album", 1]
+    assert reclaimed[0][1]["file_name"] == "a1.zip"
+    assert second.claim(3) == [URLS[0], URLS[2]]
+
+
+def test_dead_worker_on_this_host(open_queue):
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    dead = open_queue(f"{socket.gethostname()}:{process.pid}:dead", lease=60)
+    dead.add(URLS[:1])
+    dead.claim(1)
+    dead.set_state(URLS[0], jobqueue.DOWNLOADING)
+    assert dead.claim_release(("album", 0))
+    kill(dead)
+    second = open_queue("second")
+    # without waiting for the lease
+    second.reclaim()
+    assert second.claim(1) == URLS[:1]
+    assert second.claim_release(("album", 0))
+
+
+def test_unknown_owners_wait_for_their_lease(open_queue):
+    other = open_queue("not-a-host-and-pid", lease=60)
+    odd = open_queue(f"{socket.gethostname()}:pid:x", lease=60)
+    other.add(URLS[:2])
+    other.claim(1)
+    odd.claim(1)
+    second = open_queue("second")
+    assert second.reclaim() == []
+    assert second.claim(2) == []
+    assert second.in_flight_elsewhere() == 2
+
+
+def test_claim_release(open_queue):
+    first, second = open_queue("first"), open_queue("second")
+    assert first.claim_release(("album", 1))
+    assert first.claim_release(("album", 1))
+    assert not second.claim_release(("album", 1))
+    first.finish_release(("album", 1))
+    assert second.claim_release(("album", 1))
+    # only the owner gives it up
+    first.finish_release(("album", 1))
+    assert not first.claim_release(("album", 1))
+    kill(second)
+    time.sleep(LEASE + 0.1)
+    assert first.claim_release(("album", 1))
+
+
+def test_filter_releases(open_queue):
+    first, second = open_queue("first"), open_queue("second")
+    releases = [{"url": url} for url in URLS[:3]]
+    label = "https://label.bandcamp.com/music"
+    assert list(first.filter_releases(label, releases[:2])) == releases[:2]
+    assert list(second.filter_releases(label, releases)) == releases[2:]
+    assert first.claim(3) == []
+
+
+def test_close_gives_back_claims(open_queue):
+    first = open_queue("first")
+    first.add(URLS[:2])
+    first.claim(2)
+    first.set_state(URLS[0], jobqueue.AWAITING_EMAIL)
+    first.set_state(URLS[1], jobqueue.DONE)
+    first.claim_release(("album", 0))
+    first.close()
+    second = open_queue("second")
+    assert second.claim(2) == URLS[:1]
+    assert second.claim_release(("album", 0))
+
+
+def test_temporary():
+    queue = JobQueue()
+    queue.add(URLS)
+    path = queue.path
+    queue.close()
+    assert not any(os.path.exists(path + suffix) for suffix in ("", "-wal", "-shm"))
@@ -0,0 +1,203 @@
+from types import SimpleNamespace
+from typing import Dict, List
+
+from free_bandcamp_downloader.mail import (
+    GuerrillaInbox,
+    Inbox,
+    InboxPool,
+    MailMessage,
+    MailProvider,
+)
+
+
+class FakeInbox(Inbox):
+    def __init__(self, address: str):
+        self.address = address
+        self.messages: List[MailMessage] = []
+        self.bodies: Dict[str, str] = {}
+        self.listed = 0
+        self.broken = False
+
+    def deliver(self, subject: str, body: str = "") -> MailMessage:
+        message = MailMessage(str(len(self.messages)), "noreply@bandcamp.com", subject)
+        self.messages.append(message)
+        self.bodies[message.id] = body
+        return message
+
+    def list_messages(self) -> List[MailMessage]:
+        self.listed += 1
+        if self.broken:
+            raise ConnectionError("mail server is down")
+        return list(self.messages)
+
+    def get_body(self, id: str) -> str:
+        return self.bodies[id]
+
+
+class FakeSession:
+    """The part of a GuerrillaMailSession the inbox uses, with pages of
+    `page_size` messages, newest first"""
+
+    def __init__(self, page_size: int = GuerrillaInbox.PAGE_SIZE):
+        self.page_size = page_size
+        self.emails: List[SimpleNamespace] = []
+        self.offsets: List[int] = []
+
+    def deliver(self, count: int):
+        for _ in range(count):
+            guid = str(len(self.emails) + 1)
+            self.emails.append(
+                SimpleNamespace(guid=guid, sender="noreply@bandcamp.com", subject=guid)
+            )
+
+    def get_session_state(self) -> Dict:
+        return {"email_address": "user@guerrilla.mail"}
+
+    def get_email_list(self, offset: int = 0) -> List[SimpleNamespace]:
+        self.offsets.append(offset)
+        newest_first = self.emails[::-1]
+        return newest_first[offset : offset + self.page_size]
+
+
+class FakeProvider(MailProvider):
+    def __init__(self):
+        self.inboxes: List[FakeInbox] = []
+
+    def new_inbox(self) -> FakeInbox:
+        inbox = FakeInbox(f"user{len(self.inboxes)}@fake.mail")
+        self.inboxes.append(inbox)
+        return inbox
+
+
+def pool(size: int) -> InboxPool:
+    return InboxPool(FakeProvider(), size)
+
+
+def test_first_address():
+    inboxes = pool(3)
+    assert inboxes.address == "user0@fake.mail"
+    assert inboxes.address == "user0@fake.mail"
+    assert len(inboxes.inboxes) == 1
+    inboxes.close()
+
+
+def test_spreads_releases():
+    inboxes = pool(3)
+    addresses = [inboxes.address_for(("album", i)) for i in range(5)]
+    assert addresses == [
+        "user0@fake.mail",
+        "user1@fake.mail",
+        "user2@fake.mail",
+        "user0@fake.mail",
+        "user1@fake.mail",
+    ]
+    # the same inbox until it is released
+    assert inboxes.address_for(("album", 1)) == "user1@fake.mail"
+    inboxes.release(("album", 2))
+    inboxes.release(("album", 2))
+    assert inboxes.address_for(("album", 5)) == "user2@fake.mail"
+    inboxes.close()
+
+
+def test_idle_inbox_reused():
+    inboxes = pool(3)
+    assert inboxes.address_for(("album", 0)) == "user0@fake.mail"
+    inboxes.release(("album", 0))
+    # no new inbox while one is idle
+    assert inboxes.address_for(("album", 1)) == "user0@fake.mail"
+    assert len(inboxes.inboxes) == 1
+    inboxes.close()
+
+
+def test_poll():
+    inboxes = pool(2)
+    inboxes.address_for(("album", 0))
+    inboxes.address_for(("album", 1))
+    first, second = inboxes.provider.inboxes
+    message = first.deliver("Your download of A0")
+    assert inboxes.poll() == [(first, message)]
+    # returned once, unless forgotten
+    assert inboxes.poll() == []
+    inboxes.forget(first, message)
+    assert inboxes.poll() == [(first, message)]
+    # the inboxes number their messages the same way
+    other = second.deliver("Your download of A1")
+    assert inboxes.poll() == [(second, other)]
+    inboxes.close()
+
+
+def test_poll_skips_idle_inboxes():
+    inboxes = pool(2)
+    inboxes.address_for(("album", 0))
+    inboxes.address_for(("album", 1))
+    first, second = inboxes.provider.inboxes
+    inboxes.release(("album", 0))
+    second.deliver("Your download of A1")
+    assert [inbox for inbox, _ in inboxes.poll()] == [second]
+    assert first.listed == 0
+    inboxes.close()
+
+
+def test_poll_survives_errors():
+    inboxes = pool(2)
+    inboxes.address_for(("album", 0))
+    inboxes.address_for(("album", 1))
+    first, second = inboxes.provider.inboxes
+    first.broken = True
+    first.deliver("Your download of A0")
+    message = second.deliver("Your download of A1")
+    assert inboxes.poll() == [(second, message)]
+    first.broken = False
+    assert [m.subject for _, m in inboxes.poll()] == ["Your download of A0"]
+    inboxes.close()
+
+
+def test_forget_unlisted():
+    inboxes = pool(1)
+    inboxes.address_for(("album", 0))
+    (inbox,) = inboxes.provider.inboxes
+    message = inbox.deliver("Your download of A0")
+    assert inboxes.poll() == [(inbox, message)]
+    # an inbox that only lists new messages
+    inbox.messages = []
+    inboxes.forget(inbox, message)
+    assert inboxes.poll() == [(inbox, message)]
+    assert inboxes.poll() == []
+    inboxes.close()
+
+
+def test_guerrilla_inbox_lists_new_messages():
+    session = FakeSession()
+    inbox = GuerrillaInbox(session)
+    assert inbox.address == "user@guerrilla.mail"
+    session.deliver(1)
+    assert [m.id for m in inbox.list_messages()] == ["1"]
+    assert session.offsets == [0]
+    session.offsets.clear()
+    assert inbox.list_messages() == []
+    assert session.offsets == [0]
+
+
+def test_guerrilla_inbox_pages():
+    session = FakeSession()
+    inbox = GuerrillaInbox(session)
+    session.deliver(2)
+    inbox.list_messages()
+    # more than two pages arrived since the last call
+    session.deliver(45)
+    session.offsets.clear()
+    assert [m.id for m in inbox.list_messages()] == [str(i) for i in range(47, 2, -1)]
+    assert session.offsets == [0, 20, 40]
+    session.deliver(1)
+    session.offsets.clear()
+    assert [m.id for m in inbox.list_messages()] == ["48"]
+    assert session.offsets == [0]
+
+
+def test_guerrilla_inbox_whole_pages():
+    session = FakeSession()
+    inbox = GuerrillaInbox(session)
+    session.deliver(20)
+    assert len(inbox.list_messages()) == 20
+    # a full page could be followed by another one
+    assert session.offsets == [0, 20]
@@ -0,0 +1,88 @@
+import random
+import threading
+
+from typing import List, Tuple
+
+from free_bandcamp_downloader.pipeline import OrderedCommitter
+
+
+def album(name: str) -> dict:
+    return {"name": name}
+
+
+def committer() -> Tuple[OrderedCommitter, List[str]]:
+    committed: List[str] = []
+    return OrderedCommitter(lambda info: committed.append(info["name"])), committed
+
+
+def test_commits_in_key_order():
+    ordered, committed = committer()
+    for i in range(4):
+        ordered.register((i,))
+    ordered.resolve((2,), album("c"))
+    ordered.resolve((1,), album("b"))
+    assert committed == []
+    ordered.resolve((0,), album("a"))
+    assert committed == ["a", "b", "c"]
+    ordered.resolve((3,), album("d"))
+    assert committed == ["a", "b", "c", "d"]
+
+
+def test_nothing_to_commit():
+    ordered, committed = committer()
+    for i in range(3):
+        ordered.register((i,))
+    ordered.resolve((2,), album("c"))
+    # e.g. a release that was already downloaded
+    ordered.resolve((0,))
+    assert committed == []
+    ordered.resolve((1,))
+    assert committed == ["c"]
+
+
+def test_label_releases():
+    ordered, committed = committer()
+    ordered.register((0,))
+    ordered.register((1,))
+    ordered.resolve((1,), album("after label"))
+    # the label page was parsed, its releases come after it and before (1,)
+    ordered.register((0, 0))
+    ordered.register((0, 1))
+    ordered.resolve((0,))
+    ordered.resolve((0, 1), album("second release"))
+    assert committed == []
+    ordered.resolve((0, 0), album("first release"))
+    assert committed == ["first release", "second release", "after label"]
+
+
+def test_resolved_once():
+    ordered, committed = committer()
+    ordered.register((0,))
+    ordered.register((1,))
+    ordered.resolve((1,), album("b"))
+    # failed in post-processing after it was resolved
+    ordered.resolve((1,))
+    ordered.resolve((0,), album("a"))
+    ordered.resolve((0,), album("a again"))
+    assert committed == ["a", "b"]
+
+
+def test_threads():
+    ordered, committed = committer()
+    keys = [(i,) for i in range(200)]
+    for key in keys:
+        ordered.register(key)
+    shuffled = keys[:]
+    random.Random(0).shuffle(shuffled)
+    threads = [
+        threading.Thread(
+            target=lambda part: [ordered.resolve(k, album(str(k[0]))) for k in part],
+            args=(shuffled[i::4],),
+        )
+        for i in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert committed == [str(i) for i in range(200)]
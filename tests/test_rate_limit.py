@@ -0,0 +1,123 @@
+import email.utils
+import time
+
+import pytest
+import requests
+
+from requests.structures import CaseInsensitiveDict
+
+from free_bandcamp_downloader.rate_limit import (
+    RateLimiter,
+    TokenBucket,
+    may_retry,
+    parse_retry_after,
+)
+
+
+def bucket(**kwargs) -> TokenBucket:
+    args = dict(rate=10, burst=2, min_rate=1, max_rate=12, increase=1)
+    args.update(kwargs)
+    bucket = TokenBucket(**args)
+    bucket.updated = 0.0
+    return bucket
+
+
+def response(status: int, **headers: str) -> requests.Response:
+    r = requests.Response()
+    r.status_code = status
+    r.headers = CaseInsensitiveDict(
+        {name.replace("_", "-"): value for name, value in headers.items()}
+    )
+    return r
+
+
+def test_burst_then_rate():
+    b = bucket()
+    assert b.reserve(0) == 0
+    assert b.reserve(0) == 0
+    assert b.reserve(0) == pytest.approx(0.1)
+    assert b.reserve(0) == pytest.approx(0.2)
+    # refilled, but never above the burst
+    assert b.reserve(10) == 0
+    assert b.tokens == pytest.approx(1)
+
+
+def test_additive_increase():
+    b = bucket()
+    b.succeeded()
+    assert b.rate == 11
+    b.succeeded()
+    b.succeeded()
+    assert b.rate == 12
+
+
+def test_multiplicative_decrease():
+    b = bucket()
+    assert b.throttled(0, None) == 2
+    assert b.rate == 5
+    assert b.throttled(0, None) == 4
+    assert b.throttled(0, None) == 8
+    assert b.rate == 1.25
+    b.throttled(0, None)
+    assert b.rate == 1
+    # the backoff starts over once a request succeeds
+    b.succeeded()
+    assert b.failures == 0
+    assert b.rate == 2
+
+
+def test_backoff_capped():
+    b = bucket()
+    for _ in range(10):
+        wait = b.throttled(0, None)
+    assert wait == 60
+
+
+def test_pause():
+    b = bucket()
+    assert b.throttled(1, 5) == 5
+    # no tokens before the pause is over
+    assert b.reserve(2) == pytest.approx(4)
+    assert b.reserve(6) == 0
+    # a shorter Retry-After doesn't end the pause early
+    b.throttled(7, 1)
+    b.throttled(7, 10)
+    b.throttled(7, 1)
+    assert b.reserve(8) == pytest.approx(9)
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("") is None
+    assert parse_retry_after("120") == 120
+    assert parse_retry_after("1.5") == 1.5
+    assert parse_retry_after("-3") == 0
+    assert parse_retry_after("soon") is None
+    date = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert parse_retry_after(date) == pytest.approx(30, abs=2)
+    past = email.utils.formatdate(time.time() - 30, usegmt=True)
+    assert parse_retry_after(past) == 0
+
+
+def test_may_retry():
+    assert may_retry("get", 500, {})
+    assert may_retry("HEAD", 502, {})
+    assert not may_retry("POST", 429, {})
+    assert not may_retry("POST", 500, {"Retry-After": "1"})
+    assert may_retry("POST", 429, {"Retry-After": "1"})
+    assert may_retry("post", 503, CaseInsensitiveDict({"retry-after": "1"}))
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(rate=5, cdn_rate=20)
+    url = "https://artist.bandcamp.com/album/a"
+    assert limiter.update(url, response(200)) is None
+    assert limiter.update(url, response(404)) is None
+    assert limiter.update(url, response(429, Retry_After="3")) == 3
+    assert limiter.update(url, response(503)) == 4
+    assert limiter.stats.throttled == 2
+    page = limiter._bucket(url, "page")
+    assert page.rate == pytest.approx(5.2 / 4)
+    # other hosts and the cdn budget aren't slowed down
+    assert limiter._bucket("https://other.bandcamp.com/", "page").rate == 5
+    assert limiter._bucket(url, "cdn").rate == 20
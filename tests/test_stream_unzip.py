@@ -0,0 +1,273 @@
+import io
+import os
+import struct
+import zipfile
+import zlib
+
+from typing import List, Tuple
+
+import pytest
+
+from free_bandcamp_downloader.stream_unzip import (
+    CENTRAL_HEADER,
+    CENTRAL_HEADER_STRUCT,
+    DATA_DESCRIPTOR,
+    DEFLATED,
+    END_OF_CENTRAL_DIRECTORY,
+    END_OF_CENTRAL_DIRECTORY_STRUCT,
+    LOCAL_HEADER,
+    LOCAL_HEADER_STRUCT,
+    ZIP64_EXTRA_ID,
+    CorruptZipError,
+    StreamUnzipError,
+    ZipStreamExtractor,
+    ZipStreamReader,
+    safe_member_path,
+)
+
+MEMBERS = [
+    ("01 first.flac", b"first track " * 1000),
+    ("02 second.flac", os.urandom(5000)),
+    ("cover.jpg", b""),
+]
+
+
+class Unseekable(io.RawIOBase):
+    """Makes zipfile write data descriptors like a streaming zipper"""
+
+    def __init__(self):
+        self.buf = io.BytesIO()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        return self.buf.write(b)
+
+
+def make_zip(
+    members: List[Tuple[str, bytes]] = MEMBERS,
+    compression: int = zipfile.ZIP_DEFLATED,
+    descriptor: bool = False,
+) -> bytes:
+    out = Unseekable() if descriptor else io.BytesIO()
+    with zipfile.ZipFile(out, "w", compression) as zf:
+        for name, data in members:
+            zf.writestr(name, data)
+    return (out.buf if descriptor else out).getvalue()
+
+
+def make_zip64(
+    members: List[Tuple[str, bytes]] = MEMBERS, local_sizes: str = "descriptor"
+) -> bytes:
+    """A zip with a zip64 extra field for every member. `local_sizes` is
+    "descriptor" for zero sizes in the local header followed by a 64 bit data
+    descriptor, or "extra" for 0xFFFFFFFF sizes with the real ones in the
+    extra field"""
+    out = bytearray()
+    central = bytearray()
+    for name, data in members:
+        raw_name = name.encode()
+        compressed = zlib.compressobj(wbits=-15)
+        compressed = compressed.compress(data) + compressed.flush()
+        crc = zlib.crc32(data)
+        offset = len(out)
+        if local_sizes == "descriptor":
+            flags, header = 0x8, (0, 0, 0)
+            extra = struct.pack("<HHQQ", ZIP64_EXTRA_ID, 16, 0, 0)
+        else:
+            flags, header = 0, (crc, 0xFFFFFFFF, 0xFFFFFFFF)
+            extra = struct.pack("<HHQQ", ZIP64_EXTRA_ID, 16, len(data), len(compressed))
+        out += LOCAL_HEADER_STRUCT.pack(
+            LOCAL_HEADER,
+            45,
+            flags,
+            DEFLATED,
+            0,
+            0x21,
+            *header,
+            len(raw_name),
+            len(extra)
+        )
+        out += raw_name + extra + compressed
+        if local_sizes == "descriptor":
+            out += DATA_DESCRIPTOR + struct.pack(
+                "<IQQ", crc, len(compressed), len(data)
+            )
+        central_extra = struct.pack(
+            "<HHQQQ", ZIP64_EXTRA_ID, 24, len(data), len(compressed), offset
+        )
+        central += CENTRAL_HEADER_STRUCT.pack(
+            CENTRAL_HEADER,
+            45,
+            45,
+            flags,
+            DEFLATED,
+            0,
+            0x21,
+            crc,
+            0xFFFFFFFF,
+            0xFFFFFFFF,
+            len(raw_name),
+            len(central_extra),
+            0,
+            0,
+            0,
+            0,
+            0xFFFFFFFF,
+        )
+        central += raw_name + central_extra
+    end = END_OF_CENTRAL_DIRECTORY_STRUCT.pack(
+        END_OF_CENTRAL_DIRECTORY,
+        0,
+        0,
+        len(members),
+        len(members),
+        len(central),
+        len(out),
+        0,
+    )
+    return bytes(out + central + end)
+
+
+def feed(data: bytes, chunk_size: int = 7) -> ZipStreamReader:
+    reader = ZipStreamReader()
+    for i in range(0, len(data), chunk_size):
+        reader.feed(data[i : i + chunk_size])
+    reader.close()
+    return reader
+
+
+def member_names(reader: ZipStreamReader) -> List[str]:
+    return [member["name"] for member in reader.members]
+
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+@pytest.mark.parametrize("chunk_size", [1, 7, 1 << 20])
+def test_reads_members(compression: int, chunk_size: int):
+    reader = feed(make_zip(compression=compression), chunk_size)
+    assert reader.done
+    assert member_names(reader) == [name for name, _ in MEMBERS]
+    assert [member["size"] for member in reader.members] == [
+        len(data) for _, data in MEMBERS
+    ]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1 << 20])
+def test_data_descriptor(chunk_size: int):
+    data = make_zip(descriptor=True)
+    reader = feed(data, chunk_size)
+    assert all(member["has_descriptor"] for member in reader.members)
+    assert member_names(reader) == [name for name, _ in MEMBERS]
+
+
+def test_data_descriptor_stored_without_size():
+    data = make_zip(compression=zipfile.ZIP_STORED, descriptor=True)
+    with pytest.raises(StreamUnzipError, match="stored without a size"):
+        feed(data)
+
+
+def test_crc_mismatch():
+    data = bytearray(make_zip(compression=zipfile.ZIP_STORED))
+    # flip a byte of the first member's data, just after its name
+    pos = LOCAL_HEADER_STRUCT.size + len(MEMBERS[0][0]) + 10
+    data[pos] ^= 0xFF
+    with pytest.raises(CorruptZipError, match="Bad CRC-32"):
+        feed(bytes(data))
+
+
+def test_crc_mismatch_in_data_descriptor():
+    data = make_zip(descriptor=True)
+    # the first descriptor follows the first member's deflated data
+    pos = data.index(DATA_DESCRIPTOR) + 4
+    data = data[:pos] + bytes(b ^ 0xFF for b in data[pos : pos + 4]) + data[pos + 4 :]
+    with pytest.raises(CorruptZipError, match="Bad CRC-32"):
+        feed(data)
+
+
+def test_truncated_member():
+    data = make_zip()
+    with pytest.raises(CorruptZipError, match="middle of a member"):
+        feed(data[: len(data) // 2])
+
+
+@pytest.mark.parametrize("keep", [0, 10, CENTRAL_HEADER_STRUCT.size + 3, -5])
+def test_truncated_central_directory(keep: int):
+    data = make_zip()
+    central = data.index(CENTRAL_HEADER)
+    end = central + keep if keep >= 0 else len(data) + keep
+    with pytest.raises(CorruptZipError):
+        feed(data[:end])
+
+
+def test_central_directory_mismatch():
+    data = make_zip()
+    other = make_zip(MEMBERS[:2])
+    # members of one zip, central directory of another
+    with pytest.raises(CorruptZipError):
+        feed(data[: data.index(CENTRAL_HEADER)] + other[other.index(CENTRAL_HEADER) :])
+
+
+@pytest.mark.parametrize("local_sizes", ["descriptor", "extra"])
+@pytest.mark.parametrize("chunk_size", [1, 7, 1 << 20])
+def test_zip64(local_sizes: str, chunk_size: int):
+    data = make_zip64(local_sizes=local_sizes)
+    # the crafted zip is valid for zipfile too
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.testzip() is None
+    reader = feed(data, chunk_size)
+    assert all(member["zip64"] for member in reader.members)
+    assert [member["size"] for member in reader.members] == [
+        len(data) for _, data in MEMBERS
+    ]
+
+
+def test_zip64_sizes_missing():
+    data = bytearray(make_zip64(local_sizes="extra"))
+    # rename the first zip64 extra field so it can't be found
+    pos = LOCAL_HEADER_STRUCT.size + len(MEMBERS[0][0])
+    data[pos : pos + 2] = b"\xff\xff"
+    with pytest.raises(StreamUnzipError, match="Zip64 sizes missing"):
+        feed(bytes(data))
+
+
+def test_extractor(tmp_path):
+    finalized = []
+    extractor = ZipStreamExtractor(str(tmp_path), finalized.append)
+    extractor.feed(make_zip(descriptor=True))
+    files = extractor.close()
+    assert files == [str(tmp_path / name) for name, _ in MEMBERS]
+    for name, data in MEMBERS:
+        assert (tmp_path / name).read_bytes() == data
+    # finalized before they were renamed into place
+    assert [os.path.basename(path) for path in finalized] == [
+        "01 first.part.flac",
+        "02 second.part.flac",
+        "cover.part.jpg",
+    ]
+
+
+def test_extractor_reset(tmp_path):
+    extractor = ZipStreamExtractor(str(tmp_path))
+    data = make_zip()
+    extractor.feed(data[: len(data) // 2])
+    extractor.reset()
+    assert os.listdir(tmp_path) == []
+    extractor.feed(data)
+    assert len(extractor.close()) == len(MEMBERS)
+
+
+def test_extractor_stays_in_dir(tmp_path):
+    members = [("../../escape.flac", b"a"), ("/abs/dir/track.flac", b"b")]
+    extractor = ZipStreamExtractor(str(tmp_path / "album"))
+    extractor.feed(make_zip(members))
+    assert extractor.close() == [
+        str(tmp_path / "album" / "escape.flac"),
+        str(tmp_path / "album" / "abs" / "dir" / "track.flac"),
+    ]
+
+
+def test_safe_member_path():
+    assert safe_member_path("out", "a/../b\\c.flac") == os.path.join(
+        "out", "a", "b", "c.flac"
+    )